@@ -0,0 +1,117 @@
+"""
+What listing pages need to know about an image before downloading it.
+
+Every image document holds an ``analysis`` sub-document: ``width`` and
+``height`` as displayed, ``format``, ``size`` in bytes, the dominant
+``color`` and a ``placeholder``, a tiny WebP preview as a data URI a page
+can show, blurred, until the image arrives. It is None for files Pillow
+can't read.
+
+Uploads analyze the file in the image pool while it is being stored. Run
+``python analysis.py`` to analyze the images stored before.
+"""
+import argparse
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, UnidentifiedImageError
+from pymongo import UpdateOne
+
+import backends
+import db
+import imaging
+import layout
+import pools
+import storage
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_BATCH_SIZE = 100
+# Files that aren't images Pillow reads, or are truncated.
+ANALYSIS_ERRORS = (UnidentifiedImageError, Image.DecompressionBombError, OSError)
+
+
+async def analyze(executor, source):
+    """The analysis of a file path or the bytes of an image, None if unreadable."""
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(executor, imaging.analyze, source)
+    except ANALYSIS_ERRORS as e:
+        logger.info(f"Image not analyzed: {e}")
+    except Exception:
+        # Never worth failing an upload for.
+        logger.exception("Image analysis failed")
+    return None
+
+
+async def analyze_stored(files, key, executor):
+    try:
+        async with files.local_file(key) as path:
+            return await analyze(executor, str(path))
+    except FileNotFoundError:
+        return None
+
+
+async def backfill(
+    database, files, directory, executor, batch_size=BACKFILL_BATCH_SIZE
+):
+    """Analyze the images stored without an analysis, returns how many."""
+    images = database["images"]
+    analyzed = 0
+    while True:
+        batch = await images.find(
+            db.live({"analysis": {"$exists": False}}), {"_id": 1, "image_path": 1}
+        ).limit(batch_size).to_list(length=None)
+        if not batch:
+            return analyzed
+
+        # The pool works on the whole batch at once.
+        results = await asyncio.gather(
+            *(
+                analyze_stored(
+                    files,
+                    layout.key_for(directory, image_data["image_path"]),
+                    executor,
+                )
+                for image_data in batch
+            )
+        )
+        await images.bulk_write(
+            [
+                UpdateOne({"_id": image_data["_id"]}, {"$set": {"analysis": result}})
+                for image_data, result in zip(batch, results)
+            ],
+            ordered=False,
+        )
+        analyzed += len(batch)
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Analyze images stored before uploads were analyzed."
+    )
+    parser.add_argument("--directory", default="images")
+    parser.add_argument("--batch-size", type=int, default=BACKFILL_BATCH_SIZE)
+    options = parser.parse_args()
+
+    client = db.create_client()
+    try:
+        threads = ThreadPoolExecutor(storage.STORAGE_IO_THREADS)
+        image_threads = ThreadPoolExecutor(pools.IMAGE_POOL_THREADS)
+        with threads, image_threads:
+            files = backends.create_backend(storage.FileIO(threads), options.directory)
+            analyzed = await backfill(
+                client[db.db_name],
+                files,
+                options.directory,
+                image_threads,
+                options.batch_size,
+            )
+        print(f"{analyzed} images analyzed")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
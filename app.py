@@ -1,26 +1,97 @@
-import re
+import asyncio
+import copy
+import functools
 import os
 import uuid
-import random
 from pathlib import Path
 
 from sanic import Sanic, response
 from sanic_cors import CORS
 from sanic.request import Request
-from sanic.response import json, file, HTTPResponse
-from pymongo import MongoClient
-
-app = Sanic(__name__)
+from sanic.response import json, raw, redirect, HTTPResponse
+from pymongo.errors import BulkWriteError
+
+import analysis
+import backends
+import blobs
+import caching
+import collector
+import db
+import derivatives
+import facets
+import fields
+import image_cache
+import imaging
+import layout
+import metrics
+import pagination
+import pools
+import sampling
+import search_cache as search_cache_module
+import search_index
+import serving
+import storage
+import transcoding
+import uploads
+import versioning
+
+try:
+    # Several times faster than the json module on large search pages.
+    from orjson import dumps as json_dumps
+except ImportError:
+    json_dumps = None
+
+app = Sanic(__name__, dumps=json_dumps)
 CORS(app)
 
 # Connect to MongoDB
-mongo_uri = os.getenv("DB_URL") or "mongodb://localhost:27017"
-db_name = "image_db"
-client = MongoClient(mongo_uri)
-db = client[db_name]
-collection = db["images"]
+db.setup(app)
+image_cache.setup(app)
+metrics.setup(app)
+search_index.setup(app)
+facets.setup(app)
+sampling.setup(app)
+pools.setup(app)
+storage.setup(app)
+derivatives.setup(app)
+collector.setup(app)
+transcoding.setup(app)
 
 IMAGE_DIRECTORY = Path("images")
+# Uploads are streamed here first, on the same filesystem for atomic renames.
+UPLOAD_TEMP_DIRECTORY = IMAGE_DIRECTORY.joinpath(".tmp")
+
+
+@app.before_server_start
+async def setup_caches(app):
+    app.ctx.count_cache = caching.TTLCache(
+        pagination.COUNT_CACHE_SIZE, pagination.COUNT_CACHE_TTL
+    )
+    app.ctx.search_cache = search_cache_module.SearchCache()
+    # Writes of other workers arrive through the image cache's feed.
+    app.ctx.image_cache.add_listener(app.ctx.search_cache.invalidate)
+    app.ctx.hot_files = serving.HotFiles()
+
+
+@app.before_server_start
+async def setup_storage(app):
+    # Uploads are staged on local disk whatever the backend.
+    await app.ctx.storage.mkdir(UPLOAD_TEMP_DIRECTORY)
+    app.ctx.files = backends.create_backend(app.ctx.storage, str(IMAGE_DIRECTORY))
+    app.ctx.blobs = blobs.BlobStore(
+        app.ctx.images.db,
+        IMAGE_DIRECTORY,
+        UPLOAD_TEMP_DIRECTORY,
+        app.ctx.storage,
+        app.ctx.files,
+    )
+    app.ctx.transcoder = transcoding.Transcoder(
+        app.ctx.images.db,
+        app.ctx.files,
+        app.ctx.blobs,
+        app.ctx.image_cache,
+        functools.partial(pools.run_in_pool, app),
+    )
 
 
 def str2bool(s):
@@ -31,7 +102,8 @@ def str2bool(s):
 
 async def add_cors_headers(request: Request, response: HTTPResponse):
     response.headers["Access-Control-Allow-Origin"] = "*"
-    response.headers["Access-Control-Allow-Headers"] = "Content-Type"
+    response.headers["Access-Control-Allow-Headers"] = "Content-Type, If-Match"
+    response.headers["Access-Control-Expose-Headers"] = "ETag"
     response.headers["Access-Control-Max-Age"] = "3600"
     response.headers["Access-Control-Allow-Methods"] = (
         "DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT"
@@ -60,6 +132,114 @@ class ImageInfo:
         # 狀態:(註:服裝的新舊情況)
         self.status = form_data.get("status", "")
 
+    def to_dict(self):
+        return {
+            "business_type": self.business_type,
+            "category": self.category,
+            "number": self.number,
+            "title": self.title,
+            "name": self.name,
+            "content": self.content,
+            "price": self.price,
+            "status": self.status,
+        }
+
+
+INFO_FIELDS = tuple(ImageInfo().to_dict())
+# Internal fields are left out of the documents returned to clients.
+IMAGE_PROJECTION = {"_id": 0, "search": 0, "rand": 0}
+# Search pages keep _id for the next cursor, split_page drops it again.
+PAGE_PROJECTION = {"search": 0, "rand": 0}
+# Seeded random pages also keep their sort key for the cursor.
+SAMPLE_PROJECTION = {"search": 0, "rand": 0}
+
+
+def new_image_data(image_id, image_path, blob, form_data, image_analysis=None):
+    image_info = ImageInfo(form_data).to_dict()
+    return {
+        "image_id": image_id,
+        "image_path": image_path,
+        "blob": blob,
+        "info": image_info,
+        "analysis": image_analysis,
+        "search": search_index.search_document(image_info),
+        "rand": sampling.random_key(),
+        "version": versioning.INITIAL_VERSION,
+    }
+
+
+async def release_image_files(app, image_datas):
+    """Drop the file references of removed or replaced image documents."""
+    hashes = []
+    for image_data in image_datas:
+        if image_data.get("blob"):
+            hashes.append(image_data["blob"])
+        elif image_data.get("image_path"):
+            # Stored before content addressing, the file is not shared.
+            try:
+                await app.ctx.files.delete(
+                    layout.key_for(IMAGE_DIRECTORY, image_data["image_path"])
+                )
+            except OSError:
+                pass
+    if hashes:
+        await app.ctx.blobs.release_many(hashes)
+
+
+async def invalidate_writes(app, infos, image_ids=()):
+    """
+    Drop the cached searches whose results the written image infos change,
+    and the cached documents of written images, on every worker.
+    """
+    app.ctx.search_cache.invalidate(infos)
+    await app.ctx.image_cache.publish(image_ids, infos)
+
+
+async def count_facets(app, removed=(), added=()):
+    """Move the facet counters by the infos of removed and added images."""
+    await app.ctx.facets.apply(removed, added)
+
+
+def version_conflict(version):
+    return json(
+        {
+            "error": "Image was changed by another request",
+            "version": version,
+        },
+        status=409,
+        headers={"etag": versioning.etag(version)},
+    )
+
+
+async def replace_document(images, image_data, expected_version, change):
+    """
+    Replace the image document ``image_data`` as read, with ``change``
+    applied to it, only while it is still at the version read.
+
+    A concurrent write answers 409 when the client sent ``If-Match``
+    (``expected_version``). Plain PUTs instead read the document again and
+    apply ``change`` to the fresh copy, the last of them wins as before
+    versions existed. Returns the old and the new document, or None and the
+    response when the image is gone or not at ``expected_version``.
+    """
+    query = {"image_id": image_data["image_id"]}
+    while True:
+        version = versioning.current(image_data)
+        if expected_version is not None and expected_version != version:
+            return None, version_conflict(version)
+        old_image_data = copy.deepcopy(image_data)
+        change(image_data)
+        image_data["search"] = search_index.search_document(image_data["info"])
+        image_data["version"] = version + 1
+        result = await images.replace_one(
+            {**query, **versioning.expected(version)}, image_data
+        )
+        if result.matched_count:
+            return old_image_data, image_data
+        image_data = await images.find_one(query, {"_id": 0})
+        if not image_data:
+            return None, json({"error": "Image not found"}, status=404)
+
 
 @app.post("/images/upload")
 async def upload_image(request: Request):
@@ -146,30 +326,22 @@ async def upload_image(request: Request):
     if not uploaded_file.type.startswith("image/"):
         return json({"error": "Invalid file type. Only images allowed."}, status=400)
 
+    metrics.observe_upload(request, len(uploaded_file.body))
     image_id = uuid.uuid4().hex
     _, file_extension = os.path.splitext(uploaded_file.name)
-    filename = f"{image_id}{file_extension}".replace("-", "")
-
-    image_path = str(IMAGE_DIRECTORY.joinpath(filename)).replace("\\", "/")
-    with open(image_path, "wb") as f:
-        f.write(uploaded_file.body)
+    # Analyzed in the image pool while the file is written.
+    (blob, image_path), image_analysis = await asyncio.gather(
+        request.app.ctx.blobs.store_bytes(uploaded_file.body, file_extension),
+        analysis.analyze(request.app.ctx.image_pool, uploaded_file.body),
+    )
 
-    image_info = ImageInfo(request.form)
-    image_data = {
-        "image_id": image_id,
-        "image_path": image_path,
-        "info": {
-            "business_type": image_info.business_type,
-            "category": image_info.category,
-            "number": image_info.number,
-            "title": image_info.title,
-            "name": image_info.name,
-            "content": image_info.content,
-            "price": image_info.price,
-            "status": image_info.status,
-        },
-    }
-    collection.insert_one(image_data)
+    image_data = new_image_data(
+        image_id, image_path, blob, request.form, image_analysis
+    )
+    await request.app.ctx.images.insert_one(image_data)
+    await invalidate_writes(request.app, [image_data["info"]])
+    await count_facets(request.app, added=[image_data["info"]])
+    request.app.ctx.transcoder.enqueue(blob)
 
     return json(
         {
@@ -181,6 +353,234 @@ async def upload_image(request: Request):
     )
 
 
+@app.post("/images/upload/batch")
+async def upload_images_batch(request: Request):
+    """
+    Upload many images in one request.
+
+    Files are sent as repeated ``image`` fields. The optional ``metadata``
+    field is a JSON array with the info of each file in the same order;
+    info fields sent as plain form fields apply to every file. Files are
+    written concurrently and all documents are inserted with one bulk
+    write. Every file gets its own result, failed ones carry an ``error``.
+
+    openapi:
+    ---
+    operationId: uploadImagesBatch
+    tags:
+            - CRUD
+    responses:
+            200:
+                    description: Every image was uploaded.
+            207:
+                    description: Some images failed, see the per-item results.
+            400:
+                    description: No files, malformed metadata or no image uploaded.
+            413:
+                    description: More files than MAX_BATCH_UPLOAD.
+    """
+    files = request.files.getlist("image") or []
+    if not files:
+        return json({"error": "No file provided"}, status=400)
+    if len(files) > uploads.MAX_BATCH_UPLOAD:
+        return json(
+            {"error": f"At most {uploads.MAX_BATCH_UPLOAD} files per batch"},
+            status=413,
+        )
+
+    try:
+        metadata = uploads.batch_metadata(
+            request.form.get("metadata"), len(files), INFO_FIELDS
+        )
+    except ValueError as e:
+        return json({"error": str(e)}, status=400)
+    shared_info = {k: request.form.get(k) for k in INFO_FIELDS if k in request.form}
+
+    results = [{"index": i, "filename": f.name} for i, f in enumerate(files)]
+    pending = []
+    for result, uploaded_file in zip(results, files):
+        if not uploaded_file.type.startswith("image/"):
+            result["error"] = "Invalid file type. Only images allowed."
+        else:
+            pending.append(result["index"])
+            metrics.observe_upload(request, len(uploaded_file.body))
+
+    stored, analyses = await asyncio.gather(
+        asyncio.gather(
+            *(
+                request.app.ctx.blobs.store_bytes(
+                    files[i].body, os.path.splitext(files[i].name)[1]
+                )
+                for i in pending
+            ),
+            return_exceptions=True,
+        ),
+        asyncio.gather(
+            *(
+                analysis.analyze(request.app.ctx.image_pool, files[i].body)
+                for i in pending
+            )
+        ),
+    )
+
+    documents = []
+    for i, outcome, image_analysis in zip(pending, stored, analyses):
+        if isinstance(outcome, Exception):
+            results[i]["error"] = f"Failed to store image: {outcome}"
+            continue
+        blob, image_path = outcome
+        image_data = new_image_data(
+            uuid.uuid4().hex,
+            image_path,
+            blob,
+            {**shared_info, **metadata[i]},
+            image_analysis,
+        )
+        documents.append((i, image_data))
+
+    failed = {}
+    if documents:
+        try:
+            await request.app.ctx.images.insert_many([d for _, d in documents])
+        except BulkWriteError as e:
+            failed = {
+                error["index"]: error.get("errmsg", "Insert failed")
+                for error in e.details.get("writeErrors", [])
+            }
+
+    inserted_infos = []
+    for position, (i, image_data) in enumerate(documents):
+        if position in failed:
+            results[i]["error"] = f"Failed to save image: {failed[position]}"
+            continue
+        inserted_infos.append(image_data["info"])
+        request.app.ctx.transcoder.enqueue(image_data["blob"])
+        results[i].update(
+            image_id=image_data["image_id"],
+            image_path=image_data["image_path"],
+            full_image_path=f"http://{request.host}/{image_data['image_path']}",
+        )
+    if failed:
+        await release_image_files(
+            request.app, [documents[position][1] for position in failed]
+        )
+    if inserted_infos:
+        await invalidate_writes(request.app, inserted_infos)
+        await count_facets(request.app, added=inserted_infos)
+
+    uploaded = len(inserted_infos)
+    status = 200 if uploaded == len(files) else 207 if uploaded else 400
+    return json(
+        {
+            "message": f"Uploaded {uploaded} of {len(files)} images",
+            "uploaded": uploaded,
+            "failed": len(files) - uploaded,
+            "results": results,
+        },
+        status=status,
+    )
+
+
+async def fetch_with_count(app, query, count_mode, fetch):
+    """
+    Await ``fetch()`` together with the total count of ``query`` as asked
+    for by ``count_mode``, the count runs concurrently when needed.
+    """
+    if count_mode == "none":
+        return await fetch(), None
+
+    count_cache = app.ctx.count_cache
+    key = pagination.count_key(query)
+    total_count = count_cache.get(key) if count_mode == "cached" else None
+    if total_count is not None:
+        return await fetch(), total_count
+
+    documents, total_count = await asyncio.gather(fetch(), app.ctx.images.count(query))
+    count_cache.set(key, total_count)
+    return documents, total_count
+
+
+async def find_search_results(
+    app, query, count_mode, cursor, seed, is_random, skip, limit, paths=None
+):
+    """
+    One page of search results as returned by search_images, with only
+    the document ``paths`` when given.
+
+    Raises ValueError for a malformed cursor.
+    """
+    images = app.ctx.images
+    if paths:
+        # Pages and seeded samples still need their cursor fields.
+        image_projection = fields.projection(paths)
+        page_projection = fields.projection(paths, "_id")
+        sample_projection = fields.projection(paths, "_id", sampling.ORDER_FIELD)
+    else:
+        image_projection = IMAGE_PROJECTION
+        page_projection = PAGE_PROJECTION
+        sample_projection = SAMPLE_PROJECTION
+
+    if is_random:
+        position = sampling.decode_position(cursor) if seed and cursor else None
+
+        if seed:
+            (documents, next_cursor), total_count = await fetch_with_count(
+                app,
+                query,
+                count_mode,
+                lambda: sampling.seeded_page(
+                    images, query, seed, position, skip, limit, sample_projection
+                ),
+            )
+            for document in documents:
+                document.pop("_id")
+                document.pop(sampling.ORDER_FIELD)
+        else:
+            next_cursor = None
+            documents, total_count = await fetch_with_count(
+                app,
+                query,
+                count_mode,
+                lambda: sampling.sample(images, query, limit, image_projection),
+            )
+        return {
+            "results": documents,
+            "total_count": total_count,
+            "next_cursor": next_cursor,
+        }
+
+    last_id = None
+    if cursor:
+        last_id = pagination.decode_cursor(cursor)
+
+    # One extra document tells whether there is a next page.
+    page_query = pagination.after(query, last_id) if last_id else query
+
+    def fetch_page():
+        return images.find(
+            page_query,
+            page_projection,
+            skip=skip,
+            limit=limit + 1,
+            sort=pagination.SORT,
+        )
+
+    if count_mode == "single":
+        facet = await images.aggregate(
+            pagination.facet_pipeline(query, last_id, skip, limit + 1, page_projection)
+        )
+        documents = facet[0]["results"] if facet else []
+        total = facet[0]["total"] if facet else []
+        total_count = total[0]["count"] if total else 0
+    else:
+        documents, total_count = await fetch_with_count(
+            app, query, count_mode, fetch_page
+        )
+
+    results, next_cursor = pagination.split_page(documents, limit)
+    return {"results": results, "total_count": total_count, "next_cursor": next_cursor}
+
+
 @app.get("/images/search")
 async def search_images(request):
     """
@@ -226,6 +626,22 @@ async def search_images(request):
                     description: When is_random is set to `true`, return random matches. Default is `false`.
                     in: query
                     type: boolean string
+            - name: seed
+                    description: With is_random, return a repeatable random order that can be paged with `page_number` or `cursor`.
+                    in: query
+                    type: string
+            - name: cursor
+                    description: The `next_cursor` of the previous page, used instead of `page_number`.
+                    in: query
+                    type: string
+            - name: count
+                    description: How `total_count` is computed, `exact`, `single` (one aggregation round trip), `cached` or `none`. Default is `exact`.
+                    in: query
+                    type: string
+            - name: fields
+                    description: Comma separated fields to return per image, e.g. `image_id,image_path,title,price`. Default is all fields.
+                    in: query
+                    type: string
     responses:
             200:
                     description: Successfully retrieved search results.
@@ -283,51 +699,93 @@ async def search_images(request):
     is_search_bar = str2bool(request.args.get("is_search_bar", "false"))
     is_random = str2bool(request.args.get("is_random", "false"))
 
-    results, query = [], {}
-    if is_search_bar:
-        or_conditions = []
-        criteria = ["title", "name", "number"]
-
-        for criterion in criteria:
-            value = locals()[criterion]
-            if value:
-                or_conditions.append(
-                    {f"info.{criterion}": {"$regex": re.escape(value), "$options": "i"}}
-                )
-        query["$or"] = or_conditions
-
-    else:
-        criteria = ["title", "name", "number", "business_type", "category"]
-        for criterion in criteria:
-            value = locals()[criterion]
-            if value:
-                if criterion == "category" and value == "men-traditional-chinese":
-                    query[f"info.{criterion}"] = value
-                else:
-                    query[f"info.{criterion}"] = {
-                        "$regex": re.escape(value),
-                        "$options": "i",
-                    }
-
-    total_count = collection.count_documents(query)
-
-    skip = page_number * page_size
-    limit = page_size
-
-    if total_count == 0:
-        return json({"results": [], "total_count": 0})
-
-    if is_random:
-        cursor = collection.find(query, {"_id": 0}).limit(limit * 2)
-        results = [image_data for image_data in cursor]
-        if len(results) > limit:
-            results = random.sample(results, limit)
+    criteria = {
+        "title": title,
+        "name": name,
+        "number": number,
+        "business_type": business_type,
+        "category": category,
+    }
+    query = search_index.build_query(criteria, is_search_bar)
+
+    count_mode = request.args.get("count", "exact")
+    if count_mode not in pagination.COUNT_MODES:
+        return json(
+            {"error": f"count must be one of {', '.join(pagination.COUNT_MODES)}"},
+            status=400,
+        )
+    cursor = request.args.get("cursor")
+    seed = request.args.get("seed")
+    try:
+        paths = fields.parse_fields(request.args.get("fields"), INFO_FIELDS)
+    except ValueError as e:
+        return json({"error": str(e)}, status=400)
+
+    # Unseeded random results differ on every call and are never cached.
+    cache_key = None
+    search_cache = request.app.ctx.search_cache
+    if not is_random or seed:
+        cache_key = search_cache_module.request_key(
+            criteria,
+            is_search_bar,
+            is_random=is_random,
+            seed=seed,
+            cursor=cursor,
+            page_number=page_number,
+            page_size=page_size,
+            count=count_mode,
+            fields=paths,
+        )
+        cached = search_cache.get(cache_key)
+        if cached:
+            return HTTPResponse(cached.body, content_type="application/json")
+
+    generation = search_cache.generation
+    try:
+        results = await find_search_results(
+            request.app,
+            query,
+            count_mode,
+            cursor,
+            seed if is_random else None,
+            is_random,
+            0 if cursor else page_number * page_size,
+            page_size,
+            paths,
+        )
+    except ValueError as e:
+        return json({"error": str(e)}, status=400)
+
+    search_response = json(results)
+    if cache_key:
+        search_cache.store(
+            cache_key,
+            generation,
+            search_cache_module.CachedSearch(
+                criteria, is_search_bar, search_response.body
+            ),
+        )
+    return search_response
+
+
+@app.get("/images/facets")
+async def facet_counts(request: Request):
+    """
+    Number of images per category and per business type.
 
-    else:
-        cursor = collection.find(query, {"_id": 0}).skip(skip).limit(limit)
-        results = [image_data for image_data in cursor]
+    Read from counters that every write keeps up to date, so the cost
+    doesn't grow with the number of images.
 
-    return json({"results": results, "total_count": total_count})
+    openapi:
+    ---
+    operationId: facetCounts
+    tags:
+            - CRUD
+    responses:
+            200:
+                    description: Image counts by value under `category` and `business_type`, e.g. `{"category": {"dress": 12}, "business_type": {"rent": 40}}`.
+    """
+    return json(await request.app.ctx.facets.counts())
 
 
 @app.put("/images/<image_id>")
@@ -350,6 +808,10 @@ async def replace_image(request: Request, image_id: str):
 				in: path
 				type: string
 				required: true
+			- name: If-Match
+				description: The version the replacement applies to, as returned in `ETag` (optional). Without it the replacement applies to the latest version.
+				in: header
+				type: string
 		requestBody:
 			content:
 				image/*:
@@ -390,6 +852,8 @@ async def replace_image(request: Request, image_id: str):
 						error:
 							type: string
 							description: An error message indicating the image was not found.
+			409:
+				description: Only with `If-Match`, the image is no longer at that version, `version` is the current one.
 			500:
 				description: Failed to replace image.
 				schema:
@@ -432,53 +896,406 @@ async def replace_image(request: Request, image_id: str):
 								type: string
 								description: The status of the image (optional).
 		"""
-    old_image_path = ""
-    new_image_path = ""
-    # Check if image exist in DB
-    query = {"image_id": image_id}
-    if not collection.count_documents(query):
-        return response.json({"error": "Image not found"}, status=404)
+    try:
+        expected_version = versioning.parse_if_match(request.headers.get("if-match"))
+    except ValueError as e:
+        return json({"error": str(e)}, status=400)
 
-    # # Retrieve image info from DB
-    image_data = collection.find_one(query, {"_id": 0})
-    old_image_path = image_data["image_path"]
-    image_data["info"].update({k: v[0] for k, v in dict(request.form).items()})
+    images = request.app.ctx.images
+    image_data = await images.find_one({"image_id": image_id}, {"_id": 0})
+    if not image_data:
+        return response.json({"error": "Image not found"}, status=404)
+    version = versioning.current(image_data)
+    if expected_version is not None and expected_version != version:
+        return version_conflict(version)
 
+    form = {k: v[0] for k, v in dict(request.form).items()}
+    new_file = {}
     if request.files.get("image"):
         uploaded_file = request.files["image"][0]
         if not uploaded_file.type.startswith("image/"):
             return json(status=400)
 
         try:
-            # Save the new image file, overwriting the existing one
+            metrics.observe_upload(request, len(uploaded_file.body))
+            # Stored by content hash, so new bytes always get a new name and
+            # cached copies of the old URL stay valid.
             _, file_extension = os.path.splitext(uploaded_file.name)
-            new_image_path = str(
-                IMAGE_DIRECTORY.joinpath(f"{image_id}{file_extension}")
-            ).replace("\\", "/")
-
-            with open(new_image_path, "wb") as f:
-                f.write(uploaded_file.body)
-
-            image_data["image_path"] = new_image_path
+            (blob, new_image_path), image_analysis = await asyncio.gather(
+                request.app.ctx.blobs.store_bytes(uploaded_file.body, file_extension),
+                analysis.analyze(request.app.ctx.image_pool, uploaded_file.body),
+            )
+            new_file = {
+                "image_path": new_image_path,
+                "blob": blob,
+                "analysis": image_analysis,
+            }
 
         except OSError as e:
             return response.json(
                 {"error": f"Failed to replace image: {str(e)}"}, status=500
             )
 
-    collection.replace_one(query, image_data)
+    def change(image_data):
+        image_data["info"].update(form)
+        if new_file:
+            image_data.update(new_file)
+            # Made again for the new file.
+            image_data.pop("renditions", None)
+
+    old_image_data, image_data = await replace_document(
+        images, image_data, expected_version, change
+    )
+    if old_image_data is None:
+        if new_file:
+            await request.app.ctx.blobs.release(new_file["blob"])
+        return image_data
+    await invalidate_writes(
+        request.app, [old_image_data["info"], image_data["info"]], [image_id]
+    )
+    await count_facets(request.app, [old_image_data["info"]], [image_data["info"]])
+
+    if new_file:
+        request.app.ctx.transcoder.enqueue(new_file["blob"])
+        await release_image_files(request.app, [old_image_data])
 
-    image_path = new_image_path or old_image_path
     return response.json(
         {
             "message": "Image replaced successfully",
             "image_id": image_id,
+            "image_path": str(image_data["image_path"]),
+            "version": image_data["version"],
+        },
+        headers={"etag": versioning.etag(image_data["version"])},
+    )
+
+
+@app.patch("/images/<image_id>")
+async def update_image(request: Request, image_id: str):
+    """
+    Update some info fields of an image, and optionally its file.
+
+    Only the fields sent are changed, in a single atomic update, so
+    concurrent edits of other fields are kept. Send the `ETag` of the image
+    details or of the previous update as `If-Match` to only apply the
+    update to that version; a newer version answers 409.
+
+    openapi:
+    ---
+    operationId: updateImage
+    tags:
+            - CRUD
+    parameters:
+            - name: image_id
+                    description: The id of the image to be updated.
+                    in: path
+                    type: string
+                    required: true
+            - name: If-Match
+                    description: The version the update applies to, as returned in `ETag` (optional).
+                    in: header
+                    type: string
+    requestBody:
+            content:
+                    application/json:
+                            schema:
+                                    type: object
+                                    description: Info fields to change, e.g. `{"title": "..."}`.
+                    multipart/form-data:
+                            schema:
+                                    type: object
+                                    description: Info fields to change and an optional `image`.
+    responses:
+            200:
+                    description: Image updated, `version` is also returned as `ETag`.
+            400:
+                    description: Unknown field, invalid file type or nothing to update.
+            404:
+                    description: Image not found.
+            409:
+                    description: The image is no longer at the `If-Match` version, `version` is the current one.
+    """
+    try:
+        expected_version = versioning.parse_if_match(request.headers.get("if-match"))
+    except ValueError as e:
+        return json({"error": str(e)}, status=400)
+
+    if request.form or request.files:
+        changes = {k: v[0] for k, v in request.form.items()}
+    else:
+        changes = request.json or {}
+    if not isinstance(changes, dict):
+        return json({"error": "Expected an object of info fields"}, status=400)
+    unknown = sorted(set(changes) - set(INFO_FIELDS))
+    if unknown:
+        return json({"error": f"Unknown fields: {', '.join(unknown)}"}, status=400)
+    if not all(isinstance(value, str) for value in changes.values()):
+        return json({"error": "Info fields must be strings"}, status=400)
+
+    uploaded_file = request.files.get("image")
+    if not changes and not uploaded_file:
+        return json({"error": "Nothing to update"}, status=400)
+
+    update = versioning.info_update(changes)
+    if uploaded_file:
+        if not uploaded_file.type.startswith("image/"):
+            return json(
+                {"error": "Invalid file type. Only images allowed."}, status=400
+            )
+        metrics.observe_upload(request, len(uploaded_file.body))
+        _, file_extension = os.path.splitext(uploaded_file.name)
+        (blob, image_path), image_analysis = await asyncio.gather(
+            request.app.ctx.blobs.store_bytes(uploaded_file.body, file_extension),
+            analysis.analyze(request.app.ctx.image_pool, uploaded_file.body),
+        )
+        update.update(image_path=image_path, blob=blob, analysis=image_analysis)
+
+    images = request.app.ctx.images
+    query = {"image_id": image_id}
+    operations = {"$set": update, "$inc": {"version": 1}}
+    if uploaded_file:
+        # Made again for the new file.
+        operations["$unset"] = {"renditions": ""}
+    old_image_data = await images.find_one_and_update(
+        {**query, **versioning.expected(expected_version)},
+        operations,
+        {"_id": 0, "info": 1, "image_path": 1, "blob": 1, "version": 1},
+    )
+    if old_image_data is None:
+        if uploaded_file:
+            await request.app.ctx.blobs.release(update["blob"])
+        # Only failed updates pay for telling a conflict from a missing image.
+        current = await images.find_one(query, {"_id": 0, "version": 1})
+        if current is None:
+            return json({"error": "Image not found"}, status=404)
+        return version_conflict(versioning.current(current))
+
+    old_info = old_image_data.get("info", {})
+    await invalidate_writes(
+        request.app, [old_info, {**old_info, **changes}], [image_id]
+    )
+    await count_facets(request.app, [old_info], [{**old_info, **changes}])
+    if uploaded_file:
+        request.app.ctx.transcoder.enqueue(update["blob"])
+        # The superseded file is released after the response.
+        request.app.add_task(release_image_files(request.app, [old_image_data]))
+
+    version = versioning.current(old_image_data) + 1
+    return json(
+        {
+            "message": "Image updated successfully",
+            "image_id": image_id,
+            "image_path": update.get("image_path", old_image_data["image_path"]),
+            "version": version,
+        },
+        headers={"etag": versioning.etag(version)},
+    )
+
+
+@app.post("/images/upload/stream", stream=True)
+async def upload_image_stream(request: Request):
+    """
+    Upload an image by streaming the raw request body to disk.
+
+    Unlike `/images/upload`, the body is the image itself and is never held
+    in memory as a whole. Image info is passed as query arguments.
+
+    openapi:
+    ---
+    operationId: uploadImageStream
+    tags:
+            - CRUD
+    parameters:
+            - name: filename
+                    description: Original file name, used for its extension (optional, `X-Filename` header works too).
+                    in: query
+                    type: string
+            - name: business_type
+                    description: Rent or sell, other ImageInfo fields are accepted the same way.
+                    in: query
+                    type: string
+    requestBody:
+            content:
+                    image/*:
+                            schema:
+                                    type: string
+                                    format: binary
+            required: true
+    responses:
+            200:
+                    description: Upload successful.
+            400:
+                    description: No file provided or invalid file type.
+            413:
+                    description: The image is larger than MAX_UPLOAD_SIZE.
+    """
+    if not request.headers.get("content-type", "").startswith("image/"):
+        return json({"error": "Invalid file type. Only images allowed."}, status=400)
+
+    try:
+        received = await uploads.receive_to_temp(
+            request, UPLOAD_TEMP_DIRECTORY, request.app.ctx.storage
+        )
+    except uploads.UploadTooLarge:
+        return json({"error": "File too large"}, status=413)
+    if not received.size:
+        await uploads.discard(request.app.ctx.storage, received)
+        return json({"error": "No file provided"}, status=400)
+    metrics.observe_upload(request, received.size)
+
+    image_id = uuid.uuid4().hex
+    # Analyzed before storing takes over the temp file.
+    image_analysis = await analysis.analyze(
+        request.app.ctx.image_pool, str(received.temp_path)
+    )
+    image_path = await request.app.ctx.blobs.store_file(
+        received.temp_path,
+        received.sha256,
+        received.size,
+        uploads.upload_extension(request),
+    )
+
+    image_data = new_image_data(
+        image_id, image_path, received.sha256, request.args, image_analysis
+    )
+    await request.app.ctx.images.insert_one(image_data)
+    await invalidate_writes(request.app, [image_data["info"]])
+    await count_facets(request.app, added=[image_data["info"]])
+    request.app.ctx.transcoder.enqueue(received.sha256)
+
+    return json(
+        {
+            "message": "Upload successful",
+            "image_id": image_id,
             "image_path": image_path,
+            "full_image_path": f"http://{request.host}/{image_path}",
+            "size": received.size,
+            "sha256": received.sha256,
         }
     )
 
 
+@app.put("/images/<image_id>/stream", stream=True)
+async def replace_image_stream(request: Request, image_id: str):
+    """
+    Replace an image by streaming the raw request body to disk.
+
+    The new file only becomes visible once it is complete. Image info
+    fields passed as query arguments are updated as well.
+
+    openapi:
+    ---
+    operationId: replaceImageStream
+    tags:
+            - CRUD
+    parameters:
+            - name: image_id
+                    description: The id of the image to be replaced.
+                    in: path
+                    type: string
+                    required: true
+            - name: If-Match
+                    description: The version the replacement applies to, as returned in `ETag` (optional). Without it the replacement applies to the latest version.
+                    in: header
+                    type: string
+    responses:
+            200:
+                    description: Image replaced successfully.
+            400:
+                    description: Invalid file type.
+            404:
+                    description: Image not found.
+            409:
+                    description: Only with `If-Match`, the image is no longer at that version, `version` is the current one.
+            413:
+                    description: The image is larger than MAX_UPLOAD_SIZE.
+    """
+    if not request.headers.get("content-type", "").startswith("image/"):
+        return json({"error": "Invalid file type. Only images allowed."}, status=400)
+
+    try:
+        expected_version = versioning.parse_if_match(request.headers.get("if-match"))
+    except ValueError as e:
+        return json({"error": str(e)}, status=400)
+
+    images = request.app.ctx.images
+    image_data = await images.find_one({"image_id": image_id}, {"_id": 0})
+    if not image_data:
+        return json({"error": "Image not found"}, status=404)
+    version = versioning.current(image_data)
+    if expected_version is not None and expected_version != version:
+        return version_conflict(version)
+
+    try:
+        received = await uploads.receive_to_temp(
+            request, UPLOAD_TEMP_DIRECTORY, request.app.ctx.storage
+        )
+    except uploads.UploadTooLarge:
+        return json({"error": "File too large"}, status=413)
+    if not received.size:
+        await uploads.discard(request.app.ctx.storage, received)
+        return json({"error": "No file provided"}, status=400)
+    metrics.observe_upload(request, received.size)
+
+    image_analysis = await analysis.analyze(
+        request.app.ctx.image_pool, str(received.temp_path)
+    )
+    new_image_path = await request.app.ctx.blobs.store_file(
+        received.temp_path,
+        received.sha256,
+        received.size,
+        uploads.upload_extension(request),
+    )
+    args = {k: v[0] for k, v in request.args.items() if k in INFO_FIELDS}
+
+    def change(image_data):
+        image_data["image_path"] = new_image_path
+        image_data["blob"] = received.sha256
+        image_data["analysis"] = image_analysis
+        image_data.pop("renditions", None)
+        image_data["info"].update(args)
+
+    old_image_data, image_data = await replace_document(
+        images, image_data, expected_version, change
+    )
+    if old_image_data is None:
+        await request.app.ctx.blobs.release(received.sha256)
+        return image_data
+    await invalidate_writes(
+        request.app, [old_image_data["info"], image_data["info"]], [image_id]
+    )
+    await count_facets(request.app, [old_image_data["info"]], [image_data["info"]])
+
+    request.app.ctx.transcoder.enqueue(received.sha256)
+    await release_image_files(request.app, [old_image_data])
+
+    return json(
+        {
+            "message": "Image replaced successfully",
+            "image_id": image_id,
+            "image_path": new_image_path,
+            "size": received.size,
+            "sha256": received.sha256,
+            "version": image_data["version"],
+        },
+        headers={"etag": versioning.etag(image_data["version"])},
+    )
+
+
+async def render_variant(app, key, name, transform):
+    async def produce(target_path):
+        async with app.ctx.files.local_file(key) as source_path:
+            return await pools.run_in_pool(
+                app, imaging.render, str(source_path), target_path, tuple(transform)
+            )
+
+    return await app.ctx.derivatives.get(name, produce)
+
+
 @app.get("/images/<image_name>")
+# Sharded paths have slashes, a str segment alone would clash with the
+# PUT/DELETE /images/<image_id> routes.
+@app.get("/images/<image_name:path>", name="get_sharded_image")
 async def get_image(request: Request, image_name: str):
     """
     Get an image by its name.
@@ -492,7 +1309,7 @@ async def get_image(request: Request, image_name: str):
             - CRUD
     parameters:
             - name: image_name
-                    description: The name of the image to be retrieved.
+                    description: The name of the image, or its path below images/ as returned by the upload.
                     in: path
                     type: string
                     required: true
@@ -501,14 +1318,50 @@ async def get_image(request: Request, image_name: str):
                     in: path
                     type: string
                     required: false
+            - name: fields
+                    description: With details, comma separated fields to return, e.g. `image_id,title,price`. Default is all fields.
+                    in: query
+                    type: string
+            - name: width
+                    description: Resize to this width in pixels (optional).
+                    in: query
+                    type: integer
+            - name: height
+                    description: Resize to this height in pixels (optional).
+                    in: query
+                    type: integer
+            - name: fit
+                    description: How to fit both width and height, `contain`, `cover` or `fill`. Default is `contain`.
+                    in: query
+                    type: string
+            - name: quality
+                    description: Encoder quality from 1 to 100. Default is `80`.
+                    in: query
+                    type: integer
+            - name: format
+                    description: Output format, `jpeg`, `png`, `webp` or `avif`. Default is the source format.
+                    in: query
+                    type: string
     responses:
             200:
-                    description: Image found and returned successfully.
+                    description: Image found and returned successfully, as the smallest WebP or AVIF rendition `Accept` lists when there is one.
                     content:
                             image/*:
                                     schema:
                                             type: string
                                             format: binary
+            206:
+                    description: The requested byte range of the image.
+            304:
+                    description: Not modified, the cached copy named by If-None-Match or If-Modified-Since is current.
+            400:
+                    description: Invalid transform parameters.
+                    schema:
+                            type: object
+                            properties:
+                                    error:
+                                            type: string
+                                            description: An error message describing the invalid parameter.
             404:
                     description: Image not found.
                     schema:
@@ -517,22 +1370,97 @@ async def get_image(request: Request, image_name: str):
                                     error:
                                             type: string
                                             description: An error message indicating the image was not found.
+            416:
+                    description: The requested byte range is outside the image.
     """
-    image_path = IMAGE_DIRECTORY.joinpath(image_name).absolute()
+    files = request.app.ctx.files
 
     try:
         if not request.args.get("details"):
-            if not image_path.exists():
-                return json({"error": "Image not found"}, status=404)
+            hot_files = request.app.ctx.hot_files
+            keys = layout.candidate_keys(image_name)
+            # Popular files are found without touching storage.
+            for key in keys:
+                hot = hot_files.peek(files, key)
+                if hot:
+                    stat = hot.stat
+                    break
+            else:
+                # Sharded key first, then the flat key of files not migrated yet.
+                for key in keys:
+                    try:
+                        stat = await files.stat(key)
+                        break
+                    except FileNotFoundError:
+                        continue
+                else:
+                    return json({"error": "Image not found"}, status=404)
         else:
-            query = {"image_id": image_name}
-            if not collection.count_documents(query):
+            # Existence and document in one, usually cached, lookup.
+            image_data = await request.app.ctx.image_cache.find(image_name)
+            if image_data is None:
                 return json({"error": "Image not found"}, status=404)
+            try:
+                paths = fields.parse_fields(request.args.get("fields"), INFO_FIELDS)
+            except ValueError as e:
+                return json({"error": str(e)}, status=400)
+            version = versioning.current(image_data)
+            if paths:
+                image_data = fields.select(image_data, paths)
+            return json(
+                image_data,
+                status=200,
+                headers={"etag": versioning.etag(version)},
+            )
 
-            image_data = collection.find_one(query, {"_id": 0})
-            return json(image_data, status=200)
+        try:
+            transform = imaging.parse_transform(request.args, key)
+        except ValueError as e:
+            return json({"error": str(e)}, status=400)
+
+        if transform:
+            variants = request.app.ctx.derivatives.files
+            name = derivatives.variant_name(Path(key).name, stat, transform)
+            if not hot_files.peek(variants, name):
+                try:
+                    await render_variant(request.app, key, name, transform)
+                except imaging.DecodeError:
+                    return json({"error": "Image can not be transformed"}, status=400)
+            return await serving.serve_file(
+                request, variants, name, hot_files=hot_files
+            )
 
-        return await file(str(image_path))
+        # The smallest rendition the client can decode, if there is one.
+        rendition = await request.app.ctx.transcoder.choose(
+            key, stat.st_size, request.headers.get("accept")
+        )
+        presigned_url = backends.STORAGE_REDIRECT and files.presigned_url(
+            rendition or key
+        )
+        if presigned_url:
+            # The object store sends the bytes, this worker only signs.
+            return redirect(
+                presigned_url,
+                headers={
+                    "cache-control": f"private, max-age={backends.REDIRECT_MAX_AGE}",
+                    **transcoding.VARY_HEADERS,
+                },
+            )
+        if rendition:
+            try:
+                return await serving.serve_file(
+                    request,
+                    files,
+                    rendition,
+                    hot_files=hot_files,
+                    extra_headers=transcoding.VARY_HEADERS,
+                )
+            except FileNotFoundError:
+                # Removed with its blob meanwhile, the original may be left.
+                pass
+        return await serving.serve_file(
+            request, files, key, stat, hot_files, transcoding.VARY_HEADERS
+        )
     except FileNotFoundError:
         return json({"error": "Image not found"}, status=404)
 
@@ -582,17 +1510,25 @@ async def delete_image(request: Request, image_id: str):
                                             description: An error message indicating the deletion failure.
     """
 
+    images = request.app.ctx.images
     query = {"image_id": image_id}
-    if not collection.count_documents(query):
+    # Looked up and deleted in one round trip, never from a cached copy.
+    image_data = await images.find_one_and_delete(query, {"_id": 0})
+    if not image_data:
         return response.json({"error": "Image not found"}, status=404)
 
-    image_data = collection.find_one(query, {"_id": 0})
     image_path = str(image_data["image_path"])
-    collection.delete_one(query)
+    await invalidate_writes(request.app, [image_data.get("info")], [image_id])
+    await count_facets(request.app, removed=[image_data.get("info")])
 
-    if os.path.exists(image_path):
+    if image_data.get("blob"):
+        # Shared by content, the file goes with its last reference.
+        await request.app.ctx.blobs.release(image_data["blob"])
+    else:
         try:
-            os.remove(image_path)
+            await request.app.ctx.files.delete(
+                layout.key_for(IMAGE_DIRECTORY, image_path)
+            )
         except OSError as e:
             return response.json(
                 {"error": f"Failed to delete image: {str(e)}"}, status=500
@@ -603,36 +1539,128 @@ async def delete_image(request: Request, image_id: str):
 
 @app.delete("/images")
 async def delete_multiple_images(request: Request):
+    """
+    Delete several images by id.
+
+    By default the images are only marked deleted in a single update and
+    disappear from every query at once, their documents and files are
+    removed by the background collector. `mode=hard` removes everything
+    before responding.
+
+    openapi:
+    ---
+    operationId: deleteImages
+    tags:
+            - CRUD
+    parameters:
+            - name: mode
+                    description: `soft` (default) or `hard`.
+                    in: query
+                    type: string
+    requestBody:
+            content:
+                    application/json:
+                            schema:
+                                    type: object
+                                    properties:
+                                            image_ids:
+                                                    type: array
+                                                    items:
+                                                            type: string
+    responses:
+            200:
+                    description: Images deleted, `delete_count` of them.
+            400:
+                    description: Unknown mode.
+            404:
+                    description: None of the images exist.
+    """
     image_ids = request.json.get("image_ids", [])
     image_ids = list(set(image_ids))
-    delete_image_paths = []
+    mode = request.args.get("mode", "soft")
+    if mode not in ("soft", "hard"):
+        return response.json({"error": "mode must be soft or hard"}, status=400)
 
     if not image_ids:
         return response.json({"error": "Images not found"}, status=404)
 
+    images = request.app.ctx.images
     query = {"image_id": {"$in": image_ids}}
-    for image_data in collection.find(query, {"_id": 0, "image_path": 1}):
-        delete_image_paths.append(str(image_data.get("image_path", "")))
+    deleted_image_datas = await images.find(
+        query, {"_id": 0, "image_path": 1, "blob": 1, "info": 1}
+    )
 
-    deleted_images = collection.delete_many(query)
-    if deleted_images.deleted_count == 0:
+    if mode == "soft":
+        deleted_count = (await images.mark_deleted(query)).modified_count
+    else:
+        deleted_count = (await images.delete_many(query)).deleted_count
+    if deleted_count == 0:
         return response.json({"error": "Images not found"}, status=404)
+    deleted_infos = [image_data.get("info") for image_data in deleted_image_datas]
+    await invalidate_writes(request.app, deleted_infos, image_ids)
+    await count_facets(request.app, removed=deleted_infos)
 
-    for path in delete_image_paths:
-        try:
-            if os.path.exists(path):
-                os.remove(path)
-        except OSError as e:
-            pass
+    if mode == "hard":
+        await release_image_files(request.app, deleted_image_datas)
 
     return response.json(
         {
             "message": "Image deleted successfully",
-            "delete_count": deleted_images.deleted_count,
+            "delete_count": deleted_count,
+        }
+    )
+
+
+@app.get("/stats")
+async def cache_stats(request: Request):
+    """
+    Counters of this worker's in-process caches, and the progress and
+    backlog of the collector removing deleted images.
+
+    openapi:
+    ---
+    operationId: cacheStats
+    tags:
+            - healthCheck
+    responses:
+            200:
+                    description: Entries, bytes, hits, misses and evictions per cache, collector progress under `gc`.
+    """
+    derivatives = request.app.ctx.derivatives
+    return json(
+        {
+            "search_cache": request.app.ctx.search_cache.stats(),
+            "count_cache": request.app.ctx.count_cache.stats(),
+            "image_cache": request.app.ctx.image_cache.stats(),
+            "hot_files": request.app.ctx.hot_files.stats(),
+            "storage": request.app.ctx.storage.stats(),
+            "derivatives": {
+                "entries": len(derivatives.entries),
+                "bytes": derivatives.total_bytes,
+            },
+            "gc": await request.app.ctx.collector.stats(),
+            "transcoding": await request.app.ctx.transcoder.stats(),
         }
     )
 
 
+@app.get("/metrics")
+async def prometheus_metrics(request: Request):
+    """
+    Prometheus metrics in the text exposition format.
+
+    openapi:
+    ---
+    operationId: metrics
+    tags:
+            - healthCheck
+    responses:
+            200:
+                    description: Request, MongoDB and storage metrics.
+    """
+    return raw(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 @app.get("/")
 async def health_check(request):
     """This is a simple health check API
@@ -654,4 +1682,13 @@ async def health_check(request):
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=9527)
+    # Every worker is its own process with its own MongoDB client, pools and
+    # caches, all opened in before_server_start listeners. WORKERS=0 starts
+    # one worker per CPU core.
+    workers = int(os.getenv("WORKERS", "1"))
+    app.run(
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "9527")),
+        workers=workers or 1,
+        fast=workers == 0,
+    )
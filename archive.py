@@ -0,0 +1,380 @@
+"""
+Export and import of the whole catalog, image documents and files together.
+
+``python archive.py export backup.tar`` writes a single tar stream: a
+``manifest.json``, then for every batch of images their files as
+``files/<key>`` followed by the documents as ``images/<batch>.ndjson``
+(MongoDB extended JSON, one image per line). Files always come before the
+first documents referencing them and content addressed files are written
+once, so the archive can go through a pipe and neither side holds more
+than a batch in memory:
+
+    python archive.py export - | ssh other python archive.py import -
+
+Import stores the files of a batch concurrently and inserts its documents
+with one bulk insert. Images whose ``image_id`` is already present are
+skipped, so an interrupted import is simply run again. Only live images
+are exported, the target makes its own renditions.
+"""
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import os
+import sys
+import tarfile
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from bson import json_util
+from pymongo.errors import BulkWriteError
+
+import backends
+import blobs
+import db
+import facets
+import layout
+import storage
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FORMAT = 1
+ARCHIVE_BATCH_SIZE = 500
+MANIFEST_NAME = "manifest.json"
+FILES_PREFIX = "files/"
+IMAGES_PREFIX = "images/"
+COPY_CHUNK_SIZE = 1024 * 1024
+# Copies of stored state the target rebuilds itself.
+EXPORT_EXCLUDED_FIELDS = ("renditions", "transcoding_at", "transcode_error")
+DUPLICATE_KEY_ERROR = 11000
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def dump_documents(documents):
+    return "".join(
+        json_util.dumps(document, json_options=json_util.RELAXED_JSON_OPTIONS) + "\n"
+        for document in documents
+    ).encode()
+
+
+def load_documents(data):
+    return [json_util.loads(line) for line in data.decode().splitlines() if line]
+
+
+async def export_members(database, files, directory, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Yield the archive members in order as (name, source), the source being
+    the bytes of the member or the path of a local file. A downloaded file
+    is only kept until the next member is asked for.
+    """
+    yield MANIFEST_NAME, json.dumps(
+        {"format": ARCHIVE_FORMAT, "directory": layout.as_image_path(directory)}
+    ).encode()
+
+    images = database["images"]
+    # Hashes of the blobs written so far, the only state growing with the
+    # catalog.
+    exported_blobs = set()
+    last_id = None
+    batch_number = 0
+    while True:
+        query = db.live({} if last_id is None else {"_id": {"$gt": last_id}})
+        batch = await images.find(
+            query, {field: 0 for field in EXPORT_EXCLUDED_FIELDS}
+        ).sort("_id", 1).limit(batch_size).to_list(length=None)
+        if not batch:
+            return
+        last_id = batch[-1]["_id"]
+        batch_number += 1
+
+        for image_data in batch:
+            sha256 = image_data.get("blob")
+            if sha256 is not None:
+                if sha256 in exported_blobs:
+                    continue
+                exported_blobs.add(sha256)
+            key = layout.key_for(directory, image_data["image_path"])
+            try:
+                async with files.local_file(key) as path:
+                    yield FILES_PREFIX + key, path
+            except FileNotFoundError:
+                # The import reports the image as missing its file.
+                logger.warning(f"File of {image_data['image_id']} not found: {key}")
+
+        yield f"{IMAGES_PREFIX}{batch_number:08d}.ndjson", dump_documents(batch)
+
+
+def _add_member(tar, name, source):
+    if isinstance(source, bytes):
+        member = tarfile.TarInfo(name)
+        member.size = len(source)
+        member.mtime = time.time()
+        tar.addfile(member, io.BytesIO(source))
+    else:
+        tar.add(source, arcname=name, recursive=False)
+
+
+async def export_archive(
+    database, files, directory, out, storage_io, batch_size=ARCHIVE_BATCH_SIZE
+):
+    """Write the catalog as a tar stream to the binary file ``out``."""
+    members = 0
+    # Stream mode, the output is never seeked.
+    tar = await storage_io.run("archive", tarfile.open, None, "w|", out)
+    try:
+        async for name, source in export_members(
+            database, files, directory, batch_size
+        ):
+            await storage_io.run("archive", _add_member, tar, name, source)
+            members += 1
+    finally:
+        await storage_io.run("archive", tar.close)
+    return members
+
+
+def _next_member(tar):
+    member = tar.next()
+    while member is not None and not member.isfile():
+        member = tar.next()
+    return member
+
+
+def _read_member(tar, member):
+    return tar.extractfile(member).read()
+
+
+def _stage_member(tar, member, temp_directory):
+    """Copy a file member to a temp file, returns (temp_path, sha256, size)."""
+    source = tar.extractfile(member)
+    digest = hashlib.sha256()
+    fd, temp_path = tempfile.mkstemp(dir=temp_directory, suffix=".upload")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while chunk := source.read(COPY_CHUNK_SIZE):
+                digest.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return temp_path, digest.hexdigest(), member.size
+
+
+class Importer:
+    """
+    Reads an archive into ``database`` and the ``files`` backend below
+    ``directory``, staging files in the blob store's temp directory.
+    """
+
+    def __init__(self, database, blob_store, files, directory, storage_io):
+        self.images = database["images"]
+        self.facets = facets.FacetCounts(db.ImageRepository(database))
+        self.blobs = blob_store
+        self.files = files
+        self.directory = directory
+        self.storage = storage_io
+        self.source_directory = None
+        # key -> (temp_path, sha256, size) of the files since the last batch.
+        self.staged = {}
+        self.counts = Counter()
+
+    async def run(self, source):
+        """Import the tar stream read from the binary file ``source``."""
+        tar = await self.storage.run("archive", tarfile.open, None, "r|", source)
+        try:
+            while member := await self.storage.run("archive", _next_member, tar):
+                await self.read_member(tar, member)
+        finally:
+            await self.discard_staged()
+            await self.storage.run("archive", tar.close)
+        return dict(self.counts)
+
+    async def read_member(self, tar, member):
+        if member.name == MANIFEST_NAME:
+            manifest = json.loads(
+                await self.storage.run("archive", _read_member, tar, member)
+            )
+            if manifest.get("format") != ARCHIVE_FORMAT:
+                raise ArchiveError(f"Unknown archive format {manifest.get('format')}")
+            self.source_directory = manifest["directory"]
+        elif self.source_directory is None:
+            raise ArchiveError(f"{MANIFEST_NAME} must come first")
+        elif member.name.startswith(FILES_PREFIX):
+            key = member.name[len(FILES_PREFIX) :]
+            if not layout.candidate_keys(key):
+                raise ArchiveError(f"Invalid file name {member.name}")
+            self.staged[key] = await self.storage.run(
+                "archive", _stage_member, tar, member, self.blobs.temp_directory
+            )
+        elif member.name.startswith(IMAGES_PREFIX):
+            documents = load_documents(
+                await self.storage.run("archive", _read_member, tar, member)
+            )
+            await self.import_batch(documents)
+            await self.discard_staged()
+
+    async def import_batch(self, documents):
+        present = {
+            image_data["image_id"]
+            async for image_data in self.images.find(
+                {"image_id": {"$in": [d["image_id"] for d in documents]}},
+                {"image_id": 1},
+            )
+        }
+        new = [d for d in documents if d["image_id"] not in present]
+        self.counts["skipped"] += len(documents) - len(new)
+
+        refs = Counter(d["blob"] for d in new if d.get("blob"))
+        keys = {d["blob"]: self.key_of(d) for d in new if d.get("blob")}
+        legacy = [d for d in new if not d.get("blob")]
+        # The files of the batch are written concurrently.
+        blob_paths, legacy_paths = await asyncio.gather(
+            asyncio.gather(
+                *(
+                    self.store_blob(sha256, keys[sha256], count)
+                    for sha256, count in refs.items()
+                )
+            ),
+            asyncio.gather(*(self.store_legacy(d) for d in legacy)),
+        )
+        paths = dict(zip(refs, blob_paths))
+        paths.update(zip((d["image_id"] for d in legacy), legacy_paths))
+
+        stored = []
+        for image_data in new:
+            path = paths[image_data.get("blob") or image_data["image_id"]]
+            if path is None:
+                logger.warning(f"No file for {image_data['image_id']}, not imported")
+                self.counts["missing_file"] += 1
+                continue
+            image_data["image_path"] = path
+            stored.append(image_data)
+        await self.insert(stored)
+
+    def key_of(self, image_data):
+        return layout.key_for(self.source_directory, image_data["image_path"])
+
+    def take_staged(self, key):
+        return self.staged.pop(key, None)
+
+    async def store_blob(self, sha256, key, refs):
+        """Store or reference a blob for ``refs`` images, returns its path."""
+        staged = self.take_staged(key)
+        if staged is None:
+            # Written with an earlier batch, or by an earlier run.
+            return await self.blobs.reference(sha256, refs)
+        temp_path, actual, size = staged
+        if actual != sha256:
+            await self.storage.remove(temp_path)
+            logger.warning(f"{key} doesn't match its hash, not imported")
+            return None
+        return await self.blobs.store_file(
+            temp_path, sha256, size, os.path.splitext(key)[1], refs
+        )
+
+    async def store_legacy(self, image_data):
+        """Store a file that isn't content addressed, at the same key."""
+        key = self.key_of(image_data)
+        staged = self.take_staged(key)
+        if staged is None:
+            return None
+        await self.files.put_file(staged[0], key)
+        return layout.as_image_path(Path(self.directory).joinpath(key))
+
+    async def insert(self, documents):
+        if not documents:
+            return
+        inserted = documents
+        try:
+            await self.images.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details["writeErrors"]
+            if any(error["code"] != DUPLICATE_KEY_ERROR for error in errors):
+                raise
+            # Inserted by a concurrent import meanwhile, their references
+            # are given back.
+            failed = {error["index"] for error in errors}
+            inserted = [d for i, d in enumerate(documents) if i not in failed]
+            duplicates = [documents[i] for i in failed]
+            await self.blobs.release_many(
+                d["blob"] for d in duplicates if d.get("blob")
+            )
+            self.counts["skipped"] += len(duplicates)
+        await self.facets.apply(added=[d.get("info") for d in inserted])
+        self.counts["imported"] += len(inserted)
+
+    async def discard_staged(self):
+        """Remove files no new image of the batch referenced."""
+        for temp_path, _, _ in self.staged.values():
+            await self.storage.remove(temp_path)
+        self.staged.clear()
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Export the catalog with its files to a tar stream, or import one."
+    )
+    parser.add_argument("command", choices=("export", "import"))
+    parser.add_argument("archive", help="Path of the tar file, - for stdout/stdin")
+    parser.add_argument("--directory", default="images")
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=ARCHIVE_BATCH_SIZE,
+        help="Images per batch of an export, imports follow the archive",
+    )
+    options = parser.parse_args()
+
+    client = db.create_client()
+    try:
+        with ThreadPoolExecutor(storage.STORAGE_IO_THREADS) as threads:
+            storage_io = storage.FileIO(threads)
+            files = backends.create_backend(storage_io, options.directory)
+            database = client[db.db_name]
+            if options.command == "export":
+                with _open(options.archive, "wb", sys.stdout) as out:
+                    members = await export_archive(
+                        database,
+                        files,
+                        options.directory,
+                        out,
+                        storage_io,
+                        options.batch_size,
+                    )
+                print(f"{members} archive members written", file=sys.stderr)
+            else:
+                temp_directory = Path(options.directory).joinpath(".tmp")
+                await storage_io.mkdir(temp_directory)
+                blob_store = blobs.BlobStore(
+                    database, options.directory, temp_directory, storage_io, files
+                )
+                importer = Importer(
+                    database, blob_store, files, options.directory, storage_io
+                )
+                with _open(options.archive, "rb", sys.stdin) as source:
+                    counts = await importer.run(source)
+                print(
+                    ", ".join(f"{count} {what}" for what, count in counts.items())
+                    or "Nothing imported",
+                    file=sys.stderr,
+                )
+    finally:
+        client.close()
+
+
+def _open(path, mode, standard):
+    if path == "-":
+        # Not closed with the archive.
+        return open(standard.fileno(), mode, closefd=False)
+    return open(path, mode)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
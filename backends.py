@@ -0,0 +1,281 @@
+"""
+Where image files live.
+
+Routes address files by key, their path below the image directory such as
+``ab/cd/<sha256>.jpg``, and never touch the filesystem directly. Three
+backends are available, chosen with ``STORAGE_BACKEND``:
+
+- ``local``  - files below ``images/`` (default)
+- ``memory`` - a dict in the worker, for tests and benchmarks
+- ``s3``     - an S3 compatible object store (AWS, MinIO, ...), shared by
+  every node. Needs boto3, credentials come from the usual AWS variables.
+
+Remote backends can hand out presigned URLs, so ``get_image`` redirects to
+the object store instead of proxying the bytes (``STORAGE_REDIRECT``).
+"""
+import contextlib
+import os
+import time
+from typing import NamedTuple
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local")
+S3_BUCKET = os.getenv("S3_BUCKET", "images")
+S3_PREFIX = os.getenv("S3_PREFIX", "")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+S3_REGION = os.getenv("S3_REGION") or None
+# Answer plain image GETs with a redirect to a presigned URL when the
+# backend supports it.
+STORAGE_REDIRECT = os.getenv("STORAGE_REDIRECT", "true").lower() in ("true", "1")
+PRESIGNED_URL_EXPIRES = int(os.getenv("PRESIGNED_URL_EXPIRES", "3600"))
+# Browsers reuse a redirect for half the lifetime of the URL it points to.
+REDIRECT_MAX_AGE = PRESIGNED_URL_EXPIRES // 2
+
+
+class FileStat(NamedTuple):
+    """The parts of ``os.stat_result`` the serving code uses."""
+
+    st_size: int
+    st_mtime: float
+    st_mtime_ns: int
+
+
+def stat_at(size, mtime):
+    return FileStat(size, mtime, int(mtime * 1_000_000_000))
+
+
+class LocalBackend:
+    """Files below ``directory``, every call on the storage thread pool."""
+
+    def __init__(self, storage, directory):
+        self.storage = storage
+        self.directory = directory
+
+    def local_path(self, key):
+        return os.path.join(self.directory, key)
+
+    async def put_file(self, temp_path, key):
+        """Move a finished temp file to ``key``, replacing it atomically."""
+        path = self.local_path(key)
+        await self.storage.mkdir(os.path.dirname(path))
+        await self.storage.replace(temp_path, path)
+
+    async def exists(self, key):
+        return await self.storage.exists(self.local_path(key))
+
+    async def stat(self, key):
+        """FileNotFoundError if there is no such file."""
+        return await self.storage.stat(self.local_path(key))
+
+    async def read(self, key, start=0, length=-1):
+        return await self.storage.read_range(self.local_path(key), start, length)
+
+    async def delete(self, key):
+        """Remove ``key``, returns False if it did not exist."""
+        return await self.storage.remove(self.local_path(key))
+
+    async def list_keys(self):
+        """
+        Yield lists of (key, mtime) of every stored file, one top level
+        directory at a time. Hidden entries such as the upload staging
+        directory are skipped.
+        """
+        names = await self.storage.run("scan", _visible_entries, self.directory)
+        for name in sorted(names):
+            yield await self.storage.run("scan", _walk_files, self.directory, name)
+
+    @contextlib.asynccontextmanager
+    async def local_file(self, key):
+        yield self.local_path(key)
+
+    def presigned_url(self, key):
+        return None
+
+
+class MemoryBackend:
+    """Files in a dict, lost with the worker."""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.files = {}
+
+    def local_path(self, key):
+        return None
+
+    async def put_file(self, temp_path, key):
+        data = await self.storage.read_range(temp_path, 0, -1)
+        await self.storage.remove(temp_path)
+        self.files[key] = (data, time.time())
+
+    async def exists(self, key):
+        return key in self.files
+
+    async def stat(self, key):
+        if key not in self.files:
+            raise FileNotFoundError(key)
+        data, mtime = self.files[key]
+        return stat_at(len(data), mtime)
+
+    async def read(self, key, start=0, length=-1):
+        if key not in self.files:
+            raise FileNotFoundError(key)
+        data = self.files[key][0]
+        return data[start:] if length < 0 else data[start : start + length]
+
+    async def delete(self, key):
+        return self.files.pop(key, None) is not None
+
+    async def list_keys(self):
+        yield [(key, mtime) for key, (_, mtime) in list(self.files.items())]
+
+    @contextlib.asynccontextmanager
+    async def local_file(self, key):
+        async with _downloaded(self.storage, self, key) as path:
+            yield path
+
+    def presigned_url(self, key):
+        return None
+
+
+class S3Backend:
+    """
+    Objects in an S3 compatible bucket.
+
+    boto3 is blocking, its calls run on the storage thread pool and show up
+    in the storage timings as ``s3_<operation>``.
+    """
+
+    def __init__(self, storage, bucket=S3_BUCKET, prefix=S3_PREFIX, client=None):
+        self.storage = storage
+        self.bucket = bucket
+        self.prefix = prefix
+        if client is None:
+            import boto3
+
+            client = boto3.client(
+                "s3", endpoint_url=S3_ENDPOINT_URL, region_name=S3_REGION
+            )
+        self.client = client
+
+    def object_key(self, key):
+        return f"{self.prefix}{key}"
+
+    def local_path(self, key):
+        return None
+
+    def _call(self, operation, **kwargs):
+        return self.storage.run(
+            f"s3_{operation}",
+            lambda: getattr(self.client, operation)(Bucket=self.bucket, **kwargs),
+        )
+
+    async def put_file(self, temp_path, key):
+        # The object only becomes visible once the upload is complete.
+        await self.storage.run(
+            "s3_upload_file",
+            self.client.upload_file,
+            temp_path,
+            self.bucket,
+            self.object_key(key),
+        )
+        await self.storage.remove(temp_path)
+
+    async def exists(self, key):
+        try:
+            await self.stat(key)
+        except FileNotFoundError:
+            return False
+        return True
+
+    async def stat(self, key):
+        try:
+            head = await self._call("head_object", Key=self.object_key(key))
+        except self.client.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                raise FileNotFoundError(key)
+            raise
+        return stat_at(head["ContentLength"], head["LastModified"].timestamp())
+
+    async def read(self, key, start=0, length=-1):
+        kwargs = {"Key": self.object_key(key)}
+        if start or length >= 0:
+            end = "" if length < 0 else start + length - 1
+            kwargs["Range"] = f"bytes={start}-{end}"
+        try:
+            response = await self._call("get_object", **kwargs)
+        except self.client.exceptions.NoSuchKey:
+            raise FileNotFoundError(key)
+        return await self.storage.run("s3_read", response["Body"].read)
+
+    async def delete(self, key):
+        # S3 doesn't tell whether the object existed.
+        await self._call("delete_object", Key=self.object_key(key))
+        return True
+
+    async def list_keys(self):
+        """Yield lists of (key, mtime), one listing page at a time."""
+        kwargs = {"Prefix": self.prefix}
+        while True:
+            page = await self._call("list_objects_v2", **kwargs)
+            yield [
+                (item["Key"][len(self.prefix) :], item["LastModified"].timestamp())
+                for item in page.get("Contents", [])
+            ]
+            if not page.get("IsTruncated"):
+                return
+            kwargs["ContinuationToken"] = page["NextContinuationToken"]
+
+    @contextlib.asynccontextmanager
+    async def local_file(self, key):
+        async with _downloaded(self.storage, self, key) as path:
+            yield path
+
+    def presigned_url(self, key):
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": self.object_key(key)},
+            ExpiresIn=PRESIGNED_URL_EXPIRES,
+        )
+
+
+def _visible_entries(directory):
+    return [name for name in os.listdir(directory) if not name.startswith(".")]
+
+
+def _walk_files(directory, name):
+    path = os.path.join(directory, name)
+    if os.path.isfile(path):
+        return [(name, os.stat(path).st_mtime)]
+    files = []
+    for root, directories, names in os.walk(path):
+        directories[:] = [d for d in directories if not d.startswith(".")]
+        for file_name in names:
+            file_path = os.path.join(root, file_name)
+            try:
+                mtime = os.stat(file_path).st_mtime
+            except FileNotFoundError:
+                continue
+            key = os.path.relpath(file_path, directory).replace(os.sep, "/")
+            files.append((key, mtime))
+    return files
+
+
+@contextlib.asynccontextmanager
+async def _downloaded(storage, backend, key):
+    """A temp copy of ``key`` on local disk, for code that needs a path."""
+    data = await backend.read(key)
+    temp_path = await storage.write_temp(None, data)
+    try:
+        yield temp_path
+    finally:
+        await storage.remove(temp_path)
+
+
+def create_backend(storage, directory, kind=None):
+    kind = kind or STORAGE_BACKEND
+    if kind == "local":
+        return LocalBackend(storage, directory)
+    if kind == "memory":
+        return MemoryBackend(storage)
+    if kind == "s3":
+        return S3Backend(storage)
+    raise ValueError(f"Unknown STORAGE_BACKEND {kind!r}")
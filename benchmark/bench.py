@@ -0,0 +1,352 @@
+"""
+Load and latency benchmark for the image server.
+
+Starts the server in a child process, against an in-memory MongoDB stand-in
+(mongomock-motor) unless ``--db-url`` is given, in a throwaway working
+directory. Seeds a synthetic catalog from ``test_images`` and drives each
+workload with a fixed number of requests at a fixed concurrency. Results
+are printed as JSON, one entry per workload with throughput and latency
+percentiles in milliseconds:
+
+    python benchmark/bench.py --catalog 2000 --requests 500 --concurrency 32
+
+Compare the output of two commits to catch regressions before deploying.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_IMAGES = os.path.join(REPO_DIRECTORY, "test_images")
+CONTENT_TYPES = {
+    ".jpg": "image/jpeg",
+    ".png": "image/png",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+    ".bmp": "image/bmp",
+}
+WORKLOADS = (
+    "upload",
+    "search_regex",
+    "search_bar",
+    "search_random",
+    "search_deep",
+    "get",
+    "replace",
+    "bulk_delete",
+)
+SEED_BATCH_SIZE = 100
+BULK_DELETE_SIZE = 10
+PAGE_SIZE = 25
+
+WORDS = [
+    "霸王", "別姬", "牡丹", "亭", "白蛇", "傳", "西廂", "記", "鳳", "冠",
+    "dragon", "phoenix", "silk", "robe", "crown", "fan", "opera", "jade",
+]
+CATEGORIES = ["men-traditional-chinese", "women-traditional-chinese", "modern"]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = round(fraction * (len(sorted_values) - 1))
+    return round(sorted_values[index], 3)
+
+
+def summarize(name, latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    total = len(latencies) + errors
+    return {
+        "workload": name,
+        "requests": total,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 2) if elapsed else None,
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+        "max_ms": round(latencies[-1], 3) if latencies else None,
+    }
+
+
+def load_images():
+    images = []
+    for name in sorted(os.listdir(TEST_IMAGES)):
+        content_type = CONTENT_TYPES.get(os.path.splitext(name)[1].lower())
+        if content_type:
+            with open(os.path.join(TEST_IMAGES, name), "rb") as f:
+                images.append((name, f.read(), content_type))
+    return images
+
+
+def random_info(rng):
+    return {
+        "title": "".join(rng.sample(WORDS, 2)),
+        "name": "".join(rng.sample(WORDS, 2)),
+        "number": f"{rng.randrange(100000):05d}",
+        "category": rng.choice(CATEGORIES),
+        "business_type": rng.choice(["rent", "sell"]),
+    }
+
+
+def unique_image(image, rng):
+    # Distinct bytes, so content addressing can't fold the catalog into a
+    # handful of files. Trailing bytes are ignored by image decoders.
+    name, data, content_type = image
+    return name, data + rng.randbytes(16), content_type
+
+
+class Benchmark:
+    def __init__(self, client, options):
+        self.client = client
+        self.options = options
+        self.rng = random.Random(options.seed)
+        self.images = load_images()
+        self.catalog = []
+
+    async def seed(self):
+        """Fill the catalog through the batch upload endpoint."""
+        remaining = self.options.catalog
+        while remaining:
+            count = min(SEED_BATCH_SIZE, remaining)
+            chosen = [
+                unique_image(self.rng.choice(self.images), self.rng)
+                for _ in range(count)
+            ]
+            infos = [random_info(self.rng) for _ in range(count)]
+            response = await self.client.post(
+                "/images/upload/batch",
+                files=[("image", image) for image in chosen],
+                data={"metadata": json.dumps(infos)},
+            )
+            response.raise_for_status()
+            for result, info in zip(response.json()["results"], infos):
+                if "image_id" in result:
+                    self.catalog.append((result, info))
+            remaining -= count
+
+    async def drive(self, name, make_request, total):
+        """Send ``total`` requests from ``--concurrency`` tasks."""
+        counter = itertools.count()
+        latencies = []
+        errors = 0
+
+        async def worker():
+            nonlocal errors
+            while next(counter) < total:
+                method, url, kwargs = make_request()
+                started = time.perf_counter()
+                try:
+                    response = await self.client.request(method, url, **kwargs)
+                    ok = response.status_code < 400
+                except httpx.HTTPError:
+                    ok = False
+                if ok:
+                    latencies.append((time.perf_counter() - started) * 1000)
+                else:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(self.options.concurrency)))
+        return summarize(name, latencies, errors, time.perf_counter() - started)
+
+    def term(self):
+        _, info = self.rng.choice(self.catalog)
+        field = self.rng.choice(["title", "name"])
+        start = self.rng.randrange(max(1, len(info[field]) - 1))
+        return field, info[field][start : start + 2]
+
+    def upload(self):
+        image = unique_image(self.rng.choice(self.images), self.rng)
+        return "POST", "/images/upload", {
+            "files": {"image": image},
+            "data": random_info(self.rng),
+        }
+
+    def search_regex(self):
+        field, term = self.term()
+        return "GET", "/images/search", {"params": {field: term, "count": "exact"}}
+
+    def search_bar(self):
+        _, term = self.term()
+        params = {"title": term, "name": term, "number": term, "is_search_bar": "true"}
+        return "GET", "/images/search", {"params": params}
+
+    def search_random(self):
+        return "GET", "/images/search", {
+            "params": {"is_random": "true", "page_size": "10", "count": "none"}
+        }
+
+    def search_deep(self):
+        last_page = max(1, len(self.catalog) // PAGE_SIZE)
+        page = self.rng.randrange(max(1, last_page // 2), last_page + 1)
+        return "GET", "/images/search", {
+            "params": {"page_number": str(page), "page_size": str(PAGE_SIZE)}
+        }
+
+    def get(self):
+        result, _ = self.rng.choice(self.catalog)
+        return "GET", "/" + result["image_path"], {}
+
+    def replace(self):
+        result, _ = self.rng.choice(self.catalog)
+        files = None
+        if self.rng.random() < 0.5:
+            files = {"image": unique_image(self.rng.choice(self.images), self.rng)}
+        return "PUT", f"/images/{result['image_id']}", {
+            "files": files,
+            "data": {"title": "".join(self.rng.sample(WORDS, 2))},
+        }
+
+    def bulk_delete(self):
+        batch = [self.catalog.pop()[0]["image_id"] for _ in range(BULK_DELETE_SIZE)]
+        return "DELETE", "/images", {"json": {"image_ids": batch}}
+
+    async def run(self, workloads):
+        results = []
+        for name in workloads:
+            total = self.options.requests
+            if name == "bulk_delete":
+                # Limited by what is left of the catalog.
+                total = min(total, len(self.catalog) // BULK_DELETE_SIZE)
+            results.append(await self.drive(name, getattr(self, name), total))
+        return results
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve(port):
+    """Child process entry point: run the app with the configured database."""
+    sys.path.insert(0, REPO_DIRECTORY)
+    import db
+
+    if not os.getenv("DB_URL"):
+        from mongomock_motor import AsyncMongoMockClient
+
+        client = AsyncMongoMockClient()
+        db.client_factory = lambda: client
+
+    from app import app
+
+    app.run(
+        host="127.0.0.1",
+        port=port,
+        single_process=True,
+        access_log=False,
+        motd=False,
+    )
+
+
+def start_server(port, options, work_directory):
+    env = dict(os.environ)
+    env.pop("DB_URL", None)
+    if options.db_url:
+        env["DB_URL"] = options.db_url
+        env["DB_NAME"] = options.db_name
+    os.makedirs(os.path.join(work_directory, "images"), exist_ok=True)
+    return subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve", str(port)],
+        cwd=work_directory,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=None if options.verbose else subprocess.DEVNULL,
+    )
+
+
+async def wait_until_up(client, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Server exited during startup")
+        try:
+            if (await client.get("/")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("Server did not start")
+
+
+async def benchmark(options):
+    workloads = options.workloads.split(",") if options.workloads else WORKLOADS
+    unknown = set(workloads) - set(WORKLOADS)
+    if unknown:
+        raise SystemExit(f"Unknown workloads: {', '.join(sorted(unknown))}")
+
+    port = free_port()
+    with tempfile.TemporaryDirectory() as work_directory:
+        process = start_server(port, options, work_directory)
+        try:
+            limits = httpx.Limits(max_connections=options.concurrency)
+            async with httpx.AsyncClient(
+                base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=60
+            ) as client:
+                await wait_until_up(client, process)
+                bench = Benchmark(client, options)
+                started = time.perf_counter()
+                await bench.seed()
+                seed_seconds = time.perf_counter() - started
+                results = await bench.run(workloads)
+        finally:
+            process.terminate()
+            process.wait()
+
+    return {
+        "python": platform.python_version(),
+        "database": "mongodb" if options.db_url else "mongomock",
+        "catalog": options.catalog,
+        "seed_seconds": round(seed_seconds, 3),
+        "requests": options.requests,
+        "concurrency": options.concurrency,
+        "results": results,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--catalog", type=int, default=1000, help="images to seed")
+    parser.add_argument("--requests", type=int, default=200, help="per workload")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--workloads", help=f"comma separated subset of {','.join(WORKLOADS)}"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--db-url", help="benchmark a real MongoDB instead")
+    parser.add_argument("--db-name", default="image_bench")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--verbose", action="store_true", help="show server logs")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main():
+    options = parse_args()
+    if options.serve:
+        serve(options.serve)
+        return
+
+    report = asyncio.run(benchmark(options))
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
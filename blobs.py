@@ -0,0 +1,221 @@
+import asyncio
+import datetime
+import hashlib
+import os
+import uuid
+from collections import Counter
+from typing import NamedTuple
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import layout
+
+# Seconds a release may spend unlinking a blob's files. Uploads of the same
+# bytes wait for it that long, and a stalled release can be taken over after.
+BLOB_RELEASE_TIMEOUT = float(os.getenv("BLOB_RELEASE_TIMEOUT", "30"))
+RELEASE_POLL_INTERVAL = 0.05
+
+
+def sha256_hex(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class Release(NamedTuple):
+    """A claim on an unreferenced blob, held while its files are unlinked."""
+
+    sha256: str
+    token: str
+    keys: list
+
+
+class BlobStore:
+    """
+    Content addressed image files.
+
+    Every unique file is stored once as ``<sha256><ext>``, in the sharded
+    directory layout of the ``files`` backend. The ``blobs`` collection
+    keeps one document per file with the number of images referencing it,
+    and the file, with its renditions (see ``transcoding``), is only
+    removed with its last reference. Uploads are staged in
+    ``temp_directory`` on local disk through ``storage``.
+    """
+
+    def __init__(self, database, directory, temp_directory, storage, files):
+        self.collection = database["blobs"]
+        self.directory = directory
+        self.temp_directory = temp_directory
+        self.storage = storage
+        self.files = files
+
+    def path_for(self, sha256, extension):
+        return layout.as_image_path(
+            layout.sharded_path(self.directory, f"{sha256}{extension.lower()}")
+        )
+
+    def key_for(self, path):
+        return layout.key_for(self.directory, path)
+
+    async def store_bytes(self, data, extension):
+        """Store an in-memory upload, returns (sha256, image_path)."""
+        # Hashed on the storage thread together with the write, so several
+        # uploads can be stored concurrently without blocking the event loop.
+        temp_path, sha256 = await self.storage.write_temp(
+            self.temp_directory, data, sha256_hex
+        )
+        return sha256, await self.store_file(temp_path, sha256, len(data), extension)
+
+    async def store_file(self, temp_path, sha256, size, extension, refs=1):
+        """
+        Add ``refs`` references to the blob with this hash, taking ownership
+        of ``temp_path``. Returns the path of the stored file.
+        """
+        path = self.path_for(sha256, extension)
+        before = await self.collection.find_one_and_update(
+            {"_id": sha256},
+            {"$inc": {"refs": refs}, "$setOnInsert": {"path": path, "size": size}},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE,
+        )
+        if before is not None:
+            if before.get("deleting"):
+                # The files are being unlinked, written again once that's done.
+                await self._wait_for_release(sha256, before["deleting"])
+            elif before["refs"] > 0 and await self.files.exists(
+                self.key_for(before["path"])
+            ):
+                await self.storage.remove(temp_path)
+                return before["path"]
+            # A blob at zero references may be in the middle of being
+            # released, and a flat file may just have been migrated, so the
+            # file is written again at its sharded path rather than trusted.
+            extension = os.path.splitext(before["path"])[1]
+            path = self.path_for(sha256, extension)
+            if before["path"] != path or "size" not in before:
+                # Placeholders of claimed orphans don't know the size.
+                await self.collection.update_one(
+                    {"_id": sha256}, {"$set": {"path": path, "size": size}}
+                )
+
+        await self.files.put_file(temp_path, self.key_for(path))
+        return path
+
+    async def _wait_for_release(self, sha256, token):
+        deadline = asyncio.get_running_loop().time() + BLOB_RELEASE_TIMEOUT
+        while asyncio.get_running_loop().time() < deadline:
+            blob = await self.collection.find_one({"_id": sha256}, {"deleting": 1})
+            if blob is None or blob.get("deleting") != token:
+                return
+            await asyncio.sleep(RELEASE_POLL_INTERVAL)
+        # The releaser stalled, its claim is void from now on.
+        await self.collection.update_one(
+            {"_id": sha256, "deleting": token},
+            {"$unset": {"deleting": "", "deleting_at": "", "renditions": ""}},
+        )
+
+    async def reference(self, sha256, refs=1):
+        """
+        Add references to a stored blob without its bytes, returns its path
+        or None when there is no such blob.
+        """
+        blob = await self.collection.find_one_and_update(
+            {"_id": sha256, "refs": {"$gt": 0}}, {"$inc": {"refs": refs}}
+        )
+        return blob["path"] if blob else None
+
+    async def release(self, sha256):
+        await self.release_many([sha256])
+
+    async def release_many(self, hashes):
+        """Drop one reference per hash given, unlinking unreferenced files."""
+        for release in await self.unreference(hashes):
+            try:
+                for key in release.keys:
+                    await self.files.delete(key)
+            finally:
+                await self.finish_release(release)
+
+    async def unreference(self, hashes):
+        """
+        Drop one reference per hash given and claim the blobs no longer
+        referenced. The caller unlinks the keys of each Release, then hands
+        it to ``finish_release``.
+        """
+        unreferenced = []
+        for sha256, count in Counter(hashes).items():
+            blob = await self.collection.find_one_and_update(
+                {"_id": sha256},
+                {"$inc": {"refs": -count}},
+                return_document=ReturnDocument.AFTER,
+            )
+            if blob and blob["refs"] <= 0:
+                unreferenced.append(sha256)
+
+        releases = []
+        for sha256 in unreferenced:
+            release = await self.claim(sha256)
+            if release is not None:
+                releases.append(release)
+        return releases
+
+    async def claim(self, sha256, path=None):
+        """
+        Claim the unreferenced blob ``sha256`` for unlinking its files. None
+        if it is referenced or claimed by another release.
+
+        Files without a blob document, such as orphans found by the
+        collector at ``path``, are claimed through a placeholder document,
+        so an upload of the same bytes meanwhile waits for the unlink too.
+        """
+        token = uuid.uuid4().hex
+        now = utcnow()
+        stalled = now - datetime.timedelta(seconds=BLOB_RELEASE_TIMEOUT)
+        claim = {"deleting": token, "deleting_at": now}
+        # Only the caller that claims the blob unlinks the file, a
+        # concurrent upload may have taken a new reference meanwhile.
+        blob = await self.collection.find_one_and_update(
+            {
+                "_id": sha256,
+                "refs": {"$lte": 0},
+                "$or": [
+                    {"deleting": {"$exists": False}},
+                    {"deleting_at": {"$lt": stalled}},
+                ],
+            },
+            {"$set": claim},
+            return_document=ReturnDocument.AFTER,
+        )
+        if blob is None:
+            if path is None:
+                return None
+            blob = {"_id": sha256, "refs": 0, "path": path, **claim}
+            try:
+                await self.collection.insert_one(blob)
+            except DuplicateKeyError:
+                # Referenced, or claimed, by now.
+                return None
+
+        key = self.key_for(blob["path"])
+        keys = [key] + [
+            layout.rendition_key(key, format) for format in blob.get("renditions", {})
+        ]
+        return Release(sha256, token, keys)
+
+    async def finish_release(self, release):
+        """
+        Remove the blob document of an unlinked blob. An upload that took a
+        reference meanwhile is waiting to write the file again, the blob
+        then stays without its unlinked renditions.
+        """
+        deleted = await self.collection.delete_one(
+            {"_id": release.sha256, "deleting": release.token, "refs": {"$lte": 0}}
+        )
+        if not deleted.deleted_count:
+            await self.collection.update_one(
+                {"_id": release.sha256, "deleting": release.token},
+                {"$unset": {"deleting": "", "deleting_at": "", "renditions": ""}},
+            )
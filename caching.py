@@ -0,0 +1,77 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    In-process LRU cache whose entries also expire after ``ttl`` seconds.
+
+    With ``max_bytes`` set, ``sizeof(value)`` of all entries is kept under
+    that bound as well.
+    """
+
+    def __init__(self, maxsize, ttl, max_bytes=None, sizeof=len):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """Store ``value``, expiring after ``ttl`` instead of the default."""
+        if key in self.entries:
+            self._remove(key)
+        size = self.sizeof(value) if self.max_bytes else 0
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self.entries[key] = (expires, value, size)
+        self.total_bytes += size
+        while len(self.entries) > self.maxsize or (
+            self.max_bytes and self.total_bytes > self.max_bytes
+        ):
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, value, size = self.entries.pop(key)
+        self.total_bytes -= size
+        return value
+
+    def pop(self, key):
+        if key in self.entries:
+            return self._remove(key)
+        return None
+
+    def discard_where(self, predicate):
+        """Drop every entry whose value satisfies ``predicate``."""
+        stale = [key for key, entry in self.entries.items() if predicate(entry[1])]
+        for key in stale:
+            self._remove(key)
+        return len(stale)
+
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,356 @@
+"""
+Background removal of deleted images.
+
+Bulk deletes only mark documents with ``deleted_at`` in one update, see
+``db.LIVE``. Every worker runs a collector, the one holding the lease in the
+``gc`` collection does the work, so passes never overlap:
+
+- tombstoned documents are removed in batches, then the references to their
+  files are dropped and unreferenced files are unlinked. Documents go first:
+  if the collector dies in between a file is kept rather than unlinked while
+  still in use.
+- files that fail to unlink are queued in ``gc_files`` and retried with
+  backoff.
+- every ``GC_RECONCILE_INTERVAL`` the image files are listed and files
+  without a blob or image document are removed. Files younger than
+  ``GC_ORPHAN_GRACE`` are left alone, an upload or migration may be about
+  to reference them.
+
+Like releases, retries and orphan removals claim the blob of a file before
+unlinking it (see ``BlobStore.claim``), an upload of the same bytes waits
+for the unlink and writes the file again.
+
+Progress is kept on the lease document, ``GET /stats`` shows it together
+with the backlog.
+"""
+import asyncio
+import datetime
+import logging
+import os
+import socket
+import time
+import uuid
+from pathlib import Path
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+import db
+import layout
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds between passes.
+GC_INTERVAL = float(os.getenv("GC_INTERVAL", "10"))
+GC_BATCH_SIZE = int(os.getenv("GC_BATCH_SIZE", "200"))
+# A worker that stops renewing loses the lease after this many seconds.
+GC_LEASE_SECONDS = int(os.getenv("GC_LEASE_SECONDS", "60"))
+# Failed unlinks are retried after 2**attempts seconds, up to this.
+GC_MAX_BACKOFF = int(os.getenv("GC_MAX_BACKOFF", "3600"))
+# Seconds between orphan scans, 0 disables them.
+GC_RECONCILE_INTERVAL = int(os.getenv("GC_RECONCILE_INTERVAL", "3600"))
+GC_ORPHAN_GRACE = int(os.getenv("GC_ORPHAN_GRACE", "3600"))
+
+LEASE_ID = "collector"
+
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class Collector:
+    """Removes tombstoned images and unreferenced files."""
+
+    def __init__(self, database, files, blobs, directory):
+        self.images = database["images"]
+        self.blobs = blobs
+        self.blob_collection = database["blobs"]
+        self.leases = database["gc"]
+        self.retries = database["gc_files"]
+        self.files = files
+        self.directory = Path(directory)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    async def acquire_lease(self):
+        """Take or renew the lease, returns the lease document or None."""
+        now = utcnow()
+        try:
+            return await self.leases.find_one_and_update(
+                {
+                    "_id": LEASE_ID,
+                    "$or": [
+                        {"owner": self.owner},
+                        {"expires_at": {"$lt": now}},
+                        {"expires_at": {"$exists": False}},
+                    ],
+                },
+                {
+                    "$set": {
+                        "owner": self.owner,
+                        "expires_at": now
+                        + datetime.timedelta(seconds=GC_LEASE_SECONDS),
+                    }
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # Held by another worker.
+            return None
+
+    async def _progress(self, **counts):
+        for kind, count in counts.items():
+            metrics.GC_REMOVED.labels(kind).inc(count)
+        await self.leases.update_one(
+            {"_id": LEASE_ID},
+            {"$inc": counts, "$set": {"last_pass_at": utcnow()}},
+        )
+
+    async def collect_batch(self):
+        """Remove one batch of tombstoned images, returns how many."""
+        batch = await self.images.find(
+            db.TOMBSTONED, {"_id": 1, "blob": 1, "image_path": 1}
+        ).limit(GC_BATCH_SIZE).to_list(length=None)
+        if not batch:
+            return 0
+
+        await self.images.delete_many(
+            {"_id": {"$in": [image_data["_id"] for image_data in batch]}}
+        )
+        hashes = [image_data["blob"] for image_data in batch if image_data.get("blob")]
+        removed = 0
+        for release in await self.blobs.unreference(hashes):
+            # Uploads of the same bytes wait until the claim is finished.
+            try:
+                removed += await self._unlink(release.keys)
+            finally:
+                await self.blobs.finish_release(release)
+        # Stored before content addressing, the file is not shared.
+        removed += await self._unlink(
+            [
+                layout.key_for(self.directory, image_data["image_path"])
+                for image_data in batch
+                if not image_data.get("blob") and image_data.get("image_path")
+            ]
+        )
+        await self._progress(images=len(batch), files=removed)
+        return len(batch)
+
+    async def _unlink(self, keys, attempts=None):
+        """Delete ``keys``, queueing failures for a retry. Returns the count."""
+        removed = 0
+        for key in keys:
+            try:
+                await self.files.delete(key)
+            except Exception as e:
+                attempt = (attempts or {}).get(key, 0) + 1
+                delay = min(2**attempt, GC_MAX_BACKOFF)
+                logger.warning(f"Could not remove {key}, attempt {attempt}: {e}")
+                metrics.GC_FAILURES.inc()
+                await self.retries.replace_one(
+                    {"_id": key},
+                    {
+                        "attempts": attempt,
+                        "error": str(e),
+                        "retry_at": utcnow() + datetime.timedelta(seconds=delay),
+                    },
+                    upsert=True,
+                )
+                continue
+            removed += 1
+            if attempts:
+                await self.retries.delete_one({"_id": key})
+        return removed
+
+    async def retry_failed(self):
+        """Retry the unlinks that are due, returns how many succeeded."""
+        due = await self.retries.find({"retry_at": {"$lte": utcnow()}}).limit(
+            GC_BATCH_SIZE
+        ).to_list(length=None)
+        if not due:
+            return 0
+        keys = [entry["_id"] for entry in due]
+        # The same bytes may have been uploaded again since.
+        referenced = await self._referenced(keys)
+        removed, in_use = await self._unlink_unreferenced(
+            [key for key in keys if key not in referenced],
+            {entry["_id"]: entry["attempts"] for entry in due},
+        )
+        referenced |= in_use
+        if referenced:
+            await self.retries.delete_many({"_id": {"$in": list(referenced)}})
+        await self._progress(files=removed)
+        return removed
+
+    async def _unlink_unreferenced(self, keys, attempts=None, cutoff=None):
+        """
+        Unlink the files among ``keys`` found unreferenced by ``_referenced``,
+        and not modified since ``cutoff`` if given. Returns the count and the
+        keys referenced after all.
+
+        Each file's blob is claimed first, as releases do, so an upload of
+        the same bytes meanwhile waits for the unlink rather than losing its
+        file. References by image documents and the age are then checked
+        again just before unlinking.
+        """
+        removed = 0
+        referenced = set()
+        for sha256, group in _by_blob(keys).items():
+            release = await self.blobs.claim(sha256, self._original_path(group[0]))
+            if release is None:
+                referenced.update(group)
+                continue
+            try:
+                in_use = await self._referenced_by_images(group)
+                referenced |= in_use
+                unlink = []
+                for key in group:
+                    if key not in in_use and await self._unchanged(key, cutoff):
+                        unlink.append(key)
+                removed += await self._unlink(unlink, attempts)
+            finally:
+                await self.blobs.finish_release(release)
+        return removed, referenced
+
+    def _original_path(self, key):
+        """The path of the file ``key`` is, or is a rendition of."""
+        key = Path(key)
+        name = ".".join(key.name.split(".")[:2])
+        return layout.as_image_path(self.directory.joinpath(key.parent, name))
+
+    async def _unchanged(self, key, cutoff):
+        if cutoff is None:
+            return True
+        try:
+            stat = await self.files.stat(key)
+        except FileNotFoundError:
+            return False
+        return stat.st_mtime < cutoff
+
+    async def _referenced(self, keys):
+        """The keys among ``keys`` a blob or image document points to."""
+        referenced = await self._referenced_by_images(keys)
+        # Renditions, <sha256><ext>.<format>, belong to their original's blob.
+        hashes = _by_blob(keys)
+        for blob in await self.blob_collection.find(
+            {"_id": {"$in": list(hashes)}}, {"_id": 1}
+        ).to_list(length=None):
+            referenced.update(hashes[blob["_id"]])
+        return referenced
+
+    async def _referenced_by_images(self, keys):
+        # Flat and sharded locations both count, the layout migration moves
+        # files before it updates their documents.
+        paths = {}
+        for key in keys:
+            name = Path(key).name
+            for candidate in (name, layout.sharded_key(name)):
+                paths[layout.as_image_path(self.directory.joinpath(candidate))] = key
+
+        referenced = set()
+        for image_data in await self.images.find(
+            {"image_path": {"$in": list(paths)}}, {"image_path": 1}
+        ).to_list(length=None):
+            referenced.add(paths[image_data["image_path"]])
+        return referenced
+
+    async def reconcile(self):
+        """Remove stored files no document refers to, returns how many."""
+        cutoff = time.time() - GC_ORPHAN_GRACE
+        removed = 0
+        async for listed in self.files.list_keys():
+            old = [key for key, mtime in listed if mtime < cutoff]
+            for start in range(0, len(old), GC_BATCH_SIZE):
+                keys = old[start : start + GC_BATCH_SIZE]
+                referenced = await self._referenced(keys)
+                removed += (
+                    await self._unlink_unreferenced(
+                        [key for key in keys if key not in referenced], cutoff=cutoff
+                    )
+                )[0]
+            # Long scans keep the lease, and give up once it is lost.
+            if await self.acquire_lease() is None:
+                break
+        await self._progress(orphans=removed)
+        await self.leases.update_one(
+            {"_id": LEASE_ID}, {"$set": {"reconciled_at": utcnow()}}
+        )
+        return removed
+
+    async def run_once(self):
+        """One pass if this worker holds the lease, returns False otherwise."""
+        lease = await self.acquire_lease()
+        if lease is None:
+            return False
+        while await self.collect_batch():
+            if await self.acquire_lease() is None:
+                return True
+        await self.retry_failed()
+
+        reconciled_at = lease.get("reconciled_at")
+        if reconciled_at and reconciled_at.tzinfo is None:
+            reconciled_at = reconciled_at.replace(tzinfo=datetime.timezone.utc)
+        if GC_RECONCILE_INTERVAL and (
+            reconciled_at is None
+            or utcnow() - reconciled_at
+            > datetime.timedelta(seconds=GC_RECONCILE_INTERVAL)
+        ):
+            await self.reconcile()
+        return True
+
+    async def run_forever(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.exception("Collector pass failed")
+                await self._record_error(e)
+            await asyncio.sleep(GC_INTERVAL)
+
+    async def _record_error(self, error):
+        try:
+            await self.leases.update_one(
+                {"_id": LEASE_ID, "owner": self.owner},
+                {"$set": {"last_error": str(error), "last_error_at": utcnow()}},
+            )
+        except PyMongoError:
+            pass
+
+    async def stats(self):
+        """Progress of the collector on any worker and what is left to do."""
+        lease = await self.leases.find_one({"_id": LEASE_ID}) or {}
+        return {
+            "owner": lease.get("owner"),
+            "last_pass_at": _isoformat(lease.get("last_pass_at")),
+            "reconciled_at": _isoformat(lease.get("reconciled_at")),
+            "last_error": lease.get("last_error"),
+            "removed": {
+                kind: lease.get(kind, 0) for kind in ("images", "files", "orphans")
+            },
+            "backlog": {
+                "images": await self.images.count_documents(db.TOMBSTONED),
+                "failed_files": await self.retries.count_documents({}),
+            },
+        }
+
+
+def _by_blob(keys):
+    """``keys`` by the blob id of their name, shared by a file's renditions."""
+    hashes = {}
+    for key in keys:
+        hashes.setdefault(Path(key).name.split(".")[0], []).append(key)
+    return hashes
+
+
+def _isoformat(value):
+    return value.isoformat() if value else None
+
+
+def setup(app):
+    @app.after_server_start
+    async def start_collector(app):
+        app.ctx.collector = Collector(
+            app.ctx.images.db, app.ctx.files, app.ctx.blobs, app.ctx.blobs.directory
+        )
+        app.add_task(app.ctx.collector.run_forever(), name="collector")
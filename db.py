@@ -0,0 +1,177 @@
+import datetime
+import functools
+import os
+import time
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+
+import metrics
+
+mongo_uri = os.getenv("DB_URL") or "mongodb://localhost:27017"
+db_name = os.getenv("DB_NAME") or "image_db"
+
+# Connection pool and timeouts, tunable per deployment.
+MAX_POOL_SIZE = int(os.getenv("DB_MAX_POOL_SIZE", "100"))
+MIN_POOL_SIZE = int(os.getenv("DB_MIN_POOL_SIZE", "0"))
+CONNECT_TIMEOUT_MS = int(os.getenv("DB_CONNECT_TIMEOUT_MS", "5000"))
+SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("DB_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+SOCKET_TIMEOUT_MS = int(os.getenv("DB_SOCKET_TIMEOUT_MS", "10000"))
+WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("DB_WAIT_QUEUE_TIMEOUT_MS", "2000"))
+# Server side limit for a single query (maxTimeMS), 0 disables it.
+QUERY_TIMEOUT_MS = int(os.getenv("DB_QUERY_TIMEOUT_MS", "5000"))
+
+
+def create_client():
+    return AsyncIOMotorClient(
+        mongo_uri,
+        maxPoolSize=MAX_POOL_SIZE,
+        minPoolSize=MIN_POOL_SIZE,
+        connectTimeoutMS=CONNECT_TIMEOUT_MS,
+        serverSelectionTimeoutMS=SERVER_SELECTION_TIMEOUT_MS,
+        socketTimeoutMS=SOCKET_TIMEOUT_MS,
+        waitQueueTimeoutMS=WAIT_QUEUE_TIMEOUT_MS,
+    )
+
+
+# Replaced by tests and benchmarks to run against an in-memory stand-in.
+client_factory = create_client
+
+
+def _query_options():
+    if QUERY_TIMEOUT_MS:
+        return {"maxTimeMS": QUERY_TIMEOUT_MS}
+    return {}
+
+
+# Bulk deleted images keep their document, marked with ``deleted_at``, until
+# the collector removes them. Routes never see them.
+LIVE = {"deleted_at": {"$exists": False}}
+TOMBSTONED = {"deleted_at": {"$exists": True}}
+
+
+def live(query):
+    return {**query, **LIVE}
+
+
+def _timed(operation):
+    """Record the latency of a repository call as ``operation``."""
+    histogram = metrics.MONGO_SECONDS.labels(operation)
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+class ImageRepository:
+    """Async access to the ``images`` collection.
+
+    Every query of the routes goes through here so none of them block the
+    event loop while waiting on MongoDB. Deleted documents waiting for the
+    collector are left out of every query.
+    """
+
+    def __init__(self, database):
+        self.db = database
+        self.collection = database["images"]
+
+    @_timed("count_documents")
+    async def count(self, query):
+        return await self.collection.count_documents(live(query), **_query_options())
+
+    @_timed("find")
+    async def find(self, query, projection=None, skip=0, limit=0, sort=None):
+        cursor = self.collection.find(live(query), projection)
+        if QUERY_TIMEOUT_MS:
+            cursor = cursor.max_time_ms(QUERY_TIMEOUT_MS)
+        if sort:
+            cursor = cursor.sort(sort)
+        if skip:
+            cursor = cursor.skip(skip)
+        if limit:
+            cursor = cursor.limit(limit)
+        return await cursor.to_list(length=None)
+
+    @_timed("find_one")
+    async def find_one(self, query, projection=None):
+        return await self.collection.find_one(
+            live(query), projection, max_time_ms=QUERY_TIMEOUT_MS or None
+        )
+
+    @_timed("aggregate")
+    async def aggregate(self, pipeline):
+        # MongoDB merges this into the pipeline's own leading $match. A leading
+        # $sample only reads random documents directly while it stays first,
+        # there tombstones are dropped right after it.
+        first = 1 if pipeline and "$sample" in pipeline[0] else 0
+        cursor = self.collection.aggregate(
+            pipeline[:first] + [{"$match": LIVE}] + pipeline[first:],
+            **_query_options(),
+        )
+        return await cursor.to_list(length=None)
+
+    @_timed("insert_one")
+    async def insert_one(self, document):
+        return await self.collection.insert_one(document)
+
+    @_timed("insert_many")
+    async def insert_many(self, documents):
+        """Insert in one round trip, unordered so one failure skips only itself."""
+        return await self.collection.insert_many(documents, ordered=False)
+
+    @_timed("replace_one")
+    async def replace_one(self, query, document):
+        return await self.collection.replace_one(live(query), document)
+
+    @_timed("find_one_and_update")
+    async def find_one_and_update(self, query, update, projection=None):
+        """Apply ``update`` atomically, returns the document as it was before."""
+        return await self.collection.find_one_and_update(
+            live(query),
+            update,
+            projection,
+            return_document=ReturnDocument.BEFORE,
+        )
+
+    @_timed("find_one_and_delete")
+    async def find_one_and_delete(self, query, projection=None):
+        """Delete atomically, returns the deleted document or None."""
+        return await self.collection.find_one_and_delete(live(query), projection)
+
+    @_timed("delete_one")
+    async def delete_one(self, query):
+        return await self.collection.delete_one(live(query))
+
+    @_timed("delete_many")
+    async def delete_many(self, query):
+        return await self.collection.delete_many(live(query))
+
+    @_timed("update_many")
+    async def mark_deleted(self, query):
+        """Tombstone the documents matching ``query`` in one update."""
+        return await self.collection.update_many(
+            live(query),
+            {"$set": {"deleted_at": datetime.datetime.now(datetime.timezone.utc)}},
+        )
+
+
+def setup(app):
+    """Open the client when the server starts and close it on shutdown."""
+
+    @app.before_server_start
+    async def connect(app):
+        app.ctx.mongo = client_factory()
+        app.ctx.images = ImageRepository(app.ctx.mongo[db_name])
+
+    @app.after_server_stop
+    async def disconnect(app):
+        app.ctx.mongo.close()
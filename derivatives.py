@@ -0,0 +1,152 @@
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import backends
+
+DERIVATIVE_DIRECTORY = Path(os.getenv("DERIVATIVE_DIRECTORY", "cache"))
+# Upper bound for the bytes kept on disk, least recently used variants go first.
+DERIVATIVE_CACHE_MAX_BYTES = int(
+    os.getenv("DERIVATIVE_CACHE_MAX_BYTES", str(512 * 1024 * 1024))
+)
+# Seconds between directory scans that pick up the variants of other workers.
+DERIVATIVE_CACHE_SCAN_INTERVAL = float(
+    os.getenv("DERIVATIVE_CACHE_SCAN_INTERVAL", "60")
+)
+
+
+def variant_name(source_name, source_stat, transform):
+    """
+    Cache file name for one transform of one version of a source image.
+
+    The source size and mtime are part of the key, so replacing an image
+    never serves a stale variant.
+    """
+    fingerprint = f"{source_name}:{source_stat.st_size}:{source_stat.st_mtime_ns}"
+    digest = hashlib.sha1(
+        f"{fingerprint}:{transform.cache_token()}".encode()
+    ).hexdigest()
+    return f"{digest}{transform.extension}"
+
+
+class DerivativeCache:
+    """
+    Size bounded on-disk LRU of transformed images.
+
+    Concurrent requests for the same missing variant share a single render.
+    Filesystem calls go through ``storage``.
+
+    Workers share the directory and ``max_bytes`` bounds it as a whole. Each
+    worker only counts its own renders between scans, so it scans the
+    directory again when it goes over the cap or the last scan is older
+    than ``DERIVATIVE_CACHE_SCAN_INTERVAL``.
+    """
+
+    def __init__(
+        self, storage, directory=DERIVATIVE_DIRECTORY, max_bytes=DERIVATIVE_CACHE_MAX_BYTES
+    ):
+        self.storage = storage
+        self.directory = Path(directory)
+        # Variants are always on local disk, whatever backend holds the images.
+        self.files = backends.LocalBackend(storage, str(self.directory))
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.pending = {}
+        self.scanned_at = None
+        # Wall clock time of the last use here, hits don't update atimes.
+        self.used = {}
+
+    def _scan(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                files.append((stat.st_atime, entry.name, stat.st_size))
+        return files
+
+    async def load(self):
+        """Index the variants already on disk, oldest access first."""
+        await self.storage.mkdir(self.directory)
+        await self._rescan()
+        await self._trim()
+
+    async def _rescan(self):
+        """Index the variants on disk, of every worker, oldest access first."""
+        files = await self.storage.run("scan", self._scan)
+        used = {name: self.used[name] for _, name, _ in files if name in self.used}
+        self.entries.clear()
+        self.total_bytes = 0
+        for _, name, size in sorted(
+            files, key=lambda file: max(file[0], used.get(file[1], 0))
+        ):
+            self._add(name, size)
+        self.used = used
+        self.scanned_at = time.monotonic()
+
+    def _add(self, name, size):
+        if name in self.entries:
+            self.total_bytes -= self.entries.pop(name)
+        self.entries[name] = size
+        self.total_bytes += size
+
+    async def _evict(self):
+        if (
+            self.total_bytes > self.max_bytes
+            or time.monotonic() - self.scanned_at >= DERIVATIVE_CACHE_SCAN_INTERVAL
+        ):
+            await self._rescan()
+        await self._trim()
+
+    async def _trim(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            self.used.pop(name, None)
+            self.total_bytes -= size
+            await self.storage.remove(self.directory.joinpath(name))
+
+    async def get(self, name, produce):
+        """
+        Return the path of variant ``name``, rendering it on a miss.
+
+        ``produce(path)`` is awaited to write the variant and must return
+        its size in bytes.
+        """
+        path = self.directory.joinpath(name)
+        if name in self.entries and await self.storage.exists(path):
+            self.entries.move_to_end(name)
+            self.used[name] = time.time()
+            return path
+
+        if name not in self.pending:
+            try:
+                # Rendered by another worker sharing the directory.
+                self._add(name, (await self.storage.stat(path)).st_size)
+                return path
+            except FileNotFoundError:
+                pass
+        # Checked again, another request may have started it during the stat.
+        if name not in self.pending:
+            self.pending[name] = asyncio.ensure_future(self._render(name, path, produce))
+
+        await asyncio.shield(self.pending[name])
+        return path
+
+    async def _render(self, name, path, produce):
+        try:
+            size = await produce(str(path))
+            self._add(name, size)
+            self.used[name] = time.time()
+            await self._evict()
+        finally:
+            del self.pending[name]
+
+
+def setup(app):
+    @app.before_server_start
+    async def load_derivative_cache(app):
+        app.ctx.derivatives = DerivativeCache(app.ctx.storage)
+        await app.ctx.derivatives.load()
@@ -0,0 +1,155 @@
+"""
+Image counts per category and business type, for navigation.
+
+Counting on every request means one ``count_documents`` per value. Instead
+the ``facets`` collection keeps a counter per ``<field>:<value>``, and every
+write moves the counters of the info values it removes and adds with
+``$inc``. ``GET /images/facets`` then reads them all at once.
+
+Counters can drift, e.g. when two requests delete the same image at the
+same time. Every ``FACET_REBUILD_INTERVAL`` seconds one worker recounts
+them with an aggregation and corrects the difference with ``$inc`` too, so
+writes made while it runs keep counting.
+"""
+import asyncio
+import datetime
+import logging
+import os
+from collections import Counter
+
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+FACET_FIELDS = ("category", "business_type")
+# Seconds between recounts, 0 disables them.
+FACET_REBUILD_INTERVAL = int(os.getenv("FACET_REBUILD_INTERVAL", "3600"))
+# How often workers check whether a recount is due.
+FACET_CHECK_INTERVAL = 60
+
+REBUILD_ID = "rebuild"
+
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def counter_id(field, value):
+    return f"{field}:{value}"
+
+
+def deltas(removed=(), added=()):
+    """
+    Counter changes by (field, value) for the infos of images leaving and
+    entering the live set. Missing and empty values aren't counted, nor are
+    values that cancel out.
+    """
+    changes = Counter()
+    for sign, infos in ((-1, removed), (1, added)):
+        for info in infos:
+            for field in FACET_FIELDS:
+                value = (info or {}).get(field)
+                if value:
+                    changes[(field, value)] += sign
+    return {key: change for key, change in changes.items() if change}
+
+
+class FacetCounts:
+    """Counters of ``images`` (an ImageRepository) in ``facets``."""
+
+    def __init__(self, images):
+        self.images = images
+        self.collection = images.db["facets"]
+
+    async def apply(self, removed=(), added=()):
+        """Move the counters for images removed and added by one write."""
+        for (field, value), change in deltas(removed, added).items():
+            await self.collection.update_one(
+                {"_id": counter_id(field, value)},
+                {"$inc": {"count": change}, "$set": {"field": field, "value": value}},
+                upsert=True,
+            )
+
+    async def counts(self):
+        """Image counts by value per facet field, values without images left out."""
+        counts = {field: {} for field in FACET_FIELDS}
+        async for counter in self.collection.find(
+            {"field": {"$in": list(FACET_FIELDS)}, "count": {"$gt": 0}}
+        ):
+            counts[counter["field"]][counter["value"]] = counter["count"]
+        return counts
+
+    async def _stored(self, field):
+        return {
+            counter["value"]: counter["count"]
+            async for counter in self.collection.find({"field": field})
+        }
+
+    async def rebuild(self):
+        """Recount every facet from the images, returns the counters fixed."""
+        fixed = 0
+        for field in FACET_FIELDS:
+            actual = {}
+            for group in await self.images.aggregate(
+                [{"$group": {"_id": f"$info.{field}", "count": {"$sum": 1}}}]
+            ):
+                if group["_id"]:
+                    actual[group["_id"]] = group["count"]
+            # Read right after the aggregation, the corrections are relative
+            # to these counts.
+            stored = await self._stored(field)
+            for value in set(actual) | set(stored):
+                change = actual.get(value, 0) - stored.get(value, 0)
+                if change:
+                    await self.collection.update_one(
+                        {"_id": counter_id(field, value)},
+                        {
+                            "$inc": {"count": change},
+                            "$set": {"field": field, "value": value},
+                        },
+                        upsert=True,
+                    )
+                    fixed += 1
+            await self.collection.delete_many({"field": field, "count": 0})
+        return fixed
+
+    async def claim_rebuild(self, interval=FACET_REBUILD_INTERVAL):
+        """True for the one worker that should recount now."""
+        now = utcnow()
+        due = now - datetime.timedelta(seconds=interval)
+        try:
+            # Upserted when nobody counted before.
+            await self.collection.find_one_and_update(
+                {
+                    "_id": REBUILD_ID,
+                    "$or": [
+                        {"rebuilt_at": {"$lt": due}},
+                        {"rebuilt_at": {"$exists": False}},
+                    ],
+                },
+                {"$set": {"rebuilt_at": now}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # Counted recently, or claimed by another worker just now.
+            return False
+        return True
+
+    async def rebuild_forever(self):
+        while True:
+            try:
+                if await self.claim_rebuild():
+                    fixed = await self.rebuild()
+                    if fixed:
+                        logger.info(f"Facet recount fixed {fixed} counters")
+            except Exception:
+                logger.exception("Facet recount failed")
+            await asyncio.sleep(FACET_CHECK_INTERVAL)
+
+
+def setup(app):
+    @app.before_server_start
+    async def start_facet_counts(app):
+        app.ctx.facets = FacetCounts(app.ctx.images)
+        if FACET_REBUILD_INTERVAL:
+            app.add_task(app.ctx.facets.rebuild_forever(), name="facet-recount")
@@ -0,0 +1,67 @@
+"""
+Sparse field selection for search results and image details.
+
+``fields=image_id,image_path,title,price`` returns only those fields of each
+image. Info fields are named alone (``title``) or with their prefix
+(``info.title``) and stay nested under ``info``, ``info`` selects all of
+them. Searches turn the selection into an inclusion projection, so MongoDB
+doesn't even send the fields left out.
+"""
+DOCUMENT_FIELDS = (
+    "image_id",
+    "image_path",
+    "blob",
+    "version",
+    "renditions",
+    "analysis",
+    "info",
+)
+
+
+def parse_fields(value, info_fields):
+    """
+    The document paths ``value`` selects, in a stable order, or None for
+    all fields when it is absent or empty. Raises ValueError for fields
+    that can't be selected.
+    """
+    names = [name.strip() for name in (value or "").split(",") if name.strip()]
+    if not names:
+        return None
+
+    paths = set()
+    for name in names:
+        if name in DOCUMENT_FIELDS:
+            paths.add(name)
+        elif name in info_fields:
+            paths.add(f"info.{name}")
+        elif name.startswith("info.") and name[5:] in info_fields:
+            paths.add(name)
+        else:
+            allowed = ", ".join(DOCUMENT_FIELDS + tuple(info_fields))
+            raise ValueError(f"fields must be among {allowed}")
+    if "info" in paths:
+        # MongoDB rejects a path together with one of its sub-paths.
+        paths = {path for path in paths if not path.startswith("info.")}
+    return tuple(sorted(paths))
+
+
+def projection(paths, *keep):
+    """Inclusion projection of ``paths`` and the internal fields in ``keep``."""
+    projected = {path: 1 for path in paths + keep}
+    if "_id" not in keep:
+        projected["_id"] = 0
+    return projected
+
+
+def select(document, paths):
+    """``document`` cut down to ``paths``, for documents already fetched."""
+    selected = {}
+    for path in paths:
+        field, _, sub_field = path.partition(".")
+        if field not in document:
+            continue
+        if not sub_field:
+            selected[field] = document[field]
+        elif sub_field in document[field]:
+            selected.setdefault(field, {})[sub_field] = document[field][sub_field]
+    return selected
@@ -0,0 +1,253 @@
+"""
+Per-worker cache of image documents looked up by ``image_id``.
+
+Detail pages ask for the same popular images over and over. Documents are
+kept for ``IMAGE_CACHE_TTL`` seconds and unknown ids for a few seconds, so
+one lookup answers both whether an image exists and what it holds.
+
+Writes on this worker drop their entries at once. Writes on other workers,
+or other servers, arrive through a MongoDB change stream on ``images``.
+Standalone servers have no change streams, there every write is also
+published to the small capped collection ``image_events``, which each worker
+tails. While neither works, entries expire after the TTL as usual.
+
+Writes also publish the image infos they change to ``image_events``, on a
+replica set followed through the same change stream. Listeners such as the
+search cache get them from the events of other workers and drop only what
+those infos match.
+"""
+import asyncio
+import logging
+import os
+import uuid
+
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid, OperationFailure, PyMongoError
+
+import caching
+
+logger = logging.getLogger(__name__)
+
+IMAGE_CACHE_TTL = float(os.getenv("IMAGE_CACHE_TTL", "300"))
+# Unknown ids are remembered for a short while only, they may be uploaded.
+IMAGE_CACHE_NEGATIVE_TTL = float(os.getenv("IMAGE_CACHE_NEGATIVE_TTL", "5"))
+IMAGE_CACHE_MAX_ENTRIES = int(os.getenv("IMAGE_CACHE_MAX_ENTRIES", "10000"))
+
+EVENTS_COLLECTION = "image_events"
+EVENTS_BYTES = 1024 * 1024
+# Wait before re-opening a feed that failed or, for events, ran dry.
+RETRY_SECONDS = 1
+# The server is not a replica set member.
+CHANGE_STREAMS_UNSUPPORTED = 40573
+# Internal fields aren't returned to clients, _id maps change events back.
+PROJECTION = {"search": 0, "rand": 0}
+# Larger writes are published as "drop every search" instead of their infos.
+EVENT_MAX_INFOS = 100
+
+MISSING = object()
+
+
+class ChannelUnsupported(Exception):
+    pass
+
+
+class ImageCache(caching.TTLCache):
+    """
+    TTLCache of ``(_id, document)`` by image_id, None for unknown ids.
+
+    ``generation`` moves on with every change, so a lookup that was running
+    while a write happened doesn't store its possibly stale result.
+    """
+
+    def __init__(
+        self,
+        images,
+        maxsize=IMAGE_CACHE_MAX_ENTRIES,
+        ttl=IMAGE_CACHE_TTL,
+        negative_ttl=IMAGE_CACHE_NEGATIVE_TTL,
+    ):
+        super().__init__(maxsize, ttl)
+        self.images = images
+        self.negative_ttl = negative_ttl
+        # Update and delete events only carry the document's _id.
+        self.object_ids = {}
+        self.generation = 0
+        self.channel = None
+        self.listeners = []
+        # Tells this worker's events apart from those of others.
+        self.origin = uuid.uuid4().hex
+
+    def _remove(self, key):
+        value = super()._remove(key)
+        if value is not None:
+            self.object_ids.pop(value[0], None)
+        return value
+
+    def clear(self):
+        super().clear()
+        self.object_ids.clear()
+
+    async def find(self, image_id):
+        """
+        The document of ``image_id`` without internal fields, None if there
+        is none. Shared with other requests, callers must not change it.
+        """
+        cached = self.get(image_id, MISSING)
+        if cached is not MISSING:
+            return cached and cached[1]
+
+        generation = self.generation
+        document = await self.images.find_one({"image_id": image_id}, PROJECTION)
+        object_id = document.pop("_id") if document else None
+        if generation == self.generation:
+            if document is None:
+                self.set(image_id, None, self.negative_ttl)
+            else:
+                self.set(image_id, (object_id, document))
+                self.object_ids[object_id] = image_id
+        return document
+
+    def invalidate(self, image_ids):
+        self.generation += 1
+        for image_id in image_ids:
+            self.pop(image_id)
+
+    def add_listener(self, callback):
+        """
+        Call ``callback(infos)`` for writes of other workers that change
+        search results. ``infos`` are the image infos before and after, or
+        None when they aren't known and every search may have changed.
+        """
+        self.listeners.append(callback)
+
+    def _notify(self, infos):
+        for callback in self.listeners:
+            callback(infos)
+
+    async def publish(self, image_ids, infos=None):
+        """
+        Drop ``image_ids`` here and tell the other workers to do the same,
+        and to drop the searches ``infos`` match if given.
+        """
+        image_ids = list(image_ids)
+        self.invalidate(image_ids)
+        # Change streams carry the image ids already, but not the infos.
+        if self.channel is None or (
+            infos is None and (self.channel != "events" or not image_ids)
+        ):
+            return
+        event = {"origin": self.origin, "image_ids": image_ids}
+        if infos is not None:
+            infos = list(infos)
+            event["infos"] = infos if len(infos) <= EVENT_MAX_INFOS else None
+        await self.images.db[EVENTS_COLLECTION].insert_one(event)
+
+    def apply_event(self, event):
+        """Drop what an ``image_events`` event of another worker is about."""
+        if event.get("origin") == self.origin:
+            # Dropped when it was published.
+            return
+        self.invalidate(event.get("image_ids", []))
+        if "infos" in event:
+            self._notify(event["infos"])
+
+    def apply_change(self, change):
+        """Drop the entry a change stream event is about."""
+        operation = change["operationType"]
+        if change.get("ns", {}).get("coll") == EVENTS_COLLECTION:
+            if operation == "insert":
+                self.apply_event(change["fullDocument"])
+            return
+        if operation in ("drop", "rename", "dropDatabase", "invalidate"):
+            self.generation += 1
+            self.clear()
+            self._notify(None)
+            return
+        image_id = (change.get("fullDocument") or {}).get("image_id")
+        if image_id is None:
+            image_id = self.object_ids.get(change.get("documentKey", {}).get("_id"))
+        # Also for unknown ids, a lookup of that document may be under way.
+        self.invalidate([image_id] if image_id else [])
+
+    async def _watch_changes(self, database):
+        await _create_events(database)
+        try:
+            stream = database.watch(
+                [{"$match": {"ns.coll": {"$in": ["images", EVENTS_COLLECTION]}}}]
+            )
+        except (NotImplementedError, TypeError) as e:
+            # In-memory stand-ins for tests and benchmarks have no watch().
+            raise ChannelUnsupported(str(e))
+        try:
+            async with stream:
+                self._connected("change_stream")
+                async for change in stream:
+                    self.apply_change(change)
+        except OperationFailure as e:
+            if e.code == CHANGE_STREAMS_UNSUPPORTED:
+                raise ChannelUnsupported(str(e))
+            raise
+
+    async def _tail_events(self, database):
+        events = database[EVENTS_COLLECTION]
+        await _create_events(database)
+        latest = await events.find_one(sort=[("$natural", -1)])
+        last_id = latest["_id"] if latest else None
+        self._connected("events")
+        while True:
+            query = {"_id": {"$gt": last_id}} if last_id else {}
+            cursor = events.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+            while cursor.alive:
+                # Each pass waits on the server for new events.
+                async for event in cursor:
+                    last_id = event["_id"]
+                    self.apply_event(event)
+            # Tailable cursors die at once on an empty collection.
+            await asyncio.sleep(RETRY_SECONDS)
+
+    def _connected(self, channel):
+        # Changes made while no feed was open are lost, start over.
+        self.channel = channel
+        self.generation += 1
+        self.clear()
+        self._notify(None)
+
+    async def listen(self, database):
+        """Follow the changes of other workers until cancelled."""
+        for follow in (self._watch_changes, self._tail_events):
+            while True:
+                try:
+                    await follow(database)
+                except ChannelUnsupported as e:
+                    logger.info(f"Image cache can't use {follow.__name__}: {e}")
+                    self.channel = None
+                    break
+                except PyMongoError as e:
+                    logger.warning(f"Image cache feed failed, reconnecting: {e}")
+                self.channel = None
+                await asyncio.sleep(RETRY_SECONDS)
+        logger.warning(
+            "Image cache has no change feed, writes on other workers show "
+            f"within {self.ttl:.0f} seconds"
+        )
+
+    def stats(self):
+        return {**super().stats(), "channel": self.channel}
+
+
+async def _create_events(database):
+    try:
+        await database.create_collection(
+            EVENTS_COLLECTION, capped=True, size=EVENTS_BYTES
+        )
+    except CollectionInvalid:
+        pass
+    except NotImplementedError as e:
+        raise ChannelUnsupported(str(e))
+
+
+def setup(app):
+    @app.before_server_start
+    async def start_image_cache(app):
+        app.ctx.image_cache = ImageCache(app.ctx.images)
+        app.add_task(app.ctx.image_cache.listen(app.ctx.images.db))
@@ -0,0 +1,256 @@
+import base64
+import io
+import os
+from typing import NamedTuple
+
+from PIL import ExifTags, Image, ImageOps, UnidentifiedImageError, features
+
+MAX_DIMENSION = int(os.getenv("TRANSFORM_MAX_DIMENSION", "4096"))
+DEFAULT_QUALITY = int(os.getenv("TRANSFORM_DEFAULT_QUALITY", "80"))
+# Longest side of the inline placeholder previews, in pixels.
+PLACEHOLDER_SIZE = int(os.getenv("PLACEHOLDER_SIZE", "16"))
+
+FIT_MODES = ("contain", "cover", "fill")
+# Output formats that can be requested, mapped to their Pillow encoder.
+FORMATS = {"jpeg": "JPEG", "jpg": "JPEG", "png": "PNG", "webp": "WEBP"}
+EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp"}
+# Pillow 11.3 and later encode AVIF when built with libavif.
+if features.check("avif"):
+    FORMATS["avif"] = "AVIF"
+    EXTENSIONS["AVIF"] = ".avif"
+
+TRANSFORM_ARGS = ("width", "height", "fit", "quality", "format")
+
+
+class DecodeError(Exception):
+    """The source is not an image Pillow can decode whole."""
+
+
+class Transform(NamedTuple):
+    width: int
+    height: int
+    fit: str
+    quality: int
+    format: str
+
+    @property
+    def extension(self):
+        return EXTENSIONS[self.format]
+
+    def cache_token(self):
+        return f"{self.width}x{self.height}-{self.fit}-q{self.quality}"
+
+
+def _dimension(value, name):
+    if value in (None, ""):
+        return 0
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer")
+    if not 0 < number <= MAX_DIMENSION:
+        raise ValueError(f"{name} must be between 1 and {MAX_DIMENSION}")
+    return number
+
+
+def parse_transform(args, source_name):
+    """
+    Build a Transform from the query arguments of get_image.
+
+    Returns None when no transform argument is present, raises ValueError
+    when one of them is invalid.
+    """
+    if not any(arg in args for arg in TRANSFORM_ARGS):
+        return None
+
+    width = _dimension(args.get("width"), "width")
+    height = _dimension(args.get("height"), "height")
+
+    fit = args.get("fit", "contain")
+    if fit not in FIT_MODES:
+        raise ValueError(f"fit must be one of {', '.join(FIT_MODES)}")
+
+    try:
+        quality = int(args.get("quality", DEFAULT_QUALITY))
+    except ValueError:
+        raise ValueError("quality must be an integer")
+    if not 1 <= quality <= 100:
+        raise ValueError("quality must be between 1 and 100")
+
+    requested_format = args.get("format", "").lower()
+    if requested_format:
+        if requested_format not in FORMATS:
+            raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+        output_format = FORMATS[requested_format]
+    else:
+        # Keep the source format when we can encode it.
+        _, extension = os.path.splitext(source_name)
+        output_format = FORMATS.get(extension.lstrip(".").lower(), "PNG")
+
+    return Transform(width, height, fit, quality, output_format)
+
+
+def _resize(image, width, height, fit):
+    if not width and not height:
+        return image
+
+    if width and height and fit == "fill":
+        return image.resize((width, height), Image.LANCZOS)
+    if width and height and fit == "cover":
+        return ImageOps.fit(image, (width, height), Image.LANCZOS)
+
+    # contain, or only one side given: keep the aspect ratio, never upscale.
+    source_width, source_height = image.size
+    scales = [1.0]
+    if width:
+        scales.append(width / source_width)
+    if height:
+        scales.append(height / source_height)
+    scale = min(scales)
+    size = (max(1, round(source_width * scale)), max(1, round(source_height * scale)))
+    if size == image.size:
+        return image
+    return image.resize(size, Image.LANCZOS)
+
+
+def _decode(source_path):
+    """Open and fully decode ``source_path``, DecodeError if it isn't readable."""
+    image = None
+    try:
+        image = Image.open(source_path)
+        image.load()
+        return image
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        if image is not None:
+            image.close()
+        # Truncated or corrupt data raise OSError without an errno, errors of
+        # the disk itself have one.
+        if isinstance(e, OSError) and e.errno is not None:
+            raise
+        raise DecodeError(str(e)) from e
+
+
+def render(source_path, target_path, transform):
+    """
+    Resize/convert source_path into target_path and return its size.
+
+    Runs in the image pool. The result is written next to the target and
+    renamed, so readers never see a partial file. Raises DecodeError for
+    sources that aren't readable images, writing errors are raised as is.
+    """
+    transform = Transform(*transform)
+    with _decode(source_path) as image:
+        image = ImageOps.exif_transpose(image)
+        image = _resize(image, transform.width, transform.height, transform.fit)
+
+        if transform.format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        elif image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
+
+        temp_path = f"{target_path}.{os.getpid()}.tmp"
+        try:
+            image.save(
+                temp_path, transform.format, quality=transform.quality, optimize=True
+            )
+            os.replace(temp_path, target_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    return os.path.getsize(target_path)
+
+
+def transcode(source_path, target_prefix, formats, quality):
+    """
+    Encode source_path once per format in ``formats`` (keys of FORMATS) as
+    ``<target_prefix>.<format>``. Returns (format, path, size) per file.
+
+    Runs in the image pool. Animated images give nothing, their other
+    frames would be lost.
+    """
+    encoded = []
+    with Image.open(source_path) as image:
+        if getattr(image, "is_animated", False):
+            return encoded
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+        try:
+            for name in formats:
+                target_path = f"{target_prefix}.{name}"
+                image.save(target_path, FORMATS[name], quality=quality)
+                encoded.append((name, target_path, os.path.getsize(target_path)))
+        except BaseException:
+            for _, target_path, _ in encoded:
+                os.remove(target_path)
+            if os.path.exists(f"{target_prefix}.{name}"):
+                os.remove(f"{target_prefix}.{name}")
+            raise
+    return encoded
+
+
+# EXIF orientations that turn the image by 90 degrees.
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def _flatten(image):
+    """RGB on white, so transparent pixels don't count as black."""
+    if image.mode in ("RGBA", "LA") or "transparency" in image.info:
+        image = image.convert("RGBA")
+        background = Image.new("RGBA", image.size, (255, 255, 255, 255))
+        background.alpha_composite(image)
+        image = background
+    return image.convert("RGB")
+
+
+def _dominant_color(image):
+    quantized = image.quantize(colors=8)
+    _, index = max(quantized.getcolors())
+    red, green, blue = quantized.getpalette()[index * 3 : index * 3 + 3]
+    return f"#{red:02x}{green:02x}{blue:02x}"
+
+
+def _placeholder(image):
+    preview = image.copy()
+    preview.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE), Image.BOX)
+    buffer = io.BytesIO()
+    preview.save(buffer, "WEBP", quality=30)
+    encoded = base64.b64encode(buffer.getvalue()).decode()
+    return f"data:image/webp;base64,{encoded}"
+
+
+def analyze(source):
+    """
+    Width and height as displayed, format, byte size, dominant color and a
+    tiny inline preview of an image file path or its bytes.
+
+    Runs in the image pool. Only a downscaled copy is decoded where the
+    format allows it.
+    """
+    if isinstance(source, bytes):
+        size = len(source)
+        source = io.BytesIO(source)
+    else:
+        size = os.path.getsize(source)
+
+    with Image.open(source) as image:
+        width, height = image.size
+        if image.getexif().get(ExifTags.Base.Orientation) in TRANSPOSED_ORIENTATIONS:
+            width, height = height, width
+        image_format = image.format
+        # JPEGs are decoded at a fraction of their size.
+        image.draft("RGB", (PLACEHOLDER_SIZE * 8, PLACEHOLDER_SIZE * 8))
+        small = ImageOps.exif_transpose(image)
+        small.thumbnail((PLACEHOLDER_SIZE * 8, PLACEHOLDER_SIZE * 8), Image.BOX)
+        small = _flatten(small)
+
+    return {
+        "width": width,
+        "height": height,
+        "format": image_format.lower() if image_format else None,
+        "size": size,
+        "color": _dominant_color(small),
+        "placeholder": _placeholder(small),
+    }
@@ -0,0 +1,185 @@
+"""
+Fan-out directory layout for image files.
+
+Files are stored as ``images/ab/cd/abcd...<ext>``, two levels keyed by the
+first four characters of the file name (its sha256 for content addressed
+files), spreading the files evenly over 65536 directories.
+
+Files stored before the layout existed sit directly in ``images/``. Reads
+try the sharded location first and fall back to the flat one, so both kinds
+of URL keep working while ``python layout.py`` moves the files and rewrites
+``image_path`` in batches. The migration can be stopped and run again at any
+time. It applies to the local storage backend.
+"""
+import argparse
+import asyncio
+import os
+from pathlib import Path
+
+import db
+
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+MIGRATION_BATCH_SIZE = 200
+# Matches stored paths that already have the shard directories.
+SHARDED_PATH_PATTERN = "/[^/]+/[^/]+/[^/]+$"
+
+
+def shard_parts(name):
+    return [
+        name[i * SHARD_WIDTH : (i + 1) * SHARD_WIDTH] for i in range(SHARD_LEVELS)
+    ]
+
+
+def sharded_key(name):
+    return "/".join(shard_parts(name) + [name])
+
+
+def sharded_path(directory, name):
+    return Path(directory).joinpath(sharded_key(name))
+
+
+def rendition_key(key, format):
+    """Where the ``format`` rendition of the file at ``key`` is stored."""
+    return f"{key}.{format}"
+
+
+def as_image_path(path):
+    return str(path).replace("\\", "/")
+
+
+def key_for(directory, image_path):
+    """The storage key of a stored ``image_path``, e.g. ``ab/cd/abcd.jpg``."""
+    return as_image_path(Path(image_path).relative_to(directory))
+
+
+def candidate_keys(image_name):
+    """
+    The keys ``image_name`` (a path below the image directory) may be
+    stored at, sharded first. Empty for names that are neither a file name
+    nor its sharded sub-path, which also rules out ``..`` and absolute paths.
+    """
+    name = Path(image_name).name
+    if not name or name.startswith("."):
+        return []
+    if image_name not in (name, sharded_key(name)):
+        return []
+    return [sharded_key(name), name]
+
+
+def _move(source, target):
+    """Move a flat file to its sharded path. False if neither exists."""
+    if os.path.exists(target):
+        # Moved by an earlier, interrupted run.
+        if os.path.exists(source):
+            os.remove(source)
+        return True
+    if not os.path.exists(source):
+        return False
+    try:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(source, target)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+async def migrate_blobs(database, directory, batch_size):
+    blobs = database["blobs"]
+    images = database["images"]
+    moved = missing = 0
+    skip = 0
+    while True:
+        batch = await blobs.find(
+            {"path": {"$not": {"$regex": SHARDED_PATH_PATTERN}}}
+        ).skip(skip).limit(batch_size).to_list(length=None)
+        if not batch:
+            return moved, missing
+
+        for blob in batch:
+            target = sharded_path(directory, Path(blob["path"]).name)
+            if not await asyncio.to_thread(_move, blob["path"], target):
+                missing += 1
+                skip += 1
+                continue
+            for format in blob.get("renditions", {}):
+                await asyncio.to_thread(
+                    _move,
+                    rendition_key(blob["path"], format),
+                    rendition_key(str(target), format),
+                )
+            new_path = as_image_path(target)
+            await blobs.update_one({"_id": blob["_id"]}, {"$set": {"path": new_path}})
+            await images.update_many(
+                {"blob": blob["_id"]}, {"$set": {"image_path": new_path}}
+            )
+            moved += 1
+
+
+async def migrate_legacy_images(database, directory, batch_size):
+    """Images stored before content addressing own their file alone."""
+    images = database["images"]
+    moved = missing = 0
+    skip = 0
+    while True:
+        batch = await images.find(
+            {
+                "blob": None,
+                "image_path": {"$not": {"$regex": SHARDED_PATH_PATTERN}},
+            },
+            {"image_path": 1},
+        ).skip(skip).limit(batch_size).to_list(length=None)
+        if not batch:
+            return moved, missing
+
+        for image_data in batch:
+            target = sharded_path(directory, Path(image_data["image_path"]).name)
+            if not await asyncio.to_thread(_move, image_data["image_path"], target):
+                missing += 1
+                skip += 1
+                continue
+            await images.update_one(
+                {"_id": image_data["_id"]},
+                {"$set": {"image_path": as_image_path(target)}},
+            )
+            moved += 1
+
+
+async def migrate(database, directory, batch_size=MIGRATION_BATCH_SIZE):
+    """Move flat files into the sharded layout, returns counts per kind."""
+    blobs_moved, blobs_missing = await migrate_blobs(
+        database, directory, batch_size
+    )
+    legacy_moved, legacy_missing = await migrate_legacy_images(
+        database, directory, batch_size
+    )
+    return {
+        "blobs_moved": blobs_moved,
+        "legacy_moved": legacy_moved,
+        "missing_files": blobs_missing + legacy_missing,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Move images into the sharded layout."
+    )
+    parser.add_argument("--directory", default="images")
+    parser.add_argument("--batch-size", type=int, default=MIGRATION_BATCH_SIZE)
+    options = parser.parse_args()
+
+    client = db.create_client()
+    try:
+        counts = await migrate(
+            client[db.db_name], options.directory, options.batch_size
+        )
+        print(
+            f"{counts['blobs_moved']} files and {counts['legacy_moved']} legacy "
+            f"images moved, {counts['missing_files']} files missing"
+        )
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,137 @@
+"""
+Prometheus metrics served at ``GET /metrics``.
+
+Request latency, sizes and in-flight counts are collected by middleware,
+MongoDB and filesystem timings by the repository and storage layers. With
+several workers, set ``PROMETHEUS_MULTIPROC_DIR`` to an empty directory so a
+scrape sees all of them instead of whichever worker answered.
+"""
+import os
+import shutil
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+MULTIPROC_DIRECTORY = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+if MULTIPROC_DIRECTORY:
+    # Sample files are created as soon as the metrics below are.
+    os.makedirs(MULTIPROC_DIRECTORY, exist_ok=True)
+
+# Seconds, from a cached search to a large upload.
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+# Bytes, from thumbnails to MAX_UPLOAD_SIZE.
+SIZE_BUCKETS = tuple(2**n for n in range(10, 26, 2))
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Request latency per route.",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "http_requests_in_flight",
+    "Requests being handled.",
+    multiprocess_mode="livesum",
+)
+RECEIVED_BYTES = Counter(
+    "http_received_bytes", "Request body bytes received per route.", ["route"]
+)
+SERVED_BYTES = Counter(
+    "http_served_bytes", "Response body bytes sent per route.", ["route"]
+)
+UPLOAD_BYTES = Histogram(
+    "image_upload_size_bytes",
+    "Size of uploaded image files.",
+    ["route"],
+    buckets=SIZE_BUCKETS,
+)
+MONGO_SECONDS = Histogram(
+    "mongo_operation_duration_seconds",
+    "MongoDB call latency per operation.",
+    ["operation"],
+    buckets=LATENCY_BUCKETS,
+)
+STORAGE_SECONDS = Histogram(
+    "storage_operation_duration_seconds",
+    "Filesystem call latency per operation, including the wait for a thread.",
+    ["operation"],
+    buckets=LATENCY_BUCKETS,
+)
+GC_REMOVED = Counter(
+    "gc_removed",
+    "Deleted images, their files and orphaned files removed by the collector.",
+    ["kind"],
+)
+GC_FAILURES = Counter("gc_failures", "File removals the collector has to retry.")
+
+
+def route_label(request):
+    # The route pattern rather than the path keeps the label set bounded.
+    return request.route.path if request.route else "unmatched"
+
+
+def observe_upload(request, size):
+    UPLOAD_BYTES.labels(route_label(request)).observe(size)
+
+
+def observe_served(request, size):
+    SERVED_BYTES.labels(route_label(request)).inc(size)
+
+
+# Content type of what render() returns.
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+
+def render():
+    if MULTIPROC_DIRECTORY:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
+
+
+def setup(app):
+    @app.main_process_start
+    async def clear_multiprocess_directory(app):
+        # Samples of a previous run would be added to this one's.
+        if MULTIPROC_DIRECTORY:
+            shutil.rmtree(MULTIPROC_DIRECTORY, ignore_errors=True)
+            os.makedirs(MULTIPROC_DIRECTORY, exist_ok=True)
+
+    @app.after_server_stop
+    async def mark_worker_dead(app):
+        if MULTIPROC_DIRECTORY:
+            multiprocess.mark_process_dead(os.getpid())
+
+    @app.on_request
+    async def start_request_timer(request):
+        request.ctx.started = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc()
+
+    @app.on_response
+    async def observe_request(request, response):
+        started = getattr(request.ctx, "started", None)
+        if started is None:
+            return
+        REQUESTS_IN_FLIGHT.dec()
+        route = route_label(request)
+        REQUEST_SECONDS.labels(request.method, route, response.status).observe(
+            time.perf_counter() - started
+        )
+        received = int(request.headers.get("content-length") or 0)
+        if received:
+            RECEIVED_BYTES.labels(route).inc(received)
+        if response.body:
+            SERVED_BYTES.labels(route).inc(len(response.body))
@@ -0,0 +1,96 @@
+"""
+Keyset pagination for image searches.
+
+Results are ordered by ``_id``. A page ends with an opaque ``next_cursor``
+holding the last ``_id`` returned, and the next page starts right after it,
+so every page costs the same index seek no matter how deep it is.
+"""
+import base64
+import json
+import os
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+# How total_count is computed:
+#   exact  - counted next to the page query, both run concurrently
+#   single - page and count from one $facet aggregation round trip
+#   cached - exact count, remembered per query for COUNT_CACHE_TTL seconds
+#   none   - not computed, total_count is null
+COUNT_MODES = ("exact", "single", "cached", "none")
+
+COUNT_CACHE_TTL = float(os.getenv("COUNT_CACHE_TTL", "30"))
+COUNT_CACHE_SIZE = int(os.getenv("COUNT_CACHE_SIZE", "1024"))
+
+SORT = [("_id", 1)]
+
+
+def encode_payload(payload):
+    data = json.dumps(payload).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def decode_payload(cursor):
+    """Decode an opaque cursor into its dict, ValueError if malformed."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(payload, dict):
+        raise ValueError("Invalid cursor")
+    return payload
+
+
+def encode_cursor(last_id):
+    return encode_payload({"after": str(last_id)})
+
+
+def decode_cursor(cursor):
+    """Return the ``_id`` a cursor points after, ValueError if malformed."""
+    payload = decode_payload(cursor)
+    try:
+        return ObjectId(payload["after"])
+    except (TypeError, KeyError, InvalidId):
+        raise ValueError("Invalid cursor")
+
+
+def after(query, last_id):
+    condition = {"_id": {"$gt": last_id}}
+    if not query:
+        return condition
+    return {"$and": [query, condition]}
+
+
+def facet_pipeline(query, last_id, skip, limit, projection):
+    """Page and total count of ``query`` in a single aggregation."""
+    page = []
+    if last_id is not None:
+        page.append({"$match": {"_id": {"$gt": last_id}}})
+    page.append({"$sort": dict(SORT)})
+    if skip:
+        page.append({"$skip": skip})
+    page += [{"$limit": limit}, {"$project": projection}]
+    return [
+        {"$match": query},
+        {"$facet": {"results": page, "total": [{"$count": "count"}]}},
+    ]
+
+
+def split_page(documents, page_size):
+    """
+    Turn ``page_size + 1`` fetched documents into (results, next_cursor).
+
+    The extra document only tells whether another page exists.
+    """
+    next_cursor = None
+    if len(documents) > page_size:
+        documents = documents[:page_size]
+        next_cursor = encode_cursor(documents[-1]["_id"])
+    for document in documents:
+        document.pop("_id", None)
+    return documents, next_cursor
+
+
+def count_key(query):
+    return json.dumps(query, sort_keys=True, default=str)
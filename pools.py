@@ -0,0 +1,26 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Threads per server worker for CPU heavy image work. Pillow releases the GIL
+# while decoding, resizing and encoding, so they run in parallel.
+IMAGE_POOL_THREADS = int(os.getenv("IMAGE_POOL_THREADS", "2"))
+
+
+def setup(app):
+    """Give every server worker its own thread pool for image work."""
+
+    @app.before_server_start
+    async def start_image_pool(app):
+        app.ctx.image_pool = ThreadPoolExecutor(
+            IMAGE_POOL_THREADS, thread_name_prefix="image"
+        )
+
+    @app.after_server_stop
+    async def stop_image_pool(app):
+        app.ctx.image_pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def run_in_pool(app, func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(app.ctx.image_pool, func, *args)
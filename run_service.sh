@@ -3,5 +3,8 @@ sudo docker system prune -f
 
 sudo docker image build -f dockerfile -t image_server:1.0 .
 
+# Server workers, 0 for one per CPU core
+export WORKERS=${WORKERS:-0}
+
 sudo docker-compose down
-sudo docker-compose up -d
+sudo -E docker-compose up -d
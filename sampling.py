@@ -0,0 +1,138 @@
+"""
+Random selection for ``is_random`` searches.
+
+Without a seed, MongoDB's ``$sample`` picks uniformly from the whole matched
+set in one aggregation. Without a query it is the first stage, so MongoDB
+reads random documents instead of scanning the collection; it draws a few
+more than asked since tombstones are only dropped after it.
+
+With a seed, every image document carries a random key ``rand`` in [0, 1)
+set once on insert. The seed keys a hash of it, ``frac(rand * multiplier +
+offset)`` with both derived from the seed, and results are sorted on that.
+The order stays the same for the same seed, so it can be paged like any
+other search, and different seeds give unrelated orders rather than
+rotations of one. Each page sorts the matched set in MongoDB, keeping only
+the top of it in memory.
+"""
+import hashlib
+import random
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import UpdateOne
+
+import pagination
+
+# Seeded pages are sorted on this computed field, then _id.
+ORDER_FIELD = "seed_order"
+# Multipliers this large move neighbouring keys far apart in every order.
+SEED_MULTIPLIERS = (2**20, 2**21)
+BACKFILL_BATCH_SIZE = 500
+# Unfiltered samples draw this many times the wanted size, room for tombstones.
+SAMPLE_OVERSAMPLING = 2
+
+
+def random_key():
+    return random.random()
+
+
+def seed_order(seed):
+    """The multiplier and offset of the random order of ``seed``."""
+    digest = hashlib.sha256(str(seed).encode()).digest()
+    low, high = SEED_MULTIPLIERS
+    multiplier = low + int.from_bytes(digest[:8], "big") % (high - low)
+    offset = int.from_bytes(digest[8:15], "big") / 2**56
+    return multiplier, offset
+
+
+def _order_key(seed):
+    multiplier, offset = seed_order(seed)
+    return {"$mod": [{"$add": [{"$multiply": ["$rand", multiplier]}, offset]}, 1]}
+
+
+def _after_key(key, last_id):
+    return {
+        "$or": [
+            {ORDER_FIELD: {"$gt": key}},
+            {ORDER_FIELD: key, "_id": {"$gt": last_id}},
+        ]
+    }
+
+
+def encode_position(document):
+    return pagination.encode_payload(
+        {"k": document[ORDER_FIELD], "i": str(document["_id"])}
+    )
+
+
+def decode_position(cursor):
+    payload = pagination.decode_payload(cursor)
+    try:
+        return float(payload["k"]), ObjectId(payload["i"])
+    except (TypeError, ValueError, KeyError, InvalidId):
+        raise ValueError("Invalid cursor")
+
+
+async def sample(images, query, size, projection):
+    """``size`` documents drawn uniformly from everything matching ``query``."""
+    if query:
+        pipeline = [{"$match": query}, {"$sample": {"size": size}}]
+    else:
+        pipeline = [
+            {"$sample": {"size": size * SAMPLE_OVERSAMPLING}},
+            {"$limit": size},
+        ]
+    return await images.aggregate(pipeline + [{"$project": projection}])
+
+
+async def seeded_page(images, query, seed, position, skip, limit, projection):
+    """
+    One page of the random order given by ``seed``.
+
+    ``position`` is a decoded cursor or None to start from the beginning,
+    ``skip`` documents are skipped from there. Returns (documents,
+    next_cursor); documents keep ``_id`` and ``ORDER_FIELD`` so callers can
+    strip them.
+    """
+    pipeline = [{"$match": query}, {"$addFields": {ORDER_FIELD: _order_key(seed)}}]
+    if position:
+        pipeline.append({"$match": _after_key(*position)})
+    pipeline.append({"$sort": {ORDER_FIELD: 1, "_id": 1}})
+    if skip:
+        pipeline.append({"$skip": skip})
+    # One extra document tells whether there is a next page.
+    pipeline += [{"$limit": limit + 1}, {"$project": projection}]
+
+    documents = await images.aggregate(pipeline)
+    next_cursor = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        next_cursor = encode_position(documents[-1])
+    return documents, next_cursor
+
+
+async def backfill(database, batch_size=BACKFILL_BATCH_SIZE):
+    """Give a random key to images stored before seeded sampling existed."""
+    images = database["images"]
+    updated = 0
+    while True:
+        batch = await images.find({"rand": {"$exists": False}}, {"_id": 1}).limit(
+            batch_size
+        ).to_list(length=None)
+        if not batch:
+            return updated
+
+        await images.bulk_write(
+            [
+                UpdateOne({"_id": image_data["_id"]}, {"$set": {"rand": random_key()}})
+                for image_data in batch
+            ],
+            ordered=False,
+        )
+        updated += len(batch)
+
+
+def setup(app):
+    @app.before_server_start
+    async def backfill_random_keys(app):
+        app.add_task(backfill(app.ctx.images.db))
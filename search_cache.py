@@ -0,0 +1,75 @@
+"""
+In-process cache of serialized search responses.
+
+Entries are keyed on the search criteria plus the paging arguments. Writes
+drop only the entries whose criteria match the info of a written document
+(before or after the change), every other cached page stays valid.
+Writes of other workers arrive through the image cache's feed.
+"""
+import os
+from typing import NamedTuple
+
+import caching
+import search_index
+
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "60"))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "10000"))
+SEARCH_CACHE_MAX_BYTES = int(
+    os.getenv("SEARCH_CACHE_MAX_BYTES", str(64 * 1024 * 1024))
+)
+
+
+class CachedSearch(NamedTuple):
+    criteria: dict
+    is_search_bar: bool
+    body: bytes
+
+
+class SearchCache(caching.TTLCache):
+    """
+    TTLCache of CachedSearch values bounded by entries and body bytes.
+
+    ``generation`` moves on with every invalidation, so a search that was
+    running while a write happened doesn't store its possibly stale result.
+    """
+
+    def __init__(self):
+        super().__init__(
+            SEARCH_CACHE_MAX_ENTRIES,
+            SEARCH_CACHE_TTL,
+            max_bytes=SEARCH_CACHE_MAX_BYTES,
+            sizeof=lambda cached: len(cached.body),
+        )
+        self.generation = 0
+
+    def store(self, key, generation, cached):
+        if generation == self.generation:
+            self.set(key, cached)
+
+    def invalidate(self, infos):
+        """
+        Drop the cached searches any of ``infos`` matches or matched, all of
+        them if ``infos`` is None.
+        """
+        self.generation += 1
+        if infos is None:
+            self.clear()
+            return
+        infos = list(infos)
+        if any(info is None for info in infos):
+            self.clear()
+            return
+        self.discard_where(
+            lambda cached: any(
+                search_index.matches(cached.criteria, cached.is_search_bar, info)
+                for info in infos
+            )
+        )
+
+
+def request_key(criteria, is_search_bar, **paging):
+    return (
+        tuple(sorted((field, value) for field, value in criteria.items() if value)),
+        is_search_bar,
+        tuple(sorted(paging.items())),
+    )
@@ -0,0 +1,186 @@
+"""
+N-gram search index for the text fields of image info.
+
+Every image document keeps a ``search`` sub-document with the character
+unigrams and bigrams of each searchable field, e.g. ``search.title``. A
+substring query becomes an ``$all`` over the query's n-grams on a multikey
+index, which narrows the candidates without scanning the collection; the
+original case-insensitive regex then runs only on those candidates. This
+works the same for CJK titles, where there are no word boundaries to split
+on.
+
+Run ``python search_index.py`` to create the indexes and backfill documents
+stored before the index existed.
+"""
+import asyncio
+import logging
+import re
+
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import OperationFailure
+
+import db
+import sampling
+
+logger = logging.getLogger(__name__)
+
+SEARCH_FIELDS = ("title", "name", "number", "business_type", "category")
+# Categories matched as a whole value instead of as a substring.
+EXACT_CATEGORIES = ("men-traditional-chinese",)
+
+BACKFILL_BATCH_SIZE = 500
+
+
+def normalize(value):
+    return str(value or "").casefold()
+
+
+def field_tokens(value):
+    """All unigrams and bigrams of a stored value."""
+    text = normalize(value)
+    tokens = set(text)
+    tokens.update(text[i : i + 2] for i in range(len(text) - 1))
+    return sorted(tokens)
+
+
+def query_tokens(value):
+    """The n-grams every value containing ``value`` must have."""
+    text = normalize(value)
+    if len(text) < 2:
+        return [text] if text else []
+    return sorted({text[i : i + 2] for i in range(len(text) - 1)})
+
+
+def search_document(info):
+    return {field: field_tokens(info.get(field, "")) for field in SEARCH_FIELDS}
+
+
+def substring_condition(field, value):
+    condition = {
+        f"info.{field}": {"$regex": re.escape(value), "$options": "i"},
+    }
+    tokens = query_tokens(value)
+    if tokens:
+        condition[f"search.{field}"] = {"$all": tokens}
+    return condition
+
+
+def build_query(criteria, is_search_bar=False):
+    """
+    Translate search criteria ({field: value}) into a MongoDB query.
+
+    The search bar matches any of title, name and number, otherwise every
+    given criterion has to match.
+    """
+    if is_search_bar:
+        or_conditions = [
+            substring_condition(field, criteria[field])
+            for field in ("title", "name", "number")
+            if criteria.get(field)
+        ]
+        return {"$or": or_conditions} if or_conditions else {}
+
+    query = {}
+    for field in SEARCH_FIELDS:
+        value = criteria.get(field)
+        if not value:
+            continue
+        if field == "category" and value in EXACT_CATEGORIES:
+            query[f"info.{field}"] = value
+        else:
+            query.update(substring_condition(field, value))
+    return query
+
+
+def matches(criteria, is_search_bar, info):
+    """
+    Whether ``info`` satisfies the criteria, mirroring build_query.
+
+    Used to find the cached searches a written document can affect.
+    """
+    def contains(field):
+        return normalize(criteria[field]) in normalize(info.get(field, ""))
+
+    if is_search_bar:
+        fields = [f for f in ("title", "name", "number") if criteria.get(f)]
+        return not fields or any(contains(field) for field in fields)
+
+    for field in SEARCH_FIELDS:
+        value = criteria.get(field)
+        if not value:
+            continue
+        if field == "category" and value in EXACT_CATEGORIES:
+            if info.get(field) != value:
+                return False
+        elif not contains(field):
+            return False
+    return True
+
+
+async def ensure_indexes(database):
+    images = database["images"]
+    indexes = [
+        ([("image_id", ASCENDING)], {"unique": True}),
+        ([("blob", ASCENDING)], {}),
+        ([("image_path", ASCENDING)], {}),
+        # Only tombstoned documents have the field, see db.LIVE.
+        ([("deleted_at", ASCENDING)], {"sparse": True}),
+        ([("info.category", ASCENDING)], {}),
+        ([("info.business_type", ASCENDING)], {}),
+    ] + [([(f"search.{field}", ASCENDING)], {}) for field in SEARCH_FIELDS]
+
+    for keys, options in indexes:
+        try:
+            await images.create_index(keys, **options)
+        except OperationFailure as e:
+            logger.warning(f"Could not create index {keys}: {e}")
+
+
+async def backfill(database, batch_size=BACKFILL_BATCH_SIZE):
+    """Add the search sub-document to images stored without one."""
+    images = database["images"]
+    updated = 0
+    while True:
+        batch = await images.find(
+            {"search": {"$exists": False}}, {"_id": 1, "info": 1}
+        ).limit(batch_size).to_list(length=None)
+        if not batch:
+            return updated
+
+        await images.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": image_data["_id"]},
+                    {"$set": {"search": search_document(image_data.get("info", {}))}},
+                )
+                for image_data in batch
+            ],
+            ordered=False,
+        )
+        updated += len(batch)
+
+
+def setup(app):
+    @app.before_server_start
+    async def create_search_indexes(app):
+        await ensure_indexes(app.ctx.images.db)
+        app.add_task(backfill(app.ctx.images.db))
+
+
+async def main():
+    client = db.create_client()
+    try:
+        database = client[db.db_name]
+        await ensure_indexes(database)
+        updated = await backfill(database)
+        randomized = await sampling.backfill(database)
+        print(
+            f"Indexes ready, {updated} documents tokenized, "
+            f"{randomized} given a random key"
+        )
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
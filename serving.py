@@ -0,0 +1,262 @@
+"""
+Sending image files, picking the cheapest way for each size.
+
+- small files (``HOT_FILE_MAX_BYTES``) are read in one go, and the ones
+  asked for repeatedly are kept in memory by ``HotFiles``, so hits never
+  touch the filesystem.
+- larger files are streamed in ``STREAM_CHUNK_BYTES`` chunks read on the
+  storage pool, the whole file is never held in memory.
+- behind nginx or Apache, ``SENDFILE_HEADER`` hands local files of at least
+  ``SENDFILE_MIN_BYTES`` to the proxy (``X-Accel-Redirect``/``X-Sendfile``),
+  which sends them zero-copy with sendfile.
+"""
+import os
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from mimetypes import guess_type
+from typing import NamedTuple
+
+from sanic.response import HTTPResponse, empty
+
+import caching
+import metrics
+
+# File names are unique per stored version, so a URL never changes content.
+IMAGE_CACHE_CONTROL = os.getenv(
+    "IMAGE_CACHE_CONTROL", "public, max-age=31536000, immutable"
+)
+# Files up to this size are sent from memory, and may be kept there.
+HOT_FILE_MAX_BYTES = int(os.getenv("HOT_FILE_MAX_BYTES", str(256 * 1024)))
+HOT_FILE_CACHE_MAX_BYTES = int(
+    os.getenv("HOT_FILE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))
+)
+# Deleted files stop being served from memory after this many seconds.
+HOT_FILE_CACHE_TTL = float(os.getenv("HOT_FILE_CACHE_TTL", "60"))
+# Requests within HOT_FILE_CACHE_TTL before a file is kept, so one-off
+# requests don't push out the files everybody asks for.
+HOT_FILE_ADMIT_AFTER = int(os.getenv("HOT_FILE_ADMIT_AFTER", "2"))
+STREAM_CHUNK_BYTES = int(os.getenv("STREAM_CHUNK_BYTES", str(512 * 1024)))
+# E.g. X-Accel-Redirect for nginx, X-Sendfile for Apache. Unset sends the
+# files from the server itself.
+SENDFILE_HEADER = os.getenv("SENDFILE_HEADER")
+# Put in front of the file key, an nginx internal location such as
+# "/protected-images/". Empty sends the absolute path, as X-Sendfile wants.
+SENDFILE_PREFIX = os.getenv("SENDFILE_PREFIX", "")
+SENDFILE_MIN_BYTES = int(os.getenv("SENDFILE_MIN_BYTES", str(1024 * 1024)))
+
+
+def etag_for(stat):
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def validator_headers(stat):
+    return {
+        "etag": etag_for(stat),
+        "last-modified": formatdate(stat.st_mtime, usegmt=True),
+        "cache-control": IMAGE_CACHE_CONTROL,
+        "accept-ranges": "bytes",
+    }
+
+
+def _etag_matches(header, etag):
+    if header.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison.
+    candidates = [tag.strip() for tag in header.split(",")]
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+def is_not_modified(request, stat):
+    """Evaluate If-None-Match, or If-Modified-Since when it is absent."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, etag_for(stat))
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(stat.st_mtime) <= since
+    return False
+
+
+class HotFile(NamedTuple):
+    body: bytes
+    stat: object
+
+
+class HotFiles(caching.TTLCache):
+    """
+    Size bounded LRU of the bytes and stat of small, popular files.
+
+    Keys are (backend, key) pairs. A file is only admitted once it was
+    asked for ``admit_after`` times, which ``seen`` counts.
+    """
+
+    def __init__(
+        self,
+        max_bytes=HOT_FILE_CACHE_MAX_BYTES,
+        ttl=HOT_FILE_CACHE_TTL,
+        admit_after=HOT_FILE_ADMIT_AFTER,
+    ):
+        super().__init__(
+            max(1, max_bytes // 1024),
+            ttl,
+            max_bytes=max_bytes,
+            sizeof=lambda hot: len(hot.body),
+        )
+        self.admit_after = admit_after
+        self.seen = caching.TTLCache(self.maxsize * 4, ttl)
+        self.admitted = 0
+
+    def lookup(self, files, key):
+        return self.get((files, key))
+
+    def peek(self, files, key):
+        """The cached file without counting a hit, None if absent or expired."""
+        entry = self.entries.get((files, key))
+        return entry[1] if entry and entry[0] >= time.monotonic() else None
+
+    def offer(self, files, key, body, stat):
+        """Count a read of ``key`` and keep it once it is hot enough."""
+        cache_key = (files, key)
+        seen = self.seen.get(cache_key, 0) + 1
+        if seen < self.admit_after:
+            self.seen.set(cache_key, seen)
+            return
+        self.seen.pop(cache_key)
+        self.set(cache_key, HotFile(body, stat))
+        self.admitted += 1
+
+    def stats(self):
+        return {**super().stats(), "admitted": self.admitted}
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header, size):
+    """
+    Parse a single ``bytes=`` range into an inclusive (start, end) pair.
+
+    Returns None for headers we don't handle (other units, several ranges),
+    which means the whole file is sent.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            # Suffix range: the last N bytes.
+            length = int(last)
+            if length <= 0:
+                raise RangeNotSatisfiable
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+
+    if start >= size or end < start:
+        raise RangeNotSatisfiable
+    return start, min(end, size - 1)
+
+
+def _range_for(request, stat):
+    header = request.headers.get("range")
+    if not header:
+        return None
+    # A stale If-Range means the client wants the whole new file.
+    if_range = request.headers.get("if-range")
+    if if_range and if_range.strip() != etag_for(stat):
+        return None
+    return parse_range(header, stat.st_size)
+
+
+async def stream(request, files, key, start, length, status, headers, content_type):
+    """Send ``length`` bytes of ``key`` from ``start``, a chunk at a time."""
+    headers["content-length"] = str(length)
+    response = await request.respond(
+        status=status, headers=headers, content_type=content_type
+    )
+    offset, end = start, start + length
+    while offset < end:
+        chunk = await files.read(key, offset, min(STREAM_CHUNK_BYTES, end - offset))
+        if not chunk:
+            # Truncated underneath us, the client sees a short response.
+            break
+        await response.send(chunk)
+        offset += len(chunk)
+    await response.eof()
+    # Streamed bodies aren't seen by the response middleware.
+    metrics.observe_served(request, offset - start)
+    return response
+
+
+def sendfile_response(local_path, key, headers, content_type):
+    """Let the proxy in front send the file, it also answers Range requests."""
+    target = SENDFILE_PREFIX + key if SENDFILE_PREFIX else os.path.abspath(local_path)
+    return HTTPResponse(
+        headers={**headers, SENDFILE_HEADER: target}, content_type=content_type
+    )
+
+
+async def serve_file(
+    request, files, key, stat=None, hot_files=None, extra_headers=None
+):
+    """
+    Send file ``key`` of the ``files`` backend with validators, answering
+    conditional and Range requests. With ``hot_files``, popular small
+    files are served from memory.
+    """
+    hot = hot_files.lookup(files, key) if hot_files else None
+    if hot:
+        stat = hot.stat
+    stat = stat or await files.stat(key)
+    headers = {**validator_headers(stat), **(extra_headers or {})}
+
+    if is_not_modified(request, stat):
+        return empty(status=304, headers=headers)
+
+    content_type = guess_type(key)[0] or "application/octet-stream"
+    local_path = files.local_path(key)
+    if SENDFILE_HEADER and local_path and stat.st_size >= SENDFILE_MIN_BYTES:
+        return sendfile_response(local_path, key, headers, content_type)
+
+    try:
+        byte_range = _range_for(request, stat)
+    except RangeNotSatisfiable:
+        return empty(
+            status=416, headers={"content-range": f"bytes */{stat.st_size}"}
+        )
+
+    status = 200
+    start, end = 0, stat.st_size - 1
+    if byte_range is not None:
+        status = 206
+        start, end = byte_range
+        headers["content-range"] = f"bytes {start}-{end}/{stat.st_size}"
+    length = end - start + 1
+
+    if hot:
+        body = hot.body[start : end + 1]
+    elif stat.st_size <= HOT_FILE_MAX_BYTES:
+        # Small files are read whole, also for a range, so they can be kept.
+        whole = await files.read(key)
+        if hot_files:
+            hot_files.offer(files, key, whole, stat)
+        body = whole[start : end + 1]
+    elif length <= HOT_FILE_MAX_BYTES:
+        body = await files.read(key, start, length)
+    else:
+        return await stream(
+            request, files, key, start, length, status, headers, content_type
+        )
+    return HTTPResponse(
+        body=body, status=status, headers=headers, content_type=content_type
+    )
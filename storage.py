@@ -0,0 +1,135 @@
+"""
+Filesystem access for request handlers.
+
+Every call runs on a small per-worker thread pool, so a slow or network
+mounted volume delays only the requests touching it instead of the whole
+event loop. Files are written to a temp file in the target's directory and
+renamed into place, readers never see a partially written image.
+"""
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Threads per server worker for blocking filesystem calls.
+STORAGE_IO_THREADS = int(os.getenv("STORAGE_IO_THREADS", "8"))
+# Operations slower than this are logged.
+STORAGE_SLOW_MS = float(os.getenv("STORAGE_SLOW_MS", "200"))
+
+
+class FileIO:
+    """Awaitable filesystem operations with per-operation timings."""
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.timings = {}
+
+    async def run(self, operation, func, *args):
+        """Run ``func(*args)`` on the pool, timed under ``operation``."""
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self.executor, func, *args)
+        finally:
+            self._record(operation, (time.perf_counter() - started) * 1000)
+
+    def _record(self, operation, elapsed_ms):
+        metrics.STORAGE_SECONDS.labels(operation).observe(elapsed_ms / 1000)
+        timing = self.timings.setdefault(
+            operation, {"count": 0, "total_ms": 0.0, "max_ms": 0.0}
+        )
+        timing["count"] += 1
+        timing["total_ms"] += elapsed_ms
+        timing["max_ms"] = max(timing["max_ms"], elapsed_ms)
+        if elapsed_ms > STORAGE_SLOW_MS:
+            logger.warning(f"Slow storage {operation}: {elapsed_ms:.0f} ms")
+
+    def stats(self):
+        return {
+            operation: {
+                "count": timing["count"],
+                "avg_ms": round(timing["total_ms"] / timing["count"], 3),
+                "max_ms": round(timing["max_ms"], 3),
+            }
+            for operation, timing in self.timings.items()
+        }
+
+    async def write_temp(self, directory, data, transform=None):
+        """
+        Write ``data`` to a new temp file in ``directory``.
+
+        Returns the temp path, or ``(temp_path, transform(data))`` when
+        ``transform`` is given so hashing can share the thread hop.
+        """
+        return await self.run("write", _write_temp, directory, data, transform)
+
+    async def open_temp(self, directory):
+        """Create a temp file in ``directory``, returns (file, temp_path)."""
+        fd, temp_path = await self.run(
+            "open", tempfile.mkstemp, ".upload", None, directory
+        )
+        return os.fdopen(fd, "wb"), temp_path
+
+    async def replace(self, source, target):
+        return await self.run("replace", os.replace, source, target)
+
+    async def remove(self, path):
+        """Remove ``path``, returns False if it did not exist."""
+        return await self.run("remove", _remove, path)
+
+    async def exists(self, path):
+        return await self.run("stat", os.path.exists, path)
+
+    async def stat(self, path):
+        return await self.run("stat", os.stat, path)
+
+    async def read_range(self, path, start, length):
+        return await self.run("read", _read_range, path, start, length)
+
+    async def mkdir(self, path):
+        return await self.run("mkdir", os.makedirs, path, 0o777, True)
+
+
+def _write_temp(directory, data, transform):
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".upload")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    if transform is None:
+        return temp_path
+    return temp_path, transform(data)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def _read_range(path, start, length):
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read(length)
+
+
+def setup(app):
+    @app.before_server_start
+    async def start_storage_pool(app):
+        app.ctx.storage = FileIO(
+            ThreadPoolExecutor(STORAGE_IO_THREADS, thread_name_prefix="storage")
+        )
+
+    @app.after_server_stop
+    async def stop_storage_pool(app):
+        app.ctx.storage.executor.shutdown(wait=False)
@@ -0,0 +1,328 @@
+"""
+WebP and AVIF renditions of uploaded images, made in the background.
+
+Uploads answer as soon as the original is stored. Its blob is queued and
+encoded once per format in the image pool, and each rendition that comes
+out smaller than the original is stored next to it as ``<key>.<format>``,
+e.g. ``ab/cd/<sha256>.jpg.avif``. Renditions belong to the blob, images with
+the same bytes share them and they are removed with its last reference.
+The blob and its image documents record them as ``renditions``, the size of
+each format kept.
+
+Blobs without ``renditions`` are the queue. A worker claims a blob with
+``transcoding_at`` before encoding it, so no blob is encoded twice at once,
+and every ``TRANSCODE_SWEEP_INTERVAL`` each worker picks up blobs nobody
+queued, left by a worker that died or stored before renditions existed.
+
+``get_image`` sends the smallest rendition the client lists in ``Accept``
+instead of the original, with ``Vary: Accept``.
+"""
+import asyncio
+import datetime
+import logging
+import os
+import uuid
+from pathlib import Path
+
+from PIL import Image, UnidentifiedImageError
+from pymongo import ReturnDocument
+
+import caching
+import imaging
+import layout
+
+logger = logging.getLogger(__name__)
+
+MEDIA_TYPES = {"avif": "image/avif", "webp": "image/webp"}
+FORMATS_BY_MEDIA_TYPE = {media_type: name for name, media_type in MEDIA_TYPES.items()}
+# Formats to make, in the order they are encoded. Those this Pillow can't
+# encode are left out, an empty value disables transcoding.
+TRANSCODE_FORMATS = [
+    name
+    for name in os.getenv("TRANSCODE_FORMATS", "avif,webp").lower().split(",")
+    if name in MEDIA_TYPES and name in imaging.FORMATS
+]
+TRANSCODE_QUALITY = int(os.getenv("TRANSCODE_QUALITY", "75"))
+# Blobs encoded at the same time per worker, each takes a thread.
+TRANSCODE_CONCURRENCY = int(os.getenv("TRANSCODE_CONCURRENCY", "1"))
+# Seconds between sweeps for blobs nobody queued, 0 disables them.
+TRANSCODE_SWEEP_INTERVAL = float(os.getenv("TRANSCODE_SWEEP_INTERVAL", "60"))
+# A claim not finished after this many seconds is taken over.
+TRANSCODE_CLAIM_SECONDS = int(os.getenv("TRANSCODE_CLAIM_SECONDS", "300"))
+TRANSCODE_QUEUE_SIZE = int(os.getenv("TRANSCODE_QUEUE_SIZE", "1000"))
+# Renditions of a blob never change once recorded, blobs still waiting for
+# them are looked up again after RENDITION_PENDING_TTL.
+RENDITION_CACHE_TTL = float(os.getenv("RENDITION_CACHE_TTL", "3600"))
+RENDITION_PENDING_TTL = float(os.getenv("RENDITION_PENDING_TTL", "10"))
+RENDITION_CACHE_MAX_ENTRIES = int(os.getenv("RENDITION_CACHE_MAX_ENTRIES", "10000"))
+
+# Sent with every original, the bytes depend on Accept.
+VARY_HEADERS = {"vary": "Accept"}
+
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def accepted_formats(accept):
+    """
+    The rendition formats an ``Accept`` header names with a non-zero
+    quality. Wildcards don't count, many clients that send ``*/*`` can't
+    decode AVIF.
+    """
+    formats = set()
+    for part in (accept or "").split(","):
+        media_type, *params = part.split(";")
+        name = FORMATS_BY_MEDIA_TYPE.get(media_type.strip().lower())
+        if name is None:
+            continue
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        if quality > 0:
+            formats.add(name)
+    return formats
+
+
+def blob_of(key):
+    """The blob id a stored key belongs to, its sha256 for blobs."""
+    return Path(key).name.split(".")[0]
+
+
+class Transcoder:
+    """
+    Makes the renditions of queued blobs, and tells ``get_image`` which
+    ones a blob has.
+
+    ``run_in_pool(func, *args)`` runs the encoder, ``image_cache`` is
+    told about image documents that got renditions.
+    """
+
+    def __init__(
+        self,
+        database,
+        files,
+        blobs,
+        image_cache,
+        run_in_pool,
+        formats=TRANSCODE_FORMATS,
+    ):
+        self.images = database["images"]
+        self.blob_collection = database["blobs"]
+        self.files = files
+        self.blobs = blobs
+        self.image_cache = image_cache
+        self.run_in_pool = run_in_pool
+        self.formats = list(formats)
+        self.queue = asyncio.Queue(TRANSCODE_QUEUE_SIZE)
+        self.queued = set()
+        self.renditions = caching.TTLCache(
+            RENDITION_CACHE_MAX_ENTRIES, RENDITION_CACHE_TTL
+        )
+        self.transcoded = self.failed = 0
+
+    def enqueue(self, sha256):
+        """Queue a blob, a full queue leaves it to the sweep."""
+        if not self.formats or not sha256 or sha256 in self.queued:
+            return
+        try:
+            self.queue.put_nowait(sha256)
+        except asyncio.QueueFull:
+            return
+        self.queued.add(sha256)
+
+    def _unclaimed(self):
+        expired = utcnow() - datetime.timedelta(seconds=TRANSCODE_CLAIM_SECONDS)
+        return {
+            "renditions": {"$exists": False},
+            "refs": {"$gt": 0},
+            "$or": [
+                {"transcoding_at": {"$exists": False}},
+                {"transcoding_at": {"$lt": expired}},
+            ],
+        }
+
+    async def claim(self, sha256):
+        """Take a blob to encode, returns its document or None."""
+        return await self.blob_collection.find_one_and_update(
+            {"_id": sha256, **self._unclaimed()},
+            {"$set": {"transcoding_at": utcnow()}},
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def transcode(self, sha256):
+        """
+        Make the renditions of one blob. Returns the sizes of those kept,
+        None when the blob was done already or claimed by another worker.
+        """
+        blob = await self.claim(sha256)
+        if blob is None:
+            # Uploads of bytes stored before share the renditions made then.
+            done = await self.blob_collection.find_one(
+                {"_id": sha256}, {"renditions": 1}
+            )
+            if done and "renditions" in done:
+                await self._record_on_images(sha256, done["renditions"])
+            return None
+
+        key = self.blobs.key_for(blob["path"])
+        formats = [name for name in self.formats if not key.endswith(f".{name}")]
+        target_prefix = os.path.join(self.blobs.temp_directory, uuid.uuid4().hex)
+        try:
+            async with self.files.local_file(key) as source_path:
+                encoded = await self.run_in_pool(
+                    imaging.transcode,
+                    str(source_path),
+                    target_prefix,
+                    formats,
+                    TRANSCODE_QUALITY,
+                )
+        except (
+            FileNotFoundError,
+            UnidentifiedImageError,
+            Image.DecompressionBombError,
+        ) as e:
+            # Not worth trying again, the original is served as it is.
+            logger.info(f"No renditions for blob {sha256}: {e}")
+            await self._finish(blob, {}, error=str(e))
+            return {}
+
+        renditions = {}
+        try:
+            for name, temp_path, size in encoded:
+                if size < blob["size"]:
+                    await self.files.put_file(
+                        temp_path, layout.rendition_key(key, name)
+                    )
+                    renditions[name] = size
+        finally:
+            for name, temp_path, _ in encoded:
+                if name not in renditions:
+                    await self.blobs.storage.remove(temp_path)
+
+        if not await self._finish(blob, renditions):
+            # Released while it was encoded, nothing else removes these.
+            if await self.blob_collection.find_one({"_id": sha256}) is None:
+                for name in renditions:
+                    await self.files.delete(layout.rendition_key(key, name))
+            return None
+        await self._record_on_images(sha256, renditions)
+        self.transcoded += 1
+        return renditions
+
+    async def _finish(self, blob, renditions, error=None):
+        """Record the renditions under our claim, False if it was lost."""
+        update = {"$set": {"renditions": renditions}, "$unset": {"transcoding_at": ""}}
+        if error:
+            update["$set"]["transcode_error"] = error
+        result = await self.blob_collection.update_one(
+            {"_id": blob["_id"], "transcoding_at": blob["transcoding_at"]}, update
+        )
+        return bool(result.matched_count)
+
+    async def _record_on_images(self, sha256, renditions):
+        stale = await self.images.find(
+            {"blob": sha256, "renditions": {"$ne": renditions}}, {"image_id": 1}
+        ).to_list(length=None)
+        if not stale:
+            return
+        await self.images.update_many(
+            {"_id": {"$in": [image_data["_id"] for image_data in stale]}},
+            {"$set": {"renditions": renditions}},
+        )
+        await self.image_cache.publish(image_data["image_id"] for image_data in stale)
+
+    async def run(self):
+        """Encode queued blobs until cancelled."""
+        while True:
+            sha256 = await self.queue.get()
+            self.queued.discard(sha256)
+            try:
+                await self.transcode(sha256)
+            except Exception:
+                # The claim expires and a later sweep tries again.
+                logger.exception(f"Transcoding blob {sha256} failed")
+                self.failed += 1
+
+    async def sweep(self):
+        """Queue blobs nobody is encoding, returns how many."""
+        free = self.queue.maxsize - self.queue.qsize()
+        if not self.formats or free <= 0:
+            return 0
+        due = await self.blob_collection.find(self._unclaimed(), {"_id": 1}).limit(
+            free
+        ).to_list(length=None)
+        for blob in due:
+            self.enqueue(blob["_id"])
+        return len(due)
+
+    async def sweep_forever(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception:
+                logger.exception("Transcoding sweep failed")
+            await asyncio.sleep(TRANSCODE_SWEEP_INTERVAL)
+
+    async def renditions_of(self, key):
+        """The rendition sizes by format of the file at ``key``, maybe empty."""
+        sha256 = blob_of(key)
+        renditions = self.renditions.get(sha256)
+        if renditions is not None:
+            return renditions
+        blob = await self.blob_collection.find_one({"_id": sha256}, {"renditions": 1})
+        if blob and "renditions" in blob:
+            renditions = blob["renditions"]
+            self.renditions.set(sha256, renditions)
+        else:
+            # Not encoded yet, or not a blob at all.
+            renditions = {}
+            self.renditions.set(sha256, renditions, RENDITION_PENDING_TTL)
+        return renditions
+
+    async def choose(self, key, size, accept):
+        """
+        The key of the smallest rendition of ``key`` the ``Accept`` header
+        allows, None when the original of ``size`` bytes is the best choice.
+        """
+        formats = accepted_formats(accept)
+        if not formats or not self.formats:
+            return None
+        renditions = await self.renditions_of(key)
+        candidates = [
+            (rendition_size, name)
+            for name, rendition_size in renditions.items()
+            if name in formats and rendition_size < size
+        ]
+        if not candidates:
+            return None
+        return layout.rendition_key(key, min(candidates)[1])
+
+    async def stats(self):
+        return {
+            "formats": self.formats,
+            "queued": self.queue.qsize(),
+            "transcoded": self.transcoded,
+            "failed": self.failed,
+            "backlog": await self.blob_collection.count_documents(
+                {"renditions": {"$exists": False}, "refs": {"$gt": 0}}
+            ),
+            "renditions_cache": self.renditions.stats(),
+        }
+
+
+def setup(app):
+    @app.after_server_start
+    async def start_transcoder(app):
+        transcoder = app.ctx.transcoder
+        if not transcoder.formats:
+            return
+        for number in range(TRANSCODE_CONCURRENCY):
+            app.add_task(transcoder.run(), name=f"transcoder-{number}")
+        if TRANSCODE_SWEEP_INTERVAL:
+            app.add_task(transcoder.sweep_forever(), name="transcoder-sweep")
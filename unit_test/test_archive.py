@@ -0,0 +1,159 @@
+import io
+import tarfile
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from mongomock_motor import AsyncMongoMockClient
+
+import archive
+import backends
+import blobs
+import db
+import facets
+import storage
+
+
+class Site:
+    """A database with its image directory."""
+
+    def __init__(self, executor):
+        self.directory = Path(tempfile.mkdtemp())
+        self.directory.joinpath(".tmp").mkdir()
+        self.storage = storage.FileIO(executor)
+        self.files = backends.LocalBackend(self.storage, str(self.directory))
+        self.database = AsyncMongoMockClient()["test"]
+        self.images = self.database["images"]
+        self.blobs = blobs.BlobStore(
+            self.database,
+            self.directory,
+            self.directory.joinpath(".tmp"),
+            self.storage,
+            self.files,
+        )
+
+    async def add_image(self, image_id, data, category="dress"):
+        sha256, path = await self.blobs.store_bytes(data, ".jpg")
+        await self.images.insert_one(
+            {
+                "image_id": image_id,
+                "image_path": path,
+                "blob": sha256,
+                "renditions": {"webp": 10},
+                "info": {"category": category},
+            }
+        )
+
+    async def read(self, image_id):
+        image_data = await self.images.find_one({"image_id": image_id})
+        return self.directory.joinpath(
+            self.blobs.key_for(image_data["image_path"])
+        ).read_bytes()
+
+    async def refs(self, data):
+        blob = await self.database["blobs"].find_one({"_id": blobs.sha256_hex(data)})
+        return blob["refs"]
+
+
+class TestArchive(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.executor = ThreadPoolExecutor(2)
+        self.source = Site(self.executor)
+        self.target = Site(self.executor)
+        await self.source.add_image("a", b"shared")
+        await self.source.add_image("b", b"other", "hat")
+        await self.source.add_image("c", b"shared")
+        # Stored before files were content addressed.
+        self.source.directory.joinpath("d.jpg").write_bytes(b"legacy")
+        await self.source.images.insert_one(
+            {"image_id": "d", "image_path": str(self.source.directory / "d.jpg")}
+        )
+        await self.source.add_image("deleted", b"gone")
+        await self.source.images.update_one(
+            {"image_id": "deleted"}, {"$set": {"deleted_at": 1}}
+        )
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    async def export(self):
+        out = io.BytesIO()
+        await archive.export_archive(
+            self.source.database,
+            self.source.files,
+            self.source.directory,
+            out,
+            self.source.storage,
+            batch_size=2,
+        )
+        return out.getvalue()
+
+    async def import_(self, data):
+        importer = archive.Importer(
+            self.target.database,
+            self.target.blobs,
+            self.target.files,
+            self.target.directory,
+            self.target.storage,
+        )
+        return await importer.run(io.BytesIO(data))
+
+    async def test_files_come_once_before_their_documents(self):
+        with tarfile.open(fileobj=io.BytesIO(await self.export())) as tar:
+            names = tar.getnames()
+        shared = "files/" + self.source.blobs.key_for(
+            self.source.blobs.path_for(blobs.sha256_hex(b"shared"), ".jpg")
+        )
+        self.assertEqual(names[0], archive.MANIFEST_NAME)
+        self.assertEqual(names[1], shared)
+        self.assertEqual(names.count(shared), 1)
+        self.assertEqual(
+            names[3:],
+            ["images/00000001.ndjson", "files/d.jpg", "images/00000002.ndjson"],
+        )
+
+    async def test_import_copies_the_catalog(self):
+        counts = await self.import_(await self.export())
+
+        self.assertEqual(counts, {"skipped": 0, "imported": 4})
+        self.assertEqual(await self.target.read("a"), b"shared")
+        self.assertEqual(await self.target.read("c"), b"shared")
+        self.assertEqual(await self.target.refs(b"shared"), 2)
+        self.assertEqual(await self.target.read("b"), b"other")
+        self.assertEqual(
+            self.target.directory.joinpath("d.jpg").read_bytes(), b"legacy"
+        )
+        self.assertIsNone(await self.target.images.find_one({"image_id": "deleted"}))
+        self.assertNotIn(
+            "renditions", await self.target.images.find_one({"image_id": "a"})
+        )
+        target_facets = facets.FacetCounts(db.ImageRepository(self.target.database))
+        self.assertEqual(
+            await target_facets.counts(),
+            {"category": {"dress": 2, "hat": 1}, "business_type": {}},
+        )
+        self.assertEqual(list(self.target.directory.joinpath(".tmp").iterdir()), [])
+
+    async def test_import_skips_present_images(self):
+        data = await self.export()
+        await self.target.add_image("a", b"shared")
+
+        self.assertEqual(await self.import_(data), {"skipped": 1, "imported": 3})
+        self.assertEqual(await self.target.refs(b"shared"), 2)
+        # Run again after an interruption.
+        self.assertEqual(await self.import_(data), {"skipped": 4})
+        self.assertEqual(await self.target.refs(b"shared"), 2)
+        self.assertEqual(list(self.target.directory.joinpath(".tmp").iterdir()), [])
+
+    async def test_files_not_matching_their_hash_are_not_imported(self):
+        await self.source.blobs.files.put_file(
+            await self.source.storage.write_temp(self.source.directory, b"bitrot"),
+            self.source.blobs.key_for(
+                self.source.blobs.path_for(blobs.sha256_hex(b"other"), ".jpg")
+            ),
+        )
+
+        counts = await self.import_(await self.export())
+        self.assertEqual(counts, {"skipped": 0, "missing_file": 1, "imported": 3})
+        self.assertIsNone(await self.target.images.find_one({"image_id": "b"}))
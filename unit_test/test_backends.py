@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import backends
+import storage
+
+try:
+    import boto3
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+
+class BackendContract:
+    """Behaviour every backend shares, run against each of them."""
+
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(2)
+        self.storage = storage.FileIO(self.executor)
+        self.directory = tempfile.mkdtemp()
+        self.files = self.create_backend()
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    async def put(self, key, data):
+        temp_path = await self.storage.write_temp(self.directory, data)
+        await self.files.put_file(temp_path, key)
+        self.assertFalse(os.path.exists(temp_path))
+
+    async def test_put_stat_read_delete(self):
+        await self.put("ab/cd/abcd.jpg", b"0123456789")
+        self.assertTrue(await self.files.exists("ab/cd/abcd.jpg"))
+        self.assertEqual((await self.files.stat("ab/cd/abcd.jpg")).st_size, 10)
+        self.assertEqual(await self.files.read("ab/cd/abcd.jpg"), b"0123456789")
+        self.assertEqual(await self.files.read("ab/cd/abcd.jpg", 2, 3), b"234")
+        await self.files.delete("ab/cd/abcd.jpg")
+        self.assertFalse(await self.files.exists("ab/cd/abcd.jpg"))
+
+    async def test_missing_key(self):
+        with self.assertRaises(FileNotFoundError):
+            await self.files.stat("missing.jpg")
+
+    async def test_local_file(self):
+        await self.put("a.png", b"png")
+        async with self.files.local_file("a.png") as path:
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), b"png")
+
+
+class TestLocalBackend(BackendContract, unittest.IsolatedAsyncioTestCase):
+    def create_backend(self):
+        return backends.LocalBackend(self.storage, tempfile.mkdtemp())
+
+    def test_no_presigned_url(self):
+        self.assertIsNone(self.files.presigned_url("a.png"))
+
+
+class TestMemoryBackend(BackendContract, unittest.IsolatedAsyncioTestCase):
+    def create_backend(self):
+        return backends.MemoryBackend(self.storage)
+
+
+@unittest.skipUnless(mock_aws, "needs boto3 and moto")
+class TestS3Backend(BackendContract, unittest.IsolatedAsyncioTestCase):
+    def create_backend(self):
+        self.mock = mock_aws()
+        self.mock.start()
+        client = boto3.client(
+            "s3",
+            region_name="us-east-1",
+            aws_access_key_id="test",
+            aws_secret_access_key="test",
+        )
+        client.create_bucket(Bucket="images")
+        return backends.S3Backend(
+            self.storage, bucket="images", prefix="test/", client=client
+        )
+
+    def tearDown(self):
+        self.mock.stop()
+        super().tearDown()
+
+    def test_presigned_url(self):
+        url = self.files.presigned_url("ab/cd/abcd.jpg")
+        self.assertIn("/test/ab/cd/abcd.jpg", url)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest import mock
+
+from mongomock_motor import AsyncMongoMockClient
+
+import backends
+import blobs
+import storage
+
+
+class TestBlobStore(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        self.executor = ThreadPoolExecutor(2)
+        self.storage = storage.FileIO(self.executor)
+        self.files = backends.LocalBackend(self.storage, str(self.directory))
+        self.database = AsyncMongoMockClient()["test"]
+        self.blobs = blobs.BlobStore(
+            self.database, self.directory, self.directory, self.storage, self.files
+        )
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    async def blob(self, sha256):
+        return await self.database["blobs"].find_one({"_id": sha256})
+
+    async def test_file_goes_with_its_last_reference(self):
+        sha256, path = await self.blobs.store_bytes(b"bytes", ".jpg")
+        await self.blobs.store_bytes(b"bytes", ".jpg")
+
+        await self.blobs.release(sha256)
+        self.assertTrue(os.path.exists(path))
+        await self.blobs.release(sha256)
+        self.assertFalse(os.path.exists(path))
+        self.assertIsNone(await self.blob(sha256))
+
+    async def test_upload_during_release_keeps_its_file(self):
+        sha256, path = await self.blobs.store_bytes(b"bytes", ".jpg")
+        delete = self.files.delete
+        uploads = []
+
+        async def racing_delete(key):
+            # The same bytes arrive after the blob was claimed for unlinking,
+            # before the file is gone.
+            uploads.append(
+                asyncio.ensure_future(self.blobs.store_bytes(b"bytes", ".jpg"))
+            )
+            await asyncio.sleep(0.2)
+            return await delete(key)
+
+        self.files.delete = racing_delete
+        await self.blobs.release(sha256)
+        self.assertEqual(await uploads[0], (sha256, path))
+
+        self.assertTrue(os.path.exists(path))
+        blob = await self.blob(sha256)
+        self.assertEqual(blob["refs"], 1)
+        self.assertNotIn("deleting", blob)
+
+    async def test_claimed_blob_is_not_claimed_twice(self):
+        sha256, _ = await self.blobs.store_bytes(b"bytes", ".jpg")
+        [release] = await self.blobs.unreference([sha256])
+        self.assertIsNone(await self.blobs.claim(sha256))
+
+        await self.blobs.finish_release(release)
+        self.assertIsNone(await self.blob(sha256))
+
+    async def test_stalled_release_is_taken_over(self):
+        sha256, path = await self.blobs.store_bytes(b"bytes", ".jpg")
+        # Never unlinked nor finished, as if the releasing worker died.
+        [release] = await self.blobs.unreference([sha256])
+
+        with mock.patch.object(blobs, "BLOB_RELEASE_TIMEOUT", 0.1):
+            await self.blobs.store_bytes(b"bytes", ".jpg")
+        self.assertNotIn("deleting", await self.blob(sha256))
+        # The late release leaves the new reference alone.
+        await self.blobs.finish_release(release)
+        self.assertEqual((await self.blob(sha256))["refs"], 1)
+        self.assertTrue(os.path.exists(path))
+
+    async def test_orphan_is_claimed_through_a_placeholder(self):
+        path = str(self.directory / "ab" / "cd" / "abcd.jpg")
+        release = await self.blobs.claim("abcd", path)
+        self.assertEqual(release.keys, ["ab/cd/abcd.jpg"])
+        self.assertIsNone(await self.blobs.claim("abcd", path))
+
+        await self.blobs.finish_release(release)
+        self.assertIsNone(await self.blob("abcd"))
+
+
+if __name__ == "__main__":
+    unittest.main()
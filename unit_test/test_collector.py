@@ -0,0 +1,155 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from mongomock_motor import AsyncMongoMockClient
+
+import backends
+import blobs
+import collector
+import db
+import storage
+
+
+class TestCollector(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        self.executor = ThreadPoolExecutor(2)
+        self.storage = storage.FileIO(self.executor)
+        self.files = backends.LocalBackend(self.storage, str(self.directory))
+        self.database = AsyncMongoMockClient()["test"]
+        self.images = db.ImageRepository(self.database)
+        self.blobs = blobs.BlobStore(
+            self.database, self.directory, self.directory, self.storage, self.files
+        )
+        self.collector = collector.Collector(
+            self.database, self.files, self.blobs, self.directory
+        )
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    async def add_image(self, image_id, data):
+        sha256, path = await self.blobs.store_bytes(data, ".jpg")
+        await self.images.insert_one(
+            {"image_id": image_id, "image_path": path, "blob": sha256}
+        )
+        return path
+
+    async def test_tombstones_are_hidden_then_collected(self):
+        shared = await self.add_image("a", b"shared")
+        await self.add_image("b", b"shared")
+        own = await self.add_image("c", b"own")
+
+        result = await self.images.mark_deleted({"image_id": {"$in": ["a", "c"]}})
+        self.assertEqual(result.modified_count, 2)
+        self.assertEqual(await self.images.count({}), 1)
+        self.assertIsNone(await self.images.find_one({"image_id": "a"}))
+        self.assertTrue(os.path.exists(own))
+
+        self.assertTrue(await self.collector.run_once())
+        self.assertTrue(os.path.exists(shared))
+        self.assertFalse(os.path.exists(own))
+        stats = await self.collector.stats()
+        self.assertEqual(stats["removed"]["images"], 2)
+        self.assertEqual(stats["backlog"]["images"], 0)
+
+    async def test_lease_is_exclusive(self):
+        other = collector.Collector(
+            self.database, self.files, self.blobs, self.directory
+        )
+        self.assertIsNotNone(await self.collector.acquire_lease())
+        self.assertIsNone(await other.acquire_lease())
+        self.assertIsNotNone(await self.collector.acquire_lease())
+
+    async def test_failed_unlink_is_retried(self):
+        path = await self.add_image("a", b"bytes")
+        await self.images.mark_deleted({"image_id": "a"})
+        delete = self.files.delete
+
+        async def failing_delete(key):
+            raise OSError("volume unavailable")
+
+        self.files.delete = failing_delete
+        await self.collector.collect_batch()
+        self.assertEqual((await self.collector.stats())["backlog"]["failed_files"], 1)
+
+        self.files.delete = delete
+        await self.database["gc_files"].update_many(
+            {}, {"$set": {"retry_at": collector.utcnow()}}
+        )
+        self.assertEqual(await self.collector.retry_failed(), 1)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual((await self.collector.stats())["backlog"]["failed_files"], 0)
+
+    async def test_reconcile_removes_old_orphans_only(self):
+        kept = await self.add_image("a", b"bytes")
+        orphan = self.directory.joinpath("ab", "cd", "abcdef.jpg")
+        recent = self.directory.joinpath("ab", "cd", "abcdeg.jpg")
+        orphan.parent.mkdir(parents=True)
+        orphan.write_bytes(b"x")
+        recent.write_bytes(b"x")
+        old = time.time() - collector.GC_ORPHAN_GRACE - 60
+        os.utime(orphan, (old, old))
+        os.utime(kept, (old, old))
+
+        await self.collector.acquire_lease()
+        self.assertEqual(await self.collector.reconcile(), 1)
+        self.assertFalse(orphan.exists())
+        self.assertTrue(recent.exists())
+        self.assertTrue(os.path.exists(kept))
+
+    def old_orphan(self, data):
+        """A file of ``data`` older than the grace period without a document."""
+        sha256 = blobs.sha256_hex(data)
+        path = self.directory.joinpath(
+            self.blobs.key_for(self.blobs.path_for(sha256, ".jpg"))
+        )
+        path.parent.mkdir(parents=True)
+        path.write_bytes(data)
+        old = time.time() - collector.GC_ORPHAN_GRACE - 60
+        os.utime(path, (old, old))
+        return sha256, path
+
+    async def test_reference_after_the_scan_keeps_the_file(self):
+        sha256, path = self.old_orphan(b"bytes")
+        referenced = self.collector._referenced
+
+        async def upload_after_scan(keys):
+            result = await referenced(keys)
+            await self.add_image("a", b"bytes")
+            return result
+
+        self.collector._referenced = upload_after_scan
+        await self.collector.acquire_lease()
+        self.assertEqual(await self.collector.reconcile(), 0)
+        self.assertTrue(path.exists())
+        self.assertEqual((await self.blobs.collection.find_one())["refs"], 1)
+
+    async def test_upload_during_orphan_unlink_keeps_its_file(self):
+        sha256, path = self.old_orphan(b"bytes")
+        delete = self.files.delete
+        uploads = []
+
+        async def racing_delete(key):
+            uploads.append(asyncio.ensure_future(self.add_image("a", b"bytes")))
+            await asyncio.sleep(0.2)
+            return await delete(key)
+
+        self.files.delete = racing_delete
+        await self.collector.acquire_lease()
+        self.assertEqual(await self.collector.reconcile(), 1)
+        await uploads[0]
+
+        self.assertTrue(path.exists())
+        blob = await self.blobs.collection.find_one({"_id": sha256})
+        self.assertEqual((blob["refs"], blob["size"]), (1, 5))
+        self.assertNotIn("deleting", blob)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest import mock
+
+import derivatives
+import storage
+
+
+def produce(size):
+    async def write(path):
+        Path(path).write_bytes(b"x" * size)
+        return size
+
+    return write
+
+
+class TestDerivativeCache(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        self.executor = ThreadPoolExecutor(2)
+        self.storage = storage.FileIO(self.executor)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    async def cache(self):
+        cache = derivatives.DerivativeCache(self.storage, self.directory, 10)
+        await cache.load()
+        return cache
+
+    def on_disk(self):
+        return sorted(path.name for path in self.directory.iterdir())
+
+    async def test_least_recently_used_goes_first(self):
+        cache = await self.cache()
+        await cache.get("a", produce(4))
+        await cache.get("b", produce(4))
+        await cache.get("a", produce(4))
+        await cache.get("c", produce(4))
+        self.assertEqual(self.on_disk(), ["a", "c"])
+
+    async def test_cap_holds_for_all_workers(self):
+        first, second = await self.cache(), await self.cache()
+        await first.get("a", produce(6))
+        # Within the scan interval each worker only counts its own renders.
+        await second.get("b", produce(6))
+        self.assertEqual(self.on_disk(), ["a", "b"])
+
+        with mock.patch.object(derivatives, "DERIVATIVE_CACHE_SCAN_INTERVAL", 0):
+            await second.get("c", produce(2))
+        self.assertEqual(self.on_disk(), ["b", "c"])
+        self.assertEqual(second.total_bytes, 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import datetime
+import unittest
+
+from mongomock_motor import AsyncMongoMockClient
+
+import db
+import facets
+
+
+def info(category, business_type="rent"):
+    return {"category": category, "business_type": business_type}
+
+
+class TestDeltas(unittest.TestCase):
+    def test_unchanged_values_cancel_out(self):
+        self.assertEqual(
+            facets.deltas([info("dress")], [info("hat")]),
+            {("category", "dress"): -1, ("category", "hat"): 1},
+        )
+
+    def test_missing_values_are_not_counted(self):
+        self.assertEqual(facets.deltas(added=[{}, None]), {})
+        self.assertEqual(facets.deltas(added=[info("", "")]), {})
+
+
+class TestFacetCounts(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.database = AsyncMongoMockClient()["test"]
+        self.images = db.ImageRepository(self.database)
+        self.facets = facets.FacetCounts(self.images)
+
+    async def add(self, image_id, image_info):
+        await self.images.insert_one({"image_id": image_id, "info": image_info})
+        await self.facets.apply(added=[image_info])
+
+    async def test_writes_move_the_counters(self):
+        await self.add("a", info("dress"))
+        await self.add("b", info("dress", "sell"))
+        await self.facets.apply([info("dress")], [info("hat")])
+
+        self.assertEqual(
+            await self.facets.counts(),
+            {
+                "category": {"dress": 1, "hat": 1},
+                "business_type": {"rent": 1, "sell": 1},
+            },
+        )
+        await self.facets.apply(removed=[info("hat"), info("dress", "sell")])
+        self.assertEqual(
+            await self.facets.counts(), {"category": {}, "business_type": {}}
+        )
+
+    async def test_rebuild_repairs_drift(self):
+        await self.add("a", info("dress"))
+        await self.add("b", info("dress"))
+        await self.images.insert_one({"image_id": "c", "info": info("hat")})
+        await self.facets.apply(added=[info("coat")])
+        await self.images.mark_deleted({"image_id": "b"})
+
+        self.assertEqual(await self.facets.rebuild(), 4)
+        self.assertEqual(
+            await self.facets.counts(),
+            {"category": {"dress": 1, "hat": 1}, "business_type": {"rent": 2}},
+        )
+        self.assertEqual(await self.facets.rebuild(), 0)
+
+    async def test_rebuild_keeps_writes_made_meanwhile(self):
+        await self.add("a", info("dress"))
+        await self.facets.apply(added=[info("coat")])
+        stored = self.facets._stored
+
+        async def racing_stored(field):
+            counters = await stored(field)
+            # Uploaded after the counters were read, before they are fixed.
+            await self.add(f"new {field}", info("hat", "sell"))
+            return counters
+
+        self.facets._stored = racing_stored
+        await self.facets.rebuild()
+        self.assertEqual(
+            await self.facets.counts(),
+            {
+                "category": {"dress": 1, "hat": 2},
+                "business_type": {"rent": 1, "sell": 2},
+            },
+        )
+        self.assertEqual(
+            await self.database["facets"].count_documents({"value": "coat"}), 0
+        )
+
+    async def test_one_worker_rebuilds_per_interval(self):
+        other = facets.FacetCounts(self.images)
+        self.assertTrue(await self.facets.claim_rebuild(3600))
+        self.assertFalse(await other.claim_rebuild(3600))
+        # Once the interval has passed.
+        await self.database["facets"].update_one(
+            {"_id": facets.REBUILD_ID},
+            {"$set": {"rebuilt_at": datetime.datetime(2000, 1, 1)}},
+        )
+        self.assertTrue(await other.claim_rebuild(3600))
@@ -0,0 +1,49 @@
+import unittest
+
+import fields
+
+INFO_FIELDS = ("title", "name", "content", "price")
+
+
+class TestParseFields(unittest.TestCase):
+    def test_absent_selects_everything(self):
+        self.assertIsNone(fields.parse_fields(None, INFO_FIELDS))
+        self.assertIsNone(fields.parse_fields(" , ", INFO_FIELDS))
+
+    def test_info_fields_are_nested(self):
+        self.assertEqual(
+            fields.parse_fields("image_id, title,info.price,title", INFO_FIELDS),
+            ("image_id", "info.price", "info.title"),
+        )
+
+    def test_whole_info_wins_over_its_fields(self):
+        self.assertEqual(fields.parse_fields("title,info", INFO_FIELDS), ("info",))
+
+    def test_unknown_and_internal_fields_are_rejected(self):
+        for value in ("search", "rand", "_id", "info.search", "bogus"):
+            with self.assertRaises(ValueError, msg=value):
+                fields.parse_fields(value, INFO_FIELDS)
+
+
+class TestProjection(unittest.TestCase):
+    def test_inclusion_projection(self):
+        paths = ("image_id", "info.title")
+        self.assertEqual(
+            fields.projection(paths),
+            {"image_id": 1, "info.title": 1, "_id": 0},
+        )
+        self.assertEqual(
+            fields.projection(paths, "_id", "rand"),
+            {"image_id": 1, "info.title": 1, "_id": 1, "rand": 1},
+        )
+
+    def test_select_keeps_the_document_shape(self):
+        document = {
+            "image_id": "a",
+            "image_path": "images/a.jpg",
+            "info": {"title": "t", "price": "1", "content": "long"},
+        }
+        self.assertEqual(
+            fields.select(document, ("image_id", "info.price", "version")),
+            {"image_id": "a", "info": {"price": "1"}},
+        )
@@ -0,0 +1,122 @@
+import unittest
+
+from mongomock_motor import AsyncMongoMockClient
+
+import db
+import image_cache
+
+
+class TestImageCache(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.images = db.ImageRepository(AsyncMongoMockClient()["test"])
+        await self.images.insert_one({"image_id": "a", "info": {"title": "t"}})
+        self.cache = image_cache.ImageCache(self.images)
+
+    async def test_lookup_is_cached(self):
+        document = await self.cache.find("a")
+        self.assertEqual(document["info"], {"title": "t"})
+        self.assertNotIn("_id", document)
+        self.assertIs(await self.cache.find("a"), document)
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+    async def test_missing_ids_are_cached_briefly(self):
+        self.assertIsNone(await self.cache.find("b"))
+        await self.images.insert_one({"image_id": "b"})
+        self.assertIsNone(await self.cache.find("b"))
+        self.cache.negative_ttl = 0
+        self.cache.invalidate(["b"])
+        self.assertIsNone(await self.cache.find("c"))
+        self.assertIsNotNone(await self.cache.find("b"))
+        self.assertIsNone(self.cache.get("c"))
+
+    async def test_change_events_drop_entries(self):
+        await self.cache.find("a")
+        object_id = (await self.images.find_one({"image_id": "a"}))["_id"]
+        self.cache.apply_change(
+            {"operationType": "update", "documentKey": {"_id": object_id}}
+        )
+        self.assertNotIn("a", self.cache.entries)
+        self.assertEqual(self.cache.object_ids, {})
+
+        self.assertIsNone(await self.cache.find("b"))
+        self.cache.apply_change(
+            {"operationType": "insert", "fullDocument": {"image_id": "b"}}
+        )
+        self.assertNotIn("b", self.cache.entries)
+
+    async def test_write_during_lookup_is_not_cached(self):
+        find_one = self.images.find_one
+
+        async def racing_find_one(*args):
+            document = await find_one(*args)
+            await self.cache.publish(["a"])
+            return document
+
+        self.images.find_one = racing_find_one
+        self.assertIsNotNone(await self.cache.find("a"))
+        self.assertNotIn("a", self.cache.entries)
+
+    async def test_listeners_hear_of_published_infos(self):
+        other = image_cache.ImageCache(self.images)
+        heard = []
+        self.cache.add_listener(heard.append)
+        # Document changes alone don't say which searches they touch.
+        self.cache.apply_change(
+            {"operationType": "insert", "fullDocument": {"info": {"title": "t"}}}
+        )
+        self.cache.apply_change({"operationType": "delete", "documentKey": {"_id": 1}})
+        self.assertEqual(heard, [])
+
+        for origin in (other.origin, self.cache.origin):
+            self.cache.apply_change(
+                {
+                    "operationType": "insert",
+                    "ns": {"db": "test", "coll": image_cache.EVENTS_COLLECTION},
+                    "fullDocument": {
+                        "origin": origin,
+                        "image_ids": ["a"],
+                        "infos": [{"title": "t"}],
+                    },
+                }
+            )
+        # Only the other worker's write, this one was handled when published.
+        self.assertEqual(heard, [[{"title": "t"}]])
+
+        self.cache.apply_change({"operationType": "drop", "ns": {"coll": "images"}})
+        self.assertEqual(heard, [[{"title": "t"}], None])
+
+    async def test_events_of_other_workers(self):
+        other = image_cache.ImageCache(self.images)
+        other.channel = "events"
+        heard = []
+        self.cache.add_listener(heard.append)
+        await self.cache.find("a")
+
+        await other.publish(["a"], [{"title": "t"}])
+        [event] = await self.images.db[image_cache.EVENTS_COLLECTION].find().to_list(
+            None
+        )
+        self.cache.apply_event(event)
+        self.assertNotIn("a", self.cache.entries)
+        self.assertEqual(heard, [[{"title": "t"}]])
+
+        # Its own events were applied when published.
+        other.add_listener(heard.append)
+        other.apply_event(event)
+        self.assertEqual(heard, [[{"title": "t"}]])
+
+        # Transcodes change no search.
+        self.cache.apply_event({"origin": other.origin, "image_ids": ["a"]})
+        self.assertEqual(len(heard), 1)
+
+    async def test_change_streams_only_get_events_with_infos(self):
+        events = self.images.db[image_cache.EVENTS_COLLECTION]
+        self.cache.channel = "change_stream"
+        await self.cache.publish(["a"])
+        self.assertEqual(await events.count_documents({}), 0)
+        await self.cache.publish(["a"], [{"title": "t"}])
+        self.assertEqual(await events.count_documents({}), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
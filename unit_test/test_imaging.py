@@ -0,0 +1,124 @@
+import os
+import tempfile
+import unittest
+
+from PIL import Image, UnidentifiedImageError
+
+import imaging
+
+IMAGE_FOLDER = os.path.join(os.path.dirname(__file__), "..", "test_images")
+
+
+class TestParseTransform(unittest.TestCase):
+    def test_no_transform_arguments(self):
+        self.assertIsNone(imaging.parse_transform({"details": "1"}, "a.jpg"))
+
+    def test_defaults_keep_source_format(self):
+        transform = imaging.parse_transform({"width": "120"}, "a.png")
+        self.assertEqual(transform, imaging.Transform(120, 0, "contain", 80, "PNG"))
+
+    def test_unencodable_source_falls_back_to_png(self):
+        transform = imaging.parse_transform({"height": "50"}, "a.gif")
+        self.assertEqual(transform.format, "PNG")
+
+    def test_invalid_arguments(self):
+        for args in (
+            {"width": "0"},
+            {"width": "abc"},
+            {"height": str(imaging.MAX_DIMENSION + 1)},
+            {"fit": "stretch"},
+            {"quality": "101"},
+            {"format": "tiff"},
+        ):
+            with self.assertRaises(ValueError, msg=args):
+                imaging.parse_transform(args, "a.jpg")
+
+
+class TestRender(unittest.TestCase):
+    def render(self, **args):
+        source = os.path.join(IMAGE_FOLDER, "4003_Ninomae-Inanis.png")
+        transform = imaging.parse_transform(args, source)
+        with tempfile.TemporaryDirectory() as directory:
+            target = os.path.join(directory, f"variant{transform.extension}")
+            size = imaging.render(source, target, tuple(transform))
+            self.assertEqual(size, os.path.getsize(target))
+            with Image.open(target) as image:
+                return image.format, image.size
+
+    def test_contain_keeps_aspect_ratio(self):
+        image_format, (width, height) = self.render(width="100", height="100")
+        self.assertEqual(image_format, "PNG")
+        self.assertEqual(max(width, height), 100)
+
+    def test_cover_fills_box(self):
+        self.assertEqual(
+            self.render(width="64", height="48", fit="cover", format="webp"),
+            ("WEBP", (64, 48)),
+        )
+
+    def test_never_upscales_in_contain(self):
+        with Image.open(os.path.join(IMAGE_FOLDER, "4003_Ninomae-Inanis.png")) as image:
+            original = image.size
+        _, size = self.render(width=str(original[0] * 2))
+        self.assertEqual(size, original)
+
+    def test_undecodable_source(self):
+        source = os.path.join(IMAGE_FOLDER, "4003_Ninomae-Inanis.png")
+        transform = imaging.parse_transform({"width": "10"}, source)
+        with tempfile.TemporaryDirectory() as directory:
+            truncated = os.path.join(directory, "truncated.png")
+            with open(source, "rb") as f:
+                data = f.read()
+            with open(truncated, "wb") as f:
+                f.write(data[: len(data) // 2])
+            for path in (truncated, __file__):
+                with self.assertRaises(imaging.DecodeError, msg=path):
+                    imaging.render(path, os.path.join(directory, "out"), transform)
+
+    def test_write_errors_are_not_decode_errors(self):
+        source = os.path.join(IMAGE_FOLDER, "4003_Ninomae-Inanis.png")
+        transform = imaging.parse_transform({"width": "10"}, source)
+        with tempfile.TemporaryDirectory() as directory:
+            target = os.path.join(directory, "missing", "out.png")
+            with self.assertRaises(FileNotFoundError):
+                imaging.render(source, target, transform)
+
+
+class TestAnalyze(unittest.TestCase):
+    def test_path_and_bytes_agree(self):
+        path = os.path.join(IMAGE_FOLDER, "channels4_profile.jpg")
+        analysis = imaging.analyze(path)
+        with open(path, "rb") as f:
+            self.assertEqual(imaging.analyze(f.read()), analysis)
+        self.assertEqual(
+            (analysis["width"], analysis["height"], analysis["format"]),
+            (900, 900, "jpeg"),
+        )
+        self.assertEqual(analysis["size"], os.path.getsize(path))
+        self.assertRegex(analysis["color"], "^#[0-9a-f]{6}$")
+        self.assertTrue(analysis["placeholder"].startswith("data:image/webp;base64,"))
+
+    def test_rotated_images_report_displayed_size(self):
+        image = Image.new("RGB", (40, 20), "red")
+        exif = image.getexif()
+        exif[0x0112] = 6
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "rotated.jpg")
+            image.save(path, exif=exif)
+            analysis = imaging.analyze(path)
+        self.assertEqual((analysis["width"], analysis["height"]), (20, 40))
+        self.assertGreater(int(analysis["color"][1:3], 16), 200)
+
+    def test_transparency_is_not_black(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "clear.png")
+            Image.new("RGBA", (8, 8), (0, 0, 0, 0)).save(path)
+            self.assertEqual(imaging.analyze(path)["color"], "#ffffff")
+
+    def test_not_an_image(self):
+        with self.assertRaises(UnidentifiedImageError):
+            imaging.analyze(b"not an image")
+
+
+if __name__ == "__main__":
+    unittest.main()
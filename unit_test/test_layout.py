@@ -0,0 +1,31 @@
+import unittest
+
+import layout
+
+NAME = "63c35d3b.jpg"
+
+
+class TestLayout(unittest.TestCase):
+    def test_sharded_path(self):
+        self.assertEqual(
+            layout.as_image_path(layout.sharded_path("images", NAME)),
+            "images/63/c3/63c35d3b.jpg",
+        )
+
+    def test_key_for(self):
+        self.assertEqual(
+            layout.key_for("images", "images/63/c3/63c35d3b.jpg"), "63/c3/63c35d3b.jpg"
+        )
+
+    def test_candidates_for_flat_and_sharded_names(self):
+        expected = ["63/c3/63c35d3b.jpg", "63c35d3b.jpg"]
+        self.assertEqual(layout.candidate_keys(NAME), expected)
+        self.assertEqual(layout.candidate_keys("63/c3/" + NAME), expected)
+
+    def test_candidates_reject_other_paths(self):
+        for image_name in ("../app.py", "ab/cd/" + NAME, "63/c3/../../x", ".gitkeep"):
+            self.assertEqual(layout.candidate_keys(image_name), [], image_name)
+
+
+if __name__ == "__main__":
+    unittest.main()
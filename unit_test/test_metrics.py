@@ -0,0 +1,32 @@
+import unittest
+
+from mongomock_motor import AsyncMongoMockClient
+from prometheus_client import REGISTRY
+
+import db
+import metrics
+
+
+def mongo_calls(operation):
+    return REGISTRY.get_sample_value(
+        "mongo_operation_duration_seconds_count", {"operation": operation}
+    )
+
+
+class TestRepositoryTimings(unittest.IsolatedAsyncioTestCase):
+    async def test_operations_are_timed(self):
+        images = db.ImageRepository(AsyncMongoMockClient()["test"])
+        before = mongo_calls("insert_one")
+        await images.insert_one({"image_id": "a"})
+        await images.count({})
+        self.assertEqual(mongo_calls("insert_one"), before + 1)
+        self.assertGreaterEqual(mongo_calls("count_documents"), 1)
+
+    def test_render_exposes_metrics(self):
+        text = metrics.render().decode()
+        self.assertIn("mongo_operation_duration_seconds", text)
+        self.assertIn("http_requests_in_flight", text)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+
+from bson import ObjectId
+
+import pagination
+
+
+class TestCursor(unittest.TestCase):
+    def test_round_trip(self):
+        last_id = ObjectId()
+        cursor = pagination.encode_cursor(last_id)
+        self.assertEqual(pagination.decode_cursor(cursor), last_id)
+
+    def test_invalid_cursor(self):
+        for cursor in ("", "garbage", pagination.encode_cursor("not-an-id")):
+            with self.assertRaises(ValueError, msg=cursor):
+                pagination.decode_cursor(cursor)
+
+
+class TestSplitPage(unittest.TestCase):
+    def test_extra_document_gives_next_cursor(self):
+        ids = [ObjectId() for _ in range(3)]
+        documents = [{"_id": i, "image_id": str(i)} for i in ids]
+        results, next_cursor = pagination.split_page(documents, 2)
+        self.assertEqual([r["image_id"] for r in results], [str(ids[0]), str(ids[1])])
+        self.assertNotIn("_id", results[0])
+        self.assertEqual(pagination.decode_cursor(next_cursor), ids[1])
+
+    def test_last_page_has_no_cursor(self):
+        results, next_cursor = pagination.split_page([{"_id": ObjectId()}], 2)
+        self.assertEqual(len(results), 1)
+        self.assertIsNone(next_cursor)
+
+
+class TestQueries(unittest.TestCase):
+    def test_after_keeps_query(self):
+        last_id = ObjectId()
+        self.assertEqual(pagination.after({}, last_id), {"_id": {"$gt": last_id}})
+        self.assertEqual(
+            pagination.after({"a": 1}, last_id),
+            {"$and": [{"a": 1}, {"_id": {"$gt": last_id}}]},
+        )
+
+    def test_facet_pipeline_counts_whole_query(self):
+        pipeline = pagination.facet_pipeline({"a": 1}, None, 50, 26, {"search": 0})
+        self.assertEqual(pipeline[0], {"$match": {"a": 1}})
+        facet = pipeline[1]["$facet"]
+        self.assertEqual(facet["total"], [{"$count": "count"}])
+        self.assertIn({"$skip": 50}, facet["results"])
+        self.assertIn({"$limit": 26}, facet["results"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+import unittest
+from random import Random
+
+from bson import ObjectId
+from mongomock_motor import AsyncMongoMockClient
+
+import db
+import sampling
+
+SEED = "spring"
+LIMIT = 4
+
+
+class TestSeedOrder(unittest.TestCase):
+    def test_stable_and_in_range(self):
+        self.assertEqual(sampling.seed_order(SEED), sampling.seed_order(SEED))
+        self.assertNotEqual(sampling.seed_order(SEED), sampling.seed_order("other"))
+        low, high = sampling.SEED_MULTIPLIERS
+        for seed in ("a", 1, SEED):
+            multiplier, offset = sampling.seed_order(seed)
+            self.assertTrue(low <= multiplier < high)
+            self.assertTrue(0 <= offset < 1)
+
+
+class TestSeededPage(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.images = db.ImageRepository(AsyncMongoMockClient()["test"])
+        random = Random(0)
+        # Ties broken by _id, and images the query doesn't match.
+        keys = [random.random() for _ in range(40)] + [0.5, 0.5]
+        self.documents = []
+        for i, rand in enumerate(keys):
+            category = "dress" if i % 4 else "hat"
+            self.documents.append(
+                {"_id": ObjectId(), "rand": rand, "category": category}
+            )
+        await self.images.insert_many(self.documents)
+        self.query = {"category": "dress"}
+
+    def expected(self, seed=SEED):
+        multiplier, offset = sampling.seed_order(seed)
+
+        def order(document):
+            return ((document["rand"] * multiplier + offset) % 1, document["_id"])
+
+        return [
+            document["_id"]
+            for document in sorted(self.documents, key=order)
+            if document["category"] == "dress"
+        ]
+
+    async def page(self, position=None, skip=0, seed=SEED):
+        documents, next_cursor = await sampling.seeded_page(
+            self.images, self.query, seed, position, skip, LIMIT, {"search": 0}
+        )
+        return [document["_id"] for document in documents], next_cursor
+
+    async def walk(self, seed=SEED):
+        walked, next_cursor = await self.page(seed=seed)
+        while next_cursor:
+            ids, next_cursor = await self.page(
+                sampling.decode_position(next_cursor), seed=seed
+            )
+            walked += ids
+        return walked
+
+    async def test_page_numbers_cover_every_image_once(self):
+        walked = []
+        for page_number in range(len(self.expected()) // LIMIT + 2):
+            ids, _ = await self.page(skip=page_number * LIMIT)
+            walked += ids
+        self.assertEqual(walked, self.expected())
+
+    async def test_cursors_cover_every_image_once(self):
+        self.assertEqual(await self.walk(), self.expected())
+
+    async def test_seeds_are_not_rotations_of_one_order(self):
+        first, second = await self.walk(), await self.walk("autumn")
+        self.assertEqual(sorted(first), sorted(second))
+        rotations = [first[i:] + first[:i] for i in range(len(first))]
+        self.assertNotIn(second, rotations)
+        self.assertNotIn(second[::-1], rotations)
+
+    async def test_cursor_past_the_last_image(self):
+        expected = self.expected()
+        walked, next_cursor = await self.page(skip=len(expected) - LIMIT)
+        self.assertEqual(walked, expected[-LIMIT:])
+        self.assertIsNone(next_cursor)
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(ValueError):
+            sampling.decode_position("garbage")
+
+
+class TestSample(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.images = db.ImageRepository(AsyncMongoMockClient()["test"])
+        await self.images.insert_many(
+            [{"image_id": str(i), "category": "dress"} for i in range(10)]
+            + [{"image_id": "deleted", "deleted_at": 1}]
+        )
+
+    async def test_unfiltered_sample_stays_first(self):
+        aggregate = self.images.collection.aggregate
+        pipelines = []
+
+        def recording_aggregate(pipeline, **kwargs):
+            pipelines.append(pipeline)
+            return aggregate(pipeline, **kwargs)
+
+        self.images.collection.aggregate = recording_aggregate
+        documents = await sampling.sample(self.images, {}, 20, {"_id": 0})
+        self.assertIn("$sample", pipelines[0][0])
+        self.assertEqual(pipelines[0][1], {"$match": db.LIVE})
+        self.assertEqual(len(documents), 10)
+        self.assertNotIn("deleted", [document["image_id"] for document in documents])
+
+        documents = await sampling.sample(self.images, {}, 3, {"_id": 0})
+        self.assertEqual(len(documents), 3)
+
+    async def test_filtered_sample(self):
+        documents = await sampling.sample(
+            self.images, {"category": "dress"}, 3, {"_id": 0}
+        )
+        self.assertEqual(len(documents), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+
+import search_cache
+import search_index
+from search_cache import CachedSearch, SearchCache
+
+
+def cache_search(cache, criteria, is_search_bar=False, **paging):
+    key = search_cache.request_key(criteria, is_search_bar, **paging)
+    cache.store(key, cache.generation, CachedSearch(criteria, is_search_bar, b"{}"))
+    return key
+
+
+class TestSearchCache(unittest.TestCase):
+    def test_key_ignores_empty_criteria(self):
+        self.assertEqual(
+            search_cache.request_key({"title": "cat", "name": ""}, False, page_size=25),
+            search_cache.request_key({"title": "cat"}, False, page_size=25),
+        )
+
+    def test_invalidate_drops_only_matching_searches(self):
+        cache = SearchCache()
+        cat = cache_search(cache, {"title": "cat"})
+        dog = cache_search(cache, {"title": "dog"})
+        cache.invalidate([{"title": "Black Cat"}])
+        self.assertIsNone(cache.get(cat))
+        self.assertIsNotNone(cache.get(dog))
+
+    def test_invalidate_without_info_clears(self):
+        cache = SearchCache()
+        key = cache_search(cache, {"title": "cat"})
+        cache.invalidate([None])
+        self.assertIsNone(cache.get(key))
+        key = cache_search(cache, {"title": "cat"})
+        cache.invalidate(None)
+        self.assertIsNone(cache.get(key))
+
+    def test_store_skips_results_older_than_a_write(self):
+        cache = SearchCache()
+        generation = cache.generation
+        cache.invalidate([{"title": "dog"}])
+        key = search_cache.request_key({"title": "cat"}, False)
+        cache.store(key, generation, CachedSearch({"title": "cat"}, False, b"{}"))
+        self.assertIsNone(cache.get(key))
+
+    def test_max_bytes_evicts_least_recently_used(self):
+        cache = SearchCache()
+        cache.max_bytes = 5
+        for key in ("a", "b"):
+            cache.set(key, CachedSearch({}, False, b"123"))
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("b"))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+
+class TestMatches(unittest.TestCase):
+    def test_search_bar_matches_any_field(self):
+        info = {"title": "x", "name": "Sunset.jpg", "number": ""}
+        self.assertTrue(
+            search_index.matches({"title": "a", "name": "sun"}, True, info)
+        )
+
+    def test_exact_category(self):
+        criteria = {"category": "men-traditional-chinese"}
+        info = {"category": "men-traditional-chinese-extra"}
+        self.assertFalse(search_index.matches(criteria, False, info))
+
+
+if __name__ == "__main__":
+    unittest.main()
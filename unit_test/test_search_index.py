@@ -0,0 +1,47 @@
+import unittest
+
+import search_index
+
+
+class TestTokens(unittest.TestCase):
+    def test_field_tokens_hold_unigrams_and_bigrams(self):
+        self.assertEqual(
+            search_index.field_tokens("鬼滅之刃"),
+            sorted(["鬼", "滅", "之", "刃", "鬼滅", "滅之", "之刃"]),
+        )
+
+    def test_query_tokens_are_subset_of_matching_values(self):
+        stored = set(search_index.field_tokens("Ninomae Ina'nis"))
+        for query in ("ina", "INA'N", "n", "e I"):
+            self.assertTrue(
+                set(search_index.query_tokens(query)) <= stored, msg=query
+            )
+
+    def test_empty_values(self):
+        self.assertEqual(search_index.field_tokens(None), [])
+        self.assertEqual(search_index.query_tokens(""), [])
+
+
+class TestBuildQuery(unittest.TestCase):
+    def test_criteria_are_combined(self):
+        query = search_index.build_query({"title": "鬼滅", "category": "anime"})
+        self.assertEqual(query["search.title"], {"$all": ["鬼滅"]})
+        self.assertEqual(query["info.title"]["$options"], "i")
+        self.assertIn("search.category", query)
+
+    def test_exact_category(self):
+        query = search_index.build_query({"category": "men-traditional-chinese"})
+        self.assertEqual(query, {"info.category": "men-traditional-chinese"})
+
+    def test_search_bar_uses_or(self):
+        query = search_index.build_query(
+            {"title": "a", "name": "b", "business_type": "rent"}, is_search_bar=True
+        )
+        self.assertEqual(len(query["$or"]), 2)
+
+    def test_search_bar_without_criteria_matches_everything(self):
+        self.assertEqual(search_index.build_query({}, is_search_bar=True), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+
+import serving
+
+
+class TestParseRange(unittest.TestCase):
+    def test_closed_range(self):
+        self.assertEqual(serving.parse_range("bytes=0-99", 1000), (0, 99))
+
+    def test_open_range(self):
+        self.assertEqual(serving.parse_range("bytes=900-", 1000), (900, 999))
+
+    def test_end_is_clamped(self):
+        self.assertEqual(serving.parse_range("bytes=900-5000", 1000), (900, 999))
+
+    def test_suffix_range(self):
+        self.assertEqual(serving.parse_range("bytes=-100", 1000), (900, 999))
+        self.assertEqual(serving.parse_range("bytes=-5000", 1000), (0, 999))
+
+    def test_unsupported_ranges_send_whole_file(self):
+        self.assertIsNone(serving.parse_range("items=0-1", 1000))
+        self.assertIsNone(serving.parse_range("bytes=0-1,5-6", 1000))
+        self.assertIsNone(serving.parse_range("bytes=a-b", 1000))
+
+    def test_unsatisfiable(self):
+        for header in ("bytes=1000-", "bytes=10-5", "bytes=-0"):
+            with self.assertRaises(serving.RangeNotSatisfiable, msg=header):
+                serving.parse_range(header, 1000)
+
+
+class TestEtag(unittest.TestCase):
+    def test_matches_list_and_weak_tags(self):
+        self.assertTrue(serving._etag_matches('"a", W/"b"', '"b"'))
+        self.assertTrue(serving._etag_matches("*", '"b"'))
+        self.assertFalse(serving._etag_matches('"a"', '"b"'))
+
+
+class TestHotFiles(unittest.TestCase):
+    def test_admitted_after_repeated_reads(self):
+        hot_files = serving.HotFiles(max_bytes=1024, ttl=60, admit_after=2)
+        hot_files.offer("files", "a.jpg", b"abc", "stat")
+        self.assertIsNone(hot_files.peek("files", "a.jpg"))
+        hot_files.offer("files", "a.jpg", b"abc", "stat")
+        self.assertEqual(hot_files.lookup("files", "a.jpg"), (b"abc", "stat"))
+        self.assertIsNone(hot_files.lookup("other", "a.jpg"))
+        self.assertEqual(hot_files.stats()["admitted"], 1)
+
+    def test_bounded_by_bytes(self):
+        hot_files = serving.HotFiles(max_bytes=10, ttl=60, admit_after=1)
+        hot_files.offer("files", "a.jpg", b"123456", "stat")
+        hot_files.offer("files", "b.jpg", b"123456", "stat")
+        self.assertIsNone(hot_files.peek("files", "a.jpg"))
+        self.assertIsNotNone(hot_files.peek("files", "b.jpg"))
+        self.assertEqual(hot_files.stats()["bytes"], 6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import storage
+
+
+class TestFileIO(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.executor = ThreadPoolExecutor(2)
+        self.io = storage.FileIO(self.executor)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    async def test_write_temp_then_replace(self):
+        temp_path, size = await self.io.write_temp(self.directory, b"image", len)
+        self.assertEqual(size, 5)
+        target = os.path.join(self.directory, "image.jpg")
+        await self.io.replace(temp_path, target)
+        self.assertFalse(os.path.exists(temp_path))
+        self.assertEqual(await self.io.read_range(target, 1, 3), b"mag")
+
+    async def test_remove_missing_file(self):
+        path = await self.io.write_temp(self.directory, b"x")
+        self.assertTrue(await self.io.remove(path))
+        self.assertFalse(await self.io.remove(path))
+
+    async def test_timings_per_operation(self):
+        await self.io.write_temp(self.directory, b"x")
+        await self.io.exists(self.directory)
+        await self.io.exists(self.directory)
+        stats = self.io.stats()
+        self.assertEqual(stats["write"]["count"], 1)
+        self.assertEqual(stats["stat"]["count"], 2)
+        self.assertGreaterEqual(stats["stat"]["max_ms"], stats["stat"]["avg_ms"])
+
+
+if __name__ == "__main__":
+    unittest.main()
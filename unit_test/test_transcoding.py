@@ -0,0 +1,127 @@
+import io
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from mongomock_motor import AsyncMongoMockClient
+from PIL import Image
+
+import backends
+import blobs
+import db
+import image_cache
+import layout
+import storage
+import transcoding
+
+
+async def run_inline(func, *args):
+    return func(*args)
+
+
+def photo_bytes():
+    image = Image.new("RGB", (64, 64))
+    image.putdata(
+        [(x * 4, y * 4, (x * y) % 256) for y in range(64) for x in range(64)]
+    )
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class TestAcceptedFormats(unittest.TestCase):
+    def test_explicit_types_only(self):
+        accept = "image/avif,image/webp,image/apng,image/*,*/*;q=0.8"
+        self.assertEqual(transcoding.accepted_formats(accept), {"avif", "webp"})
+        self.assertEqual(transcoding.accepted_formats("*/*"), set())
+        self.assertEqual(transcoding.accepted_formats(None), set())
+
+    def test_zero_quality_excludes(self):
+        accept = "image/avif;q=0, image/webp;q=0.5"
+        self.assertEqual(transcoding.accepted_formats(accept), {"webp"})
+
+
+@unittest.skipUnless(transcoding.TRANSCODE_FORMATS, "Pillow can't encode renditions")
+class TestTranscoder(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        self.executor = ThreadPoolExecutor(2)
+        self.storage = storage.FileIO(self.executor)
+        self.files = backends.LocalBackend(self.storage, str(self.directory))
+        self.database = AsyncMongoMockClient()["test"]
+        self.images = db.ImageRepository(self.database)
+        self.blobs = blobs.BlobStore(
+            self.database, self.directory, self.directory, self.storage, self.files
+        )
+        self.transcoder = transcoding.Transcoder(
+            self.database,
+            self.files,
+            self.blobs,
+            image_cache.ImageCache(self.images),
+            run_inline,
+        )
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    async def add_image(self, image_id, data, extension=".png"):
+        sha256, path = await self.blobs.store_bytes(data, extension)
+        await self.images.insert_one(
+            {"image_id": image_id, "image_path": path, "blob": sha256}
+        )
+        return sha256, self.blobs.key_for(path)
+
+    async def test_renditions_are_recorded_and_chosen(self):
+        sha256, key = await self.add_image("a", photo_bytes())
+        renditions = await self.transcoder.transcode(sha256)
+
+        self.assertTrue(renditions)
+        for name in renditions:
+            self.assertTrue(await self.files.exists(layout.rendition_key(key, name)))
+        image_data = await self.images.find_one({"image_id": "a"})
+        self.assertEqual(image_data["renditions"], renditions)
+
+        size = (await self.files.stat(key)).st_size
+        smallest = min(renditions, key=renditions.get)
+        self.assertEqual(
+            await self.transcoder.choose(key, size, "image/avif,image/webp"),
+            layout.rendition_key(key, smallest),
+        )
+        self.assertIsNone(await self.transcoder.choose(key, size, "*/*"))
+
+    async def test_same_bytes_share_renditions(self):
+        data = photo_bytes()
+        sha256, _ = await self.add_image("a", data)
+        renditions = await self.transcoder.transcode(sha256)
+        await self.add_image("b", data)
+
+        self.assertIsNone(await self.transcoder.transcode(sha256))
+        image_data = await self.images.find_one({"image_id": "b"})
+        self.assertEqual(image_data["renditions"], renditions)
+
+    async def test_renditions_go_with_the_blob(self):
+        sha256, key = await self.add_image("a", photo_bytes())
+        renditions = await self.transcoder.transcode(sha256)
+
+        await self.blobs.release(sha256)
+        self.assertFalse(await self.files.exists(key))
+        for name in renditions:
+            self.assertFalse(await self.files.exists(layout.rendition_key(key, name)))
+
+    async def test_unreadable_image_is_not_retried(self):
+        sha256, key = await self.add_image("a", b"not an image")
+        self.assertEqual(await self.transcoder.transcode(sha256), {})
+
+        blob = await self.database["blobs"].find_one({"_id": sha256})
+        self.assertEqual(blob["renditions"], {})
+        self.assertIn("transcode_error", blob)
+        self.assertEqual(await self.transcoder.sweep(), 0)
+        # No temp files are left behind.
+        self.assertEqual(os.listdir(self.directory), [key.split("/")[0]])
+
+    async def test_sweep_queues_blobs_without_renditions(self):
+        sha256, _ = await self.add_image("a", photo_bytes())
+        self.assertEqual(await self.transcoder.sweep(), 1)
+        self.assertEqual(self.transcoder.queue.get_nowait(), sha256)
@@ -2,11 +2,10 @@ import os
 import unittest
 import requests
 
-# Replace with the URL of your API endpoint
-API_ENDPOINT = "http://localhost:8000/images/upload"
+# Needs a running server, see benchmark/bench.py for a self-contained run.
+API_ENDPOINT = os.getenv("API_ENDPOINT", "http://localhost:9527/images/upload")
 
-# Replace with the path to the folder containing the test images
-IMAGE_FOLDER = "../test_images"
+IMAGE_FOLDER = os.path.join(os.path.dirname(__file__), "..", "test_images")
 
 
 class TestImageUpload(unittest.TestCase):
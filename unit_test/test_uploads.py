@@ -0,0 +1,161 @@
+import asyncio
+import hashlib
+import io
+import os
+import tempfile
+import unittest
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from mongomock_motor import AsyncMongoMockClient
+from PIL import Image
+
+import db
+import storage
+import uploads
+
+FIELDS = ("title", "name")
+
+
+class TestBatchMetadata(unittest.TestCase):
+    def test_missing_metadata_gives_empty_info(self):
+        self.assertEqual(uploads.batch_metadata(None, 2, FIELDS), [{}, {}])
+
+    def test_keeps_known_fields_as_strings(self):
+        metadata = uploads.batch_metadata(
+            '[{"title": "A", "price": 1}, {"name": 7, "title": null}]', 2, FIELDS
+        )
+        self.assertEqual(metadata, [{"title": "A"}, {"name": "7"}])
+
+    def test_rejects_malformed_metadata(self):
+        for raw in ("not json", '{"title": "A"}', "[1]", '[{"title": "A"}]'):
+            with self.assertRaises(ValueError, msg=raw):
+                uploads.batch_metadata(raw, 2, FIELDS)
+
+
+class FakeStream:
+    """Request body chunks, an exception raised where the client went away."""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    async def read(self):
+        if not self.chunks:
+            return None
+        chunk = self.chunks.pop(0)
+        if isinstance(chunk, BaseException):
+            raise chunk
+        return chunk
+
+
+class FakeRequest:
+    def __init__(self, chunks, headers=None):
+        self.headers = headers or {}
+        self.stream = FakeStream(chunks)
+
+
+class TestReceiveToTemp(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.executor = ThreadPoolExecutor(2)
+        self.storage = storage.FileIO(self.executor)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    async def receive(self, chunks, headers=None):
+        return await uploads.receive_to_temp(
+            FakeRequest(chunks, headers), self.directory, self.storage, max_size=10
+        )
+
+    def assertNoTempFiles(self):
+        self.assertEqual(os.listdir(self.directory), [])
+
+    async def test_body_is_hashed_while_written(self):
+        received = await self.receive([b"abcd", b"efg"])
+
+        self.assertEqual(received.size, 7)
+        self.assertEqual(received.sha256, hashlib.sha256(b"abcdefg").hexdigest())
+        with open(received.temp_path, "rb") as f:
+            self.assertEqual(f.read(), b"abcdefg")
+        self.assertTrue(received.temp_path.endswith(".upload"))
+
+    async def test_body_over_the_limit_is_removed(self):
+        with self.assertRaises(uploads.UploadTooLarge):
+            await self.receive([b"123456", b"789012"])
+        self.assertNoTempFiles()
+
+    async def test_content_length_over_the_limit_is_rejected_unread(self):
+        request = FakeRequest([b"x" * 11], {"content-length": "11"})
+        with self.assertRaises(uploads.UploadTooLarge):
+            await uploads.receive_to_temp(
+                request, self.directory, self.storage, max_size=10
+            )
+        self.assertEqual(len(request.stream.chunks), 1)
+        self.assertNoTempFiles()
+
+    async def test_disconnect_removes_the_temp_file(self):
+        for error in (ConnectionResetError(), asyncio.CancelledError()):
+            with self.assertRaises(type(error)):
+                await self.receive([b"abc", error])
+            self.assertNoTempFiles()
+
+
+class TestStreamUploadRoute(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        import app
+
+        self.app = app.app
+        self.temp_directory = app.UPLOAD_TEMP_DIRECTORY
+        client = AsyncMongoMockClient()
+        self.addCleanup(setattr, db, "client_factory", db.client_factory)
+        db.client_factory = lambda: client
+
+    def leftover_uploads(self):
+        if not self.temp_directory.exists():
+            return []
+        return [name for name in os.listdir(self.temp_directory) if ".upload" in name]
+
+    async def test_body_over_the_limit_answers_413(self):
+        before = self.leftover_uploads()
+
+        async def body():
+            # Chunked, without a Content-Length to reject it up front.
+            for _ in range(3):
+                yield b"x" * (uploads.MAX_UPLOAD_SIZE // 2)
+
+        _, response = await self.app.asgi_client.post(
+            "/images/upload/stream",
+            content=body(),
+            headers={"content-type": "image/jpeg"},
+        )
+        self.assertEqual(response.status, 413)
+        self.assertEqual(self.leftover_uploads(), before)
+
+
+class TestVariantRoute(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        import app
+
+        self.app = app.app
+        client = AsyncMongoMockClient()
+        self.addCleanup(setattr, db, "client_factory", db.client_factory)
+        db.client_factory = lambda: client
+        app.IMAGE_DIRECTORY.mkdir(exist_ok=True)
+        self.path = app.IMAGE_DIRECTORY.joinpath(f"{uuid.uuid4().hex}.jpg")
+        self.addCleanup(self.path.unlink)
+
+    async def test_undecodable_image_answers_400(self):
+        image = io.BytesIO()
+        Image.new("RGB", (64, 64)).save(image, "JPEG")
+        # Truncated, Pillow raises OSError rather than UnidentifiedImageError.
+        self.path.write_bytes(image.getvalue()[:200])
+
+        _, response = await self.app.asgi_client.get(
+            f"/images/{self.path.name}", params={"width": "10"}
+        )
+        self.assertEqual(response.status, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import unittest
+
+from mongomock_motor import AsyncMongoMockClient
+
+import app
+import db
+import versioning
+
+
+class TestIfMatch(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(versioning.parse_if_match('"3"'), 3)
+        self.assertEqual(versioning.parse_if_match('W/"3"'), 3)
+        self.assertIsNone(versioning.parse_if_match("*"))
+        self.assertIsNone(versioning.parse_if_match(None))
+        with self.assertRaises(ValueError):
+            versioning.parse_if_match('"abc"')
+        with self.assertRaises(ValueError):
+            versioning.parse_if_match('"-1"')
+
+    def test_etag_round_trip(self):
+        self.assertEqual(versioning.parse_if_match(versioning.etag(7)), 7)
+        self.assertEqual(versioning.etag(None), '"0"')
+
+    def test_info_update_sets_changed_fields_only(self):
+        update = versioning.info_update({"title": "Ab", "price": "10"})
+        self.assertEqual(
+            update,
+            {
+                "info.title": "Ab",
+                "search.title": ["a", "ab", "b"],
+                "info.price": "10",
+            },
+        )
+
+
+class TestCompareAndSwap(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.images = db.ImageRepository(AsyncMongoMockClient()["test"])
+
+    async def update(self, version, title):
+        return await self.images.find_one_and_update(
+            {"image_id": "a", **versioning.expected(version)},
+            {"$set": versioning.info_update({"title": title}), "$inc": {"version": 1}},
+        )
+
+    async def test_stale_version_is_rejected(self):
+        await self.images.insert_one(
+            {"image_id": "a", "info": {"title": "t", "name": "n"}, "version": 1}
+        )
+        self.assertIsNotNone(await self.update(1, "first"))
+        self.assertIsNone(await self.update(1, "second"))
+        image_data = await self.images.find_one({"image_id": "a"})
+        self.assertEqual(image_data["version"], 2)
+        self.assertEqual(image_data["info"], {"title": "first", "name": "n"})
+
+    async def test_documents_without_version_are_version_zero(self):
+        await self.images.insert_one({"image_id": "a", "info": {}})
+        self.assertIsNone(await self.update(1, "x"))
+        self.assertIsNotNone(await self.update(0, "x"))
+        image_data = await self.images.find_one({"image_id": "a"})
+        self.assertEqual(versioning.current(image_data), 1)
+
+
+class TestReplaceDocument(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.images = db.ImageRepository(AsyncMongoMockClient()["test"])
+        await self.images.insert_one(
+            {"image_id": "a", "info": {"title": "t", "price": "1"}, "version": 1}
+        )
+
+    async def replace(self, expected_version, title):
+        image_data = await self.images.find_one({"image_id": "a"}, {"_id": 0})
+
+        def change(image_data):
+            image_data["info"]["title"] = title
+
+        # Another write lands between the read and the replacement.
+        await self.images.find_one_and_update(
+            {"image_id": "a"},
+            {"$set": {"info.price": "2"}, "$inc": {"version": 1}},
+        )
+        return await app.replace_document(
+            self.images, image_data, expected_version, change
+        )
+
+    async def test_plain_replace_applies_to_the_latest_version(self):
+        old_image_data, image_data = await self.replace(None, "new")
+
+        self.assertEqual(old_image_data["version"], 2)
+        stored = await self.images.find_one({"image_id": "a"})
+        self.assertEqual(stored["version"], 3)
+        self.assertEqual(stored["info"], {"title": "new", "price": "2"})
+        self.assertEqual(image_data["version"], 3)
+
+    async def test_if_match_replace_conflicts(self):
+        old_image_data, conflict = await self.replace(1, "new")
+
+        self.assertIsNone(old_image_data)
+        self.assertEqual(conflict.status, 409)
+        stored = await self.images.find_one({"image_id": "a"})
+        self.assertEqual(stored["info"], {"title": "t", "price": "2"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import mimetypes
+import os
+from typing import NamedTuple
+
+# Largest accepted upload in bytes.
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(20 * 1024 * 1024)))
+# Most files accepted by one batch upload.
+MAX_BATCH_UPLOAD = int(os.getenv("MAX_BATCH_UPLOAD", "200"))
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class ReceivedUpload(NamedTuple):
+    temp_path: str
+    size: int
+    sha256: str
+
+
+def upload_extension(request):
+    """File extension from the ``filename`` argument or the Content-Type."""
+    filename = request.args.get("filename") or request.headers.get("x-filename", "")
+    _, extension = os.path.splitext(filename)
+    if extension:
+        return extension
+    content_type = request.headers.get("content-type", "").split(";")[0]
+    return mimetypes.guess_extension(content_type) or ""
+
+
+async def receive_to_temp(request, directory, storage, max_size=None):
+    """
+    Stream the request body into a temp file inside ``directory``.
+
+    Size and sha256 are computed while writing, the writes go through
+    ``storage``. UploadTooLarge is raised as soon as Content-Length or the
+    bytes received exceed ``max_size`` (MAX_UPLOAD_SIZE by default). The
+    temp file is removed on any failure.
+    """
+    max_size = max_size or MAX_UPLOAD_SIZE
+    content_length = request.headers.get("content-length")
+    if content_length and int(content_length) > max_size:
+        raise UploadTooLarge
+
+    f, temp_path = await storage.open_temp(directory)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        try:
+            while True:
+                chunk = await request.stream.read()
+                if chunk is None:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    raise UploadTooLarge
+                digest.update(chunk)
+                await storage.run("write", f.write, chunk)
+        finally:
+            await storage.run("write", f.close)
+    except BaseException:
+        await storage.remove(temp_path)
+        raise
+
+    return ReceivedUpload(temp_path, size, digest.hexdigest())
+
+
+def batch_metadata(raw, count, fields):
+    """
+    Per-file info of a batch upload from its ``metadata`` form field.
+
+    ``raw`` is a JSON array with one object per file, in the order of the
+    files, or empty. Only keys in ``fields`` are kept. Raises ValueError if
+    it is malformed or does not line up with the files.
+    """
+    if not raw:
+        return [{} for _ in range(count)]
+    try:
+        items = json.loads(raw)
+    except ValueError:
+        raise ValueError("metadata must be a JSON array")
+    if not isinstance(items, list) or not all(isinstance(i, dict) for i in items):
+        raise ValueError("metadata must be a JSON array of objects")
+    if len(items) != count:
+        raise ValueError(f"metadata has {len(items)} entries for {count} files")
+    return [
+        {k: str(v) for k, v in item.items() if k in fields and v is not None}
+        for item in items
+    ]
+
+
+async def discard(storage, upload):
+    await storage.remove(upload.temp_path)
@@ -0,0 +1,60 @@
+"""
+Optimistic concurrency for image documents.
+
+Every write bumps the document's ``version``, documents stored before it
+existed count as version 0. Clients send the version they edited as
+``If-Match`` (the ``ETag`` of the image details) and the update only applies
+while the document is still at that version, otherwise they get a 409 with
+the current version and can retry on fresh data.
+"""
+import search_index
+
+INITIAL_VERSION = 1
+
+
+def etag(version):
+    return f'"{version or 0}"'
+
+
+def current(image_data):
+    return image_data.get("version") or 0
+
+
+def parse_if_match(value):
+    """
+    The version an ``If-Match`` header asks for, None for ``*`` or no
+    header. Raises ValueError for anything else.
+    """
+    if value is None or value.strip() == "*":
+        return None
+    value = value.strip()
+    if value.startswith("W/"):
+        value = value[2:]
+    try:
+        version = int(value.strip('"'))
+    except ValueError:
+        raise ValueError("If-Match must be an image version")
+    if version < 0:
+        raise ValueError("If-Match must be an image version")
+    return version
+
+
+def expected(version):
+    """Query condition matching documents at ``version``."""
+    if version is None:
+        return {}
+    # None also matches documents without the field.
+    return {"version": version or None}
+
+
+def info_update(changes):
+    """
+    ``$set`` of the changed info fields and their search tokens only, so
+    concurrent edits of other fields are kept.
+    """
+    update = {}
+    for field, value in changes.items():
+        update[f"info.{field}"] = value
+        if field in search_index.SEARCH_FIELDS:
+            update[f"search.{field}"] = search_index.field_tokens(value)
+    return update